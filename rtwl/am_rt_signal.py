@@ -1,9 +1,11 @@
 import sys
 import numpy as np
-import scipy.stats as ss
-from itertools import islice
+from scipy import fftpack
+from scipy.signal import lfilter
+from numpy.lib.stride_tricks import as_strided
 from obspy.core.trace import Trace, UTCDateTime
 from obspy.realtime.rtmemory import RtMemory
+from am_signal import filter_cache
 
 # submitted to obspy.realtime
 # not not modify
@@ -29,14 +31,51 @@ from obspy.realtime.rtmemory import RtMemory
 #    return trace.data
 # end submitted code
 
-def neg_to_zero(trace, rtmemory_list=None):
+# All the processes below take an optional out array of the shape of the
+# trace data, into which they write their output (it may be the trace data
+# itself). Without it the output is a new array of the type of the data
+# (float32 for integer data). Double precision is only used internally, for
+# the recursive filters and the running sums.
+
+def _output(sample, out=None):
+    """
+    Returns the array the output of a process on sample is written to : out
+    if given, otherwise a new array of the type of sample (float32 for
+    integer data).
+    """
+    if out is None:
+        dtype=sample.dtype if sample.dtype.kind=='f' else np.float32
+        out=np.empty(sample.shape, dtype=dtype)
+    return out
+
+def _work_array(work, name, shape, dtype=np.float64):
+    """
+    Returns an uninitialized array of the given shape and type. If work is a
+    dict, the array is a view of a buffer kept in it under name and reused
+    by the following calls (the buffer only grows), so that processing
+    packets of the same length does not allocate memory.
+    """
+    if work is None:
+        return np.empty(shape, dtype=dtype)
+    size=1
+    for s in shape:
+        size*=s
+    buf=work.get(name)
+    if buf is None or buf.dtype!=dtype or len(buf) < size:
+        buf=np.empty(size, dtype=dtype)
+        work[name]=buf
+    return buf[0:size].reshape(shape)
+
+def neg_to_zero(trace, rtmemory_list=None, out=None):
     """
-    Set all negative values to zero
+    Set all negative values to zero (in place, unless out is given)
 
     :type trace: :class:`~obspy.core.trace.Trace`
     :param trace: :class:`~obspy.core.trace.Trace` object to append to this RtTrace
     :type rtmemory_list: list of :class:`~obspy.realtime.rtmemory.RtMemory`, optional
     :param rtmemory_list: Persistent memory used by this process for specified trace
+    :type out: :class:`numpy.ndarray`, optional
+    :param out: array of the shape of the data for the output
     :rtype: Numpy :class:`numpy.ndarray`
     :return: Processed trace data from appended Trace object
     """
@@ -45,12 +84,31 @@ def neg_to_zero(trace, rtmemory_list=None):
         msg = "Trace parameter must be an obspy.core.trace.Trace object."
         raise ValueError(msg)
 
-    trace.data[trace.data < 0.0] = 0.0
-    return trace.data
+    if out is None:
+        out = trace.data
+    np.maximum(trace.data, trace.data.dtype.type(0), out=out)
+    return out
+
+def _recursive_average(x, C1, a1, y_last):
+    """
+    Returns the recursive (exponential) average y[i] = a1*y[i-1] + C1*x[i]
+    starting from y[-1] = y_last, computed as an IIR filter.
+    """
+    y, zf = lfilter([C1], [1.0, -a1], x, zi=[a1*y_last])
+    return y
+
+def _init_memory(rtmemory, value):
+    """
+    Initializes a RtMemory holding a single double precision value (the last
+    output of a recursive filter).
+    """
+    if not rtmemory.initialized:
+        rtmemory.initialize(np.float64, 1, 0, value, 0)
 
-def mean(trace, win=1.0, rtmemory_list=None):
+def mean(trace, win=1.0, rtmemory_list=None, out=None):
     """
-    Calculate recursive mean. win is a window length
+    Calculate recursive mean. win is a window length, out an optional output
+    array.
     """
 
     if not isinstance(trace, Trace):
@@ -67,41 +125,27 @@ def mean(trace, win=1.0, rtmemory_list=None):
     if np.size(sample) < 1:
         return sample
 
-    # get simple info from trace
-    npts=len(sample)
-
-    # prepare the output array
-    mu1 = np.empty(npts, sample.dtype)
-
     # prepare the rt memory
     rtmemory_mu1 = rtmemory_list[0]
-
-    if not rtmemory_mu1.initialized:
-        memory_size_input  = 1
-        memory_size_output = 0
-        rtmemory_mu1.initialize(sample.dtype, memory_size_input,\
-                                memory_size_output, 0, 0)
-
-    # initialize from memory
-
-    mu1_last = rtmemory_mu1.input[0]
+    _init_memory(rtmemory_mu1, 0)
 
     C1 = dt/float(win)
     a1 = 1-C1
 
-    # do recursive mean
-    for i in xrange(npts):
-        mu1[i] = a1*mu1_last + C1*sample[i]
-        mu1_last=mu1[i]
+    # do recursive mean (in double precision)
+    mu1 = _recursive_average(sample, C1, a1, rtmemory_mu1.input[0])
 
     # save to memory
-    rtmemory_mu1.input[0] = mu1_last
+    rtmemory_mu1.input[0] = mu1[-1]
 
-    return mu1
+    out = _output(sample, out)
+    out[:] = mu1
+    return out
 
-def variance(trace, win=1.0, rtmemory_list=None):
+def variance(trace, win=1.0, rtmemory_list=None, out=None):
     """
-    Calculate recursive variance. Win is a window in seconds.
+    Calculate recursive variance. Win is a window in seconds, out an optional
+    output array.
     """
 
     if not isinstance(trace, Trace):
@@ -113,61 +157,41 @@ def variance(trace, win=1.0, rtmemory_list=None):
         rtmemory_list = [RtMemory(), RtMemory()]
 
     # deal with case of empty trace
-    # are going to need double precision here
-    sample = trace.data.astype('float64')
+    sample = trace.data
     if np.size(sample) < 1:
         return sample
 
-    # get simple info from trace
-    npts=len(sample)
     dt=trace.stats.delta
 
-    # prepare the output array
-    mu2 = np.empty(npts, sample.dtype)
-
     # prepare the rt memory
     rtmemory_mu1 = rtmemory_list[0]
     rtmemory_mu2 = rtmemory_list[1]
-
-    if not rtmemory_mu1.initialized:
-        memory_size_input  = 1
-        memory_size_output = 0
-        rtmemory_mu1.initialize(sample.dtype, memory_size_input,\
-                                memory_size_output, 0, 0)
-
-    if not rtmemory_mu2.initialized:
-        memory_size_input  = 1
-        memory_size_output = 0
-        rtmemory_mu2.initialize(sample.dtype, memory_size_input,\
-                                memory_size_output, sample[0]*sample[0], 0)
-    # initialize from memory
-
-
-    mu1_last = rtmemory_mu1.input[0]
-    mu2_last = rtmemory_mu2.input[0]
+    x0 = float(sample[0])
+    _init_memory(rtmemory_mu1, 0)
+    _init_memory(rtmemory_mu2, x0*x0)
 
     C1 = dt/float(win)
     a1 = 1-C1
     C2 = (1.0 - a1*a1)/2.0
 
-    # do recursive mean
-    for i in xrange(npts):
-        mu1 = a1*mu1_last + C1*sample[i]
-        mu1_last=mu1
-        dx2 = (sample[i]-mu1_last)*(sample[i]-mu1_last)
-        mu2[i] = a1*mu2_last + C2*dx2
-        mu2_last=mu2[i]
+    # do recursive mean and variance (in double precision)
+    mu1 = _recursive_average(sample, C1, a1, rtmemory_mu1.input[0])
+    dx2 = sample-mu1
+    dx2 *= dx2
+    mu2 = _recursive_average(dx2, C2, a1, rtmemory_mu2.input[0])
 
     # save to memory
-    rtmemory_mu1.input[0] = mu1_last
-    rtmemory_mu2.input[0] = mu2_last
-
+    rtmemory_mu1.input[0] = mu1[-1]
+    rtmemory_mu2.input[0] = mu2[-1]
 
-    return mu2
+    out = _output(sample, out)
+    out[:] = mu2
+    return out
 
-def dx2(trace, win=1.0, rtmemory_list=None):
+def dx2(trace, win=1.0, rtmemory_list=None, out=None):
     """
-    Calculate recursive variance. C is a scaling constant
+    Calculate recursive variance. C is a scaling constant, out an optional
+    output array.
     """
 
     if not isinstance(trace, Trace):
@@ -179,63 +203,255 @@ def dx2(trace, win=1.0, rtmemory_list=None):
         rtmemory_list = [RtMemory(), RtMemory()]
 
     # deal with case of empty trace
-    # are going to need double precision here
-    sample = trace.data.astype('float64')
+    sample = trace.data
     if np.size(sample) < 1:
         return sample
 
-    # get simple info from trace
     npts=len(sample)
     dt=trace.stats.delta
 
-    # prepare the output array
-    dx2 = np.empty(npts, sample.dtype)
-
     # prepare the rt memory
     rtmemory_mu1 = rtmemory_list[0]
     rtmemory_mu2 = rtmemory_list[1]
+    x0 = float(sample[0])
+    _init_memory(rtmemory_mu1, 0)
+    _init_memory(rtmemory_mu2, x0*x0)
 
-    if not rtmemory_mu1.initialized:
-        memory_size_input  = 1
-        memory_size_output = 0
-        rtmemory_mu1.initialize(sample.dtype, memory_size_input,\
-                                memory_size_output, 0, 0)
+    C1 = dt/float(win)
+    a1 = 1.0-C1
+    C2 = (1.0 - a1*a1)/2.0
 
-    if not rtmemory_mu2.initialized:
-        memory_size_input  = 1
-        memory_size_output = 0
-        rtmemory_mu2.initialize(sample.dtype, memory_size_input,\
-                                memory_size_output, sample[0]*sample[0], 0)
-    # initialize from memory
+    # do recursive mean and variance (in double precision)
+    mu1 = _recursive_average(sample, C1, a1, rtmemory_mu1.input[0])
+    dx2 = sample-mu1
+    dx2 *= dx2
+    mu2 = _recursive_average(dx2, C2, a1, rtmemory_mu2.input[0])
 
+    # normalize by the variance before each sample
+    dx2[0] /= rtmemory_mu2.input[0]
+    dx2[1:] /= mu2[0:npts-1]
 
-    mu1_last = rtmemory_mu1.input[0]
-    mu2_last = rtmemory_mu2.input[0]
+    # save to memory
+    rtmemory_mu1.input[0] = mu1[-1]
+    rtmemory_mu2.input[0] = mu2[-1]
+
+    out = _output(sample, out)
+    out[:] = dx2
+    return out
+
+def rec_kurtosis(trace, win=3.0, rtmemory_list=None, out=None):
+    """
+    Calculate recursive kurtosis, as the ratio of the recursive fourth
+    central moment to the square of the recursive variance, minus 3 (so
+    Gaussian noise gives 0). win is a window in seconds.
+
+    The mean is started at the first sample and the variance at the variance
+    of the first trace, with the fourth moment of a Gaussian distribution.
+    out is an optional output array.
+    """
+
+    if not isinstance(trace, Trace):
+        msg = "Trace parameter must be an obspy.core.trace.Trace object."
+        raise ValueError(msg)
+    
+    # if this is the first appended trace, the rtmemory_list will be None
+    if not rtmemory_list:
+        rtmemory_list = [RtMemory(), RtMemory(), RtMemory()]
+
+    # deal with case of empty trace
+    sample = trace.data
+    if np.size(sample) < 1:
+        return sample
+
+    dt=trace.stats.delta
+
+    # prepare the rt memory
+    rtmemory_mu1 = rtmemory_list[0]
+    rtmemory_mu2 = rtmemory_list[1]
+    rtmemory_mu4 = rtmemory_list[2]
+    if not rtmemory_mu2.initialized:
+        var0 = np.var(sample.astype(np.float64))
+        if var0 == 0:
+            var0 = 1.0
+        _init_memory(rtmemory_mu1, float(sample[0]))
+        _init_memory(rtmemory_mu2, var0)
+        _init_memory(rtmemory_mu4, 3*var0*var0)
 
     C1 = dt/float(win)
     a1 = 1.0-C1
-    C2 = (1.0 - a1*a1)/2.0
 
-    # do recursive mean
-    for i in xrange(npts):
-        mu1 = a1*mu1_last + C1*sample[i]
-        mu1_last=mu1
-        dx2[i] = (sample[i]-mu1_last)*(sample[i]-mu1_last)
-        mu2 = a1*mu2_last + C2*dx2[i]
-        dx2[i] = dx2[i] / mu2_last
-        mu2_last=mu2
+    # do recursive mean and central moments (in double precision)
+    mu1 = _recursive_average(sample, C1, a1, rtmemory_mu1.input[0])
+    dx2 = sample-mu1
+    dx2 *= dx2
+    mu2 = _recursive_average(dx2, C1, a1, rtmemory_mu2.input[0])
+    dx2 *= dx2
+    mu4 = _recursive_average(dx2, C1, a1, rtmemory_mu4.input[0])
 
     # save to memory
-    rtmemory_mu1.input[0] = mu1_last
-    rtmemory_mu2.input[0] = mu2_last
+    rtmemory_mu1.input[0] = mu1[-1]
+    rtmemory_mu2.input[0] = mu2[-1]
+    rtmemory_mu4.input[0] = mu4[-1]
+
+    # a constant signal gives a kurtosis of -3, as sw_kurtosis
+    zero = mu2 <= 0
+    np.copyto(mu2, 1.0, where=zero)
+    mu2 *= mu2
+    mu4 /= mu2
+    mu4 -= 3.0
+    np.copyto(mu4, -3.0, where=zero)
 
+    out = _output(sample, out)
+    out[:] = mu4
+    return out
 
-    return dx2
 
+# kernels shorter than this are convolved directly, longer ones by FFT
+CONVOLVE_FFT_MIN_LENGTH=64
 
-def convolve(trace, conv_signal=None, rtmemory_list=None):
+def _kernel_fft(kernel, nfft, spectra=None):
+    """
+    Returns the real FFT of a real kernel zero-padded to nfft points. The
+    spectrum is taken from the filter cache (which hashes the kernel), or if
+    spectra is a dict, from spectra[nfft] : callers convolving packets by
+    the same kernel keep it there, so that the cache is only looked up once
+    per FFT length.
     """
-    Convolve data with a (complex) signal (conv_signal). 
+    if spectra is None:
+        return filter_cache.spectrum(kernel, nfft)
+    spec=spectra.get(nfft)
+    if spec is None:
+        spec=filter_cache.spectrum(kernel, nfft)
+        spectra[nfft]=spec
+    return spec
+
+def convolve_fft_length(flen):
+    """
+    Returns the FFT length used to convolve packets by a kernel of flen
+    points : the power of 2 of at least 4 kernel lengths. It does not depend
+    on the packet length, so all the packets use the same spectrum of the
+    kernel and the same blocks. The output of a packet then only differs
+    from that of the whole trace by the round-off of the FFTs (the blocks
+    start at the start of each packet).
+    """
+    return int(2**np.ceil(np.log2(4*flen)))
+
+def _multiply_packed(spec, kernel_spec, work=None):
+    """
+    Multiplies in place the real FFTs along the last axis of spec, in the
+    packed format of scipy.fftpack.rfft (of an even length), by a spectrum
+    computed by numpy.fft.rfft.
+    """
+    re=spec[..., 1:-1:2]
+    im=spec[..., 2:-1:2]
+    a=kernel_spec.real[1:-1]
+    b=kernel_spec.imag[1:-1]
+    im_b=_work_array(work, 'packed_im_b', re.shape)
+    re_b=_work_array(work, 'packed_re_b', re.shape)
+    np.multiply(im, b, out=im_b)
+    np.multiply(re, b, out=re_b)
+    re*=a
+    re-=im_b
+    im*=a
+    im+=re_b
+    spec[..., 0]*=kernel_spec.real[0]
+    spec[..., -1]*=kernel_spec.real[-1]
+
+def _overlap_save(x, kernel, work=None, spectra=None):
+    """
+    Returns the valid part of the convolution along the last axis of x by
+    kernel (the last len(kernel)-1 samples of each row that do not need data
+    outside x), computed by blocks with the overlap-save method. The blocks
+    are transformed in place, in buffers taken from work (see _work_array).
+    The spectra of the kernel are kept in spectra (see _kernel_fft).
+    """
+    flen=len(kernel)
+    nx=x.shape[-1]
+    n=nx-flen+1
+    nfft=convolve_fft_length(flen)
+    step=nfft-flen+1
+    nblocks=(n+step-1)//step
+    # overlapping blocks of nfft samples, every step samples
+    blocks=_work_array(work, 'fft_blocks', x.shape[:-1]+(nblocks, nfft))
+    for i in xrange(nblocks):
+        nb=min(nfft, nx-i*step)
+        blocks[..., i, 0:nb]=x[..., i*step:i*step+nb]
+        blocks[..., i, nb:]=0.0
+    spec=fftpack.rfft(blocks, axis=-1, overwrite_x=True)
+    _multiply_packed(spec, _kernel_fft(kernel, nfft, spectra), work)
+    y=fftpack.irfft(spec, axis=-1, overwrite_x=True)
+    # the first flen-1 samples of each block are wrapped around
+    out=_work_array(work, 'fft_out', x.shape[:-1]+(n,))
+    for i in xrange(nblocks):
+        nb=min(step, n-i*step)
+        out[..., i*step:i*step+nb]=y[..., i, flen-1:flen-1+nb]
+    return out
+
+def _overlap_save_bank(x, kernels, weights=None, spectra=None):
+    """
+    Overlap-save convolution of x (1D) by a bank of real kernels of the same
+    length, sharing the forward FFT of the blocks. Returns the (nbands, n)
+    valid parts of the convolutions if weights is None, otherwise their
+    combination with the given weights (computed with a single inverse FFT).
+    If spectra is a dict, the spectra of the kernels are kept in it, as an
+    array by FFT length.
+    """
+    nbands, flen = kernels.shape
+    nx=len(x)
+    n=nx-flen+1
+    nfft=convolve_fft_length(flen)
+    step=nfft-flen+1
+    nblocks=(n+step-1)//step
+    xp=np.zeros(nblocks*step+flen-1)
+    xp[0:nx]=x
+    blocks=as_strided(xp, shape=(nblocks, nfft), \
+            strides=(step*xp.strides[0], xp.strides[0]))
+    spec=np.fft.rfft(blocks, axis=-1)
+    kernel_spec=None
+    if spectra is not None:
+        kernel_spec=spectra.get(nfft)
+    if kernel_spec is None:
+        kernel_spec=np.array([_kernel_fft(kernel, nfft) for kernel in kernels])
+        if spectra is not None:
+            spectra[nfft]=kernel_spec
+    if weights is not None:
+        # the combination is linear : combine the kernels
+        spec*=np.dot(weights, kernel_spec)
+        y=np.fft.irfft(spec, nfft, axis=-1)
+        return y[:, flen-1:].ravel()[0:n]
+    out=np.empty((nbands, nblocks, step))
+    band_spec=np.empty(spec.shape, dtype=spec.dtype)
+    for i in xrange(nbands):
+        np.multiply(spec, kernel_spec[i], out=band_spec)
+        out[i]=np.fft.irfft(band_spec, nfft, axis=-1)[:, flen-1:]
+    return out.reshape(nbands, nblocks*step)[:, 0:n]
+
+def _convolve_valid(x, kernel, work=None, spectra=None):
+    """
+    Returns the valid part of the convolution along the last axis of x by a
+    real kernel, directly for short kernels and by FFT for long ones, using
+    the buffers of work (see _work_array) and the kernel spectra of spectra
+    (see _kernel_fft).
+    """
+    flen=len(kernel)
+    if flen >= CONVOLVE_FFT_MIN_LENGTH:
+        return _overlap_save(x, kernel, work, spectra)
+    # one shifted product per tap
+    n=x.shape[-1]-flen+1
+    y=_work_array(work, 'conv_out', x.shape[:-1]+(n,))
+    np.multiply(x[..., flen-1:flen-1+n], kernel[0], out=y)
+    if flen > 1:
+        tap=_work_array(work, 'conv_tap', y.shape)
+    for m in xrange(1, flen):
+        np.multiply(x[..., flen-1-m:flen-1-m+n], kernel[m], out=tap)
+        y+=tap
+    return y
+
+def convolve(trace, conv_signal=None, rtmemory_list=None, out=None):
+    """
+    Convolve data with a (complex) signal (conv_signal), keeping the real
+    part. Long signals are convolved by FFT (overlap-save), short ones
+    directly.
 
     Note that the signal length should be odd. For a signal of (2N+1) points,
     the resulting output trace will be time shifted by -N*dt where dt is the
@@ -252,6 +468,8 @@ def convolve(trace, conv_signal=None, rtmemory_list=None):
     :param conv_signal: signal with which to perform convolution
     :type rtmemory_list: list of :class:`~obspy.realtime.rtmemory.RtMemory`, optional
     :param rtmemory_list: Persistent memory used by this process for specified trace
+    :type out: :class:`numpy.ndarray`, optional
+    :param out: array of the shape of the data for the output
     :rtype: Numpy :class:`numpy.ndarray`
     :return: Processed trace data from appended Trace object
     """
@@ -260,8 +478,8 @@ def convolve(trace, conv_signal=None, rtmemory_list=None):
         msg = "Trace parameter must be an obspy.core.trace.Trace object."
         raise ValueError(msg)
 
-    if conv_signal == None :
-        return trace
+    if conv_signal is None :
+        return trace.data
 
     if not rtmemory_list:
         rtmemory_list=[RtMemory()]
@@ -271,51 +489,320 @@ def convolve(trace, conv_signal=None, rtmemory_list=None):
     if np.size(sample) < 1:
         return sample
 
-    flen=len(conv_signal)
-    flen2=(flen-1)/2
-    mem_size=3*flen2+1
+    # the real part of the convolution by a complex signal is the
+    # convolution by its real part
+    kernel=np.real(conv_signal)
+    flen=len(kernel)
+    # the memory holds the flen-1 samples preceding the new ones
+    mem_size=flen-1
 
     rtmemory=rtmemory_list[0]
     if not rtmemory.initialized:
-        first_trace=True
         memory_size_input  = mem_size
         memory_size_output = 0
         rtmemory.initialize(sample.dtype, memory_size_input,\
                                 memory_size_output, 0, 0)
+        # spectra of the kernel by FFT length
+        rtmemory.spectra={}
 
 
     # make an array of the right dimension
-    x=np.empty(len(sample)+mem_size, dtype=complex)
+    x=np.empty(len(sample)+mem_size)
     # fill it up partly with the memory, partly with the new data
     x[0:mem_size]=rtmemory.input[:]
     x[mem_size:]=sample[:]
 
     # do the convolution
-    x_new = np.real(np.convolve(x,conv_signal,'same'))
-    i_start=mem_size-flen2
-    i_end=i_start+len(sample)
+    x_new=_convolve_valid(x, kernel, spectra=rtmemory.spectra)
     
     # put new data into memory for next trace
     
     rtmemory.updateInput(sample)
 
-    return x_new[i_start:i_end]
+    out=_output(sample, out)
+    out[:]=x_new
+    return out
+
+def filter_bank(trace, kernels=None, weights=None, rtmemory_list=None, \
+        out=None):
+    """
+    Convolve data with a bank of (complex) signals of the same length
+    (kernels, see am_signal.gaussian_filter_bank), keeping the real parts,
+    and combine the bands : at each sample, the output of the band with the
+    largest absolute value if weights is None, otherwise the weighted sum of
+    the bands. The convolutions are done by overlap-save FFT, with a single
+    forward FFT per block for all the bands (and a single inverse FFT for a
+    weighted sum).
+
+    As for convolve, for signals of (2N+1) points the output is time shifted
+    by -N*dt.
 
-def _window(seq, n=2):
-    "Returns a sliding window (of width n) over data from the iterable"
-    "   s -> (s0,s1,...s[n-1]), (s1,s2,...,sn), ...                   "
-    it = iter(seq)
-    result = tuple(islice(it, n))
-    if len(result) == n:
-        yield result    
-    for elem in it:
-        result = result[1:] + (elem,)
-        yield result
+    :type trace: :class:`~obspy.core.trace.Trace`
+    :param trace: :class:`~obspy.core.trace.Trace` object to append to this RtTrace
+    :type kernels: :class:`numpy.ndarray`
+    :param kernels: (nbands, npts) signals with which to perform convolution
+    :type weights: list of float, optional
+    :param weights: weights of the bands for a weighted sum
+    :type rtmemory_list: list of :class:`~obspy.realtime.rtmemory.RtMemory`, optional
+    :param rtmemory_list: Persistent memory used by this process for specified trace
+    :type out: :class:`numpy.ndarray`, optional
+    :param out: array of the shape of the data for the output
+    :rtype: Numpy :class:`numpy.ndarray`
+    :return: Processed trace data from appended Trace object
+    """
+
+    if not isinstance(trace, Trace):
+        msg = "Trace parameter must be an obspy.core.trace.Trace object."
+        raise ValueError(msg)
 
+    if kernels is None :
+        return trace.data
 
-def sw_kurtosis(trace, win=3.0, rtmemory_list=None):
+    if not rtmemory_list:
+        rtmemory_list=[RtMemory()]
+
+    # deal with case of empty trace
+    sample = trace.data
+    if np.size(sample) < 1:
+        return sample
+
+    kernels=np.real(np.atleast_2d(kernels))
+    mem_size=kernels.shape[1]-1
+
+    rtmemory=rtmemory_list[0]
+    if not rtmemory.initialized:
+        rtmemory.initialize(sample.dtype, mem_size, 0, 0, 0)
+        # spectra of the kernels by FFT length
+        rtmemory.spectra={}
+
+    x=np.empty(len(sample)+mem_size)
+    x[0:mem_size]=rtmemory.input[:]
+    x[mem_size:]=sample[:]
+
+    if weights is not None:
+        x_new=_overlap_save_bank(x, kernels, np.asarray(weights, dtype=float),\
+                rtmemory.spectra)
+    else:
+        bands=_overlap_save_bank(x, kernels, spectra=rtmemory.spectra)
+        imax=np.argmax(np.abs(bands), axis=0)
+        x_new=bands[imax, np.arange(len(sample))]
+
+    rtmemory.updateInput(sample)
+
+    out=_output(sample, out)
+    out[:]=x_new
+    return out
+
+def _kurtosis_from_sums(wsums, npts, work=None):
+    """
+    Returns the kurtosis of windows of npts samples given the sums (first
+    axis) of the first to fourth powers of their samples. wsums is used as
+    work space (the result is a view of it), with the arrays of work (see
+    _work_array).
+    """
+    wsums/=float(npts)
+    s1, s2, s3, s4 = wsums
+    # central moments from the power sums :
+    # m2 = s2 - s1^2, m4 = s4 - s1*(4*s3 - s1*(6*s2 - 3*s1^2))
+    s1_2=_work_array(work, 'kurt_s1_2', s1.shape)
+    m2=_work_array(work, 'kurt_m2', s1.shape)
+    np.multiply(s1, s1, out=s1_2)
+    np.subtract(s2, s1_2, out=m2)
+    # a constant window gives a kurtosis of -3, as in scipy.stats.kurtosis
+    threshold=_work_array(work, 'kurt_threshold', s1.shape)
+    zero=_work_array(work, 'kurt_zero', s1.shape, np.bool_)
+    np.multiply(s2, 1e-12, out=threshold)
+    np.less_equal(m2, threshold, out=zero)
+    s2*=6.0
+    s1_2*=3.0
+    s2-=s1_2
+    s2*=s1
+    s3*=4.0
+    s3-=s2
+    s3*=s1
+    s4-=s3
+    np.copyto(m2, 1.0, where=zero)
+    m2*=m2
+    s4/=m2
+    s4-=3.0
+    np.copyto(s4, -3.0, where=zero)
+    return s4
+
+class _WindowSums(object):
+    """
+    Sums of the first to fourth powers of a stream of samples, minus a fixed
+    shift, over the sliding windows of up to npts samples ending at each new
+    sample. The stream is cut into blocks of npts samples : the sums are
+    kept as running sums from the start of the current block to each of its
+    samples, and, once a block is complete, from each of its samples to its
+    end. A window of npts samples is then the end of a block plus the start
+    of the next one, and a shorter window either that or a difference of
+    running sums of the same block. The running sums restart at each block,
+    so the round-off of large values does not carry over to the windows of
+    the following blocks, and appending n samples costs O(n) whatever npts
+    and the number of windows (only the sums of the last two blocks are
+    kept).
+
+    The buffers hold the samples along their first axis, the four powers
+    along the second one and the stations (of shape shape) along the next
+    ones.
     """
-    Compute kurtosis using a sliding window method. Calls scipy.stats.kurtosis
+
+    def __init__(self, npts, shape, shift, n=0):
+        """
+        :param npts: length of the longest window
+        :param shape: shape of a sample (() for a single station)
+        :param shift: value subtracted from the samples to limit round-off,
+            of shape shape
+        :param n: expected length of the appended packets, to size the
+            buffers
+        """
+        self.npts=npts
+        self.shape=tuple(shape)
+        self.shift=shift
+        # stream indexes of the first sample held and after the last one
+        self.start=0
+        self.end=0
+        cap=4*npts+2*n
+        self.powers=np.empty((cap, 4)+self.shape)
+        self.sums=np.empty((cap, 4)+self.shape)
+
+    def _reserve(self, n):
+        """
+        Makes room for n new samples, dropping the samples before the start
+        of the previous block.
+        """
+        if self.end+n-self.start <= len(self.powers):
+            return
+        N=self.npts
+        keep=max(0, (self.end//N-1)*N)
+        i0=keep-self.start
+        i1=self.end-self.start
+        if len(self.powers) < 4*N+2*n:
+            powers=np.empty((4*N+2*n, 4)+self.shape)
+            sums=np.empty(powers.shape)
+        else:
+            # the capacity leaves the kept samples (at most 2*npts) clear of
+            # their new place
+            powers=self.powers
+            sums=self.sums
+        powers[0:i1-i0]=self.powers[i0:i1]
+        sums[0:i1-i0]=self.sums[i0:i1]
+        self.powers=powers
+        self.sums=sums
+        self.start=keep
+
+    def history(self, k):
+        """
+        Returns the last k samples (k < npts), along the last axis.
+        """
+        i1=self.end-self.start
+        x=self.powers[i1-k:i1, 0]+self.shift
+        return np.rollaxis(x, 0, len(self.shape)+1)
+
+    def append(self, x, npts_list=None, out=None):
+        """
+        Appends the samples of x (along its last axis, of shape shape+(n,))
+        to the stream. If npts_list is given, writes into out the sums for
+        the windows of each length in npts_list ending at each new sample,
+        as a (len(npts_list), n, 4)+shape array. The stream must already
+        hold npts-1 samples.
+        """
+        N=self.npts
+        n=x.shape[-1]
+        self._reserve(n)
+        start=self.start
+        end=self.end
+        P=self.powers
+        S=self.sums
+        p=P[end-start:end-start+n]
+        np.subtract(np.rollaxis(x, -1), self.shift, out=p[:, 0])
+        for k in xrange(1, 4):
+            np.multiply(p[:, k-1], p[:, 0], out=p[:, k])
+        t=end
+        stop=end+n
+        while t < stop:
+            # new samples of the block starting at bs
+            bs=t-t%N
+            t1=min(stop, bs+N)
+            r0=t-start
+            r1=t1-start
+            np.cumsum(P[r0:r1], axis=0, out=S[r0:r1])
+            if t > bs:
+                S[r0:r1]+=S[r0-1]
+            if npts_list is not None:
+                for i in xrange(len(npts_list)):
+                    L=npts_list[i]
+                    o=out[i, t-end:t1-end]
+                    # windows starting in the previous block
+                    u=min(t1, bs+L-1)
+                    if u > t:
+                        np.add(S[r0:u-start], S[r0-L+1:u-start-L+1], \
+                                out=o[0:u-t])
+                    # window starting the block
+                    if t <= bs+L-1 < t1:
+                        o[bs+L-1-t]=S[bs+L-1-start]
+                    # windows within the block
+                    v=max(t, bs+L)
+                    if v < t1:
+                        np.subtract(S[v-start:r1], S[v-start-L:r1-L], \
+                                out=o[v-t:])
+            if t1==bs+N:
+                # the block is complete : sums from each sample to its end
+                rb=bs-start
+                np.cumsum(P[rb:rb+N][::-1], axis=0, out=S[rb:rb+N][::-1])
+            t=t1
+        self.end=stop
+
+def _kurtosis_bank(window_sums, x, npts_list, work=None):
+    """
+    Appends the samples of x (along its last axis) to window_sums (see
+    _WindowSums) and returns the maximum over the windows of the lengths in
+    npts_list of the kurtosis over the windows ending at each of them. The
+    work arrays are taken from work (see _work_array).
+    """
+    n=x.shape[-1]
+    shape=window_sums.shape
+    wsums=_work_array(work, 'kurt_wsums', (len(npts_list), n, 4)+shape)
+    window_sums.append(x, npts_list, wsums)
+    kurt=_work_array(work, 'kurt_max', shape+(n,))
+    for i in xrange(len(npts_list)):
+        # powers along the first axis and samples along the last one
+        w=np.rollaxis(wsums[i], 0, len(shape)+2)
+        k=_kurtosis_from_sums(w, npts_list[i], work)
+        if i==0:
+            kurt[...]=k
+        else:
+            np.maximum(kurt, k, out=kurt)
+    return kurt
+
+def _init_window_sums(rtmemory, sample, npts):
+    """
+    Initializes the memory of the sliding window kurtosis of sample with
+    the window sums (see _WindowSums) of the mirrored start of the data
+    (repeating the last sample if the trace is shorter), which pad the
+    first window.
+    """
+    n=len(sample)
+    mirror=sample[np.minimum(np.arange(npts-2, -1, -1), n-1)]
+    shift=(np.sum(mirror, dtype=np.float64)+np.sum(sample, dtype=np.float64))\
+            /(len(mirror)+n)
+    rtmemory.initialize(sample.dtype, 0, 0)
+    rtmemory.window_sums=_WindowSums(npts, (), shift, n)
+    rtmemory.window_sums.append(mirror)
+
+def sw_kurtosis(trace, win=3.0, rtmemory_list=None, out=None):
+    """
+    Compute kurtosis using a sliding window method. Gives the same result as
+    calling scipy.stats.kurtosis on each window, but uses running sums of the
+    first to fourth powers of the data over blocks of the window length, so
+    the cost per sample does not depend on the window length.
+
+    The memory holds the running sums of the last two blocks. They restart
+    at each block, so the round-off left by large amplitudes does not carry
+    over to the windows of the following blocks. The data are shifted by
+    their mean over the first trace to limit round-off. The first window is
+    padded with the mirrored start of the data.
 
     :type trace: :class:`~obspy.core.trace.Trace`
     :param trace: :class:`~obspy.core.trace.Trace` object to append to this RtTrace
@@ -323,6 +810,8 @@ def sw_kurtosis(trace, win=3.0, rtmemory_list=None):
     :param win: sliding window length in seconds
     :type rtmemory_list: list of :class:`~obspy.realtime.rtmemory.RtMemory`, optional
     :param rtmemory_list: Persistent memory used by this process for specified trace
+    :type out: :class:`numpy.ndarray`, optional
+    :param out: array of the shape of the data for the output
     :rtype: Numpy :class:`numpy.ndarray`
     :return: Processed trace data from appended Trace object
     """
@@ -343,39 +832,363 @@ def sw_kurtosis(trace, win=3.0, rtmemory_list=None):
     dt=trace.stats.delta
     npts=int(np.round(win/float(dt)))
 
-    # set up temporary array for kurtosis and output array
-    k_array=np.empty((len(sample),npts),dtype=sample.dtype)
-    x_out=np.empty(len(sample))
+    rtmemory=rtmemory_list[0]
+    if not rtmemory.initialized:
+        _init_window_sums(rtmemory, sample, npts)
+
+    xout=_kurtosis_bank(rtmemory.window_sums, sample, [npts])
+
+    out=_output(sample, out)
+    out[:]=xout
+    return out
+
+def sw_kurtosis_bank(trace, win_list=[3.0], rtmemory_list=None, out=None):
+    """
+    Compute the maximum over a bank of windows of the sliding window kurtosis
+    (see sw_kurtosis). All the windows are computed in a single pass from the
+    same powers of the data and the same running sums over blocks of the
+    longest window : an extra window only costs the combination of these
+    sums into its own and the kurtosis from them.
+
+    :type trace: :class:`~obspy.core.trace.Trace`
+    :param trace: :class:`~obspy.core.trace.Trace` object to append to this RtTrace
+    :type win_list: list of float
+    :param win_list: sliding window lengths in seconds
+    :type rtmemory_list: list of :class:`~obspy.realtime.rtmemory.RtMemory`, optional
+    :param rtmemory_list: Persistent memory used by this process for specified trace
+    :type out: :class:`numpy.ndarray`, optional
+    :param out: array of the shape of the data for the output
+    :rtype: Numpy :class:`numpy.ndarray`
+    :return: Processed trace data from appended Trace object
+    """
+
+    if not isinstance(trace, Trace):
+        msg = "Trace parameter must be an obspy.core.trace.Trace object."
+        raise ValueError(msg)
+
+    if not rtmemory_list:
+        rtmemory_list=[RtMemory()]
+
+    # deal with case of empty trace
+    sample = trace.data
+    if np.size(sample) < 1:
+        return sample
+
+    # get info from trace
+    dt=trace.stats.delta
+    npts_list=[int(np.round(win/float(dt))) for win in win_list]
 
     rtmemory=rtmemory_list[0]
-    mem_size=npts-1
     if not rtmemory.initialized:
-        sample_start=sample[0:mem_size]
-        first_trace=True
-        memory_size_input  = mem_size
-        memory_size_output = 0
-        rtmemory.initialize(sample.dtype, memory_size_input, memory_size_output)
-        rtmemory.input=sample_start[::-1]
+        _init_window_sums(rtmemory, sample, max(npts_list))
 
+    xout=_kurtosis_bank(rtmemory.window_sums, sample, npts_list)
 
-    # make an array of the right dimension
-    x=np.empty(len(sample)+mem_size, dtype=sample.dtype)
-    # fill it up partly with the memory, partly with the new data
-    x[0:mem_size]=rtmemory.input[:]
-    x[mem_size:]=sample[:]
+    out=_output(sample, out)
+    out[:]=xout
+    return out
 
-    # do the sliding window kurtosis
-    windows=_window(x,npts)
-    i=0
-    for w in windows:
-        k_array[i,0:npts]=w
-        i=i+1
-    xout = ss.kurtosis(k_array,axis=1)
 
-    
-    # put new data into memory for next trace
-    
-    rtmemory.updateInput(sample)
+def _station_index(stations, m, nsta):
+    """
+    Returns the index of the m stations of a block in (nsta, ...) state
+    arrays : a slice if they are consecutive (the state is then updated in
+    place), otherwise an integer array.
+    """
+    if stations is None:
+        return slice(0, nsta)
+    if isinstance(stations, np.ndarray):
+        stations=stations.reshape(m).tolist()
+    else:
+        stations=[int(ista) for ista in stations]
+    i0=stations[0]
+    if stations==range(i0, i0+m):
+        return slice(i0, i0+m)
+    return np.array(stations, dtype=int)
+
+
+class CFProcessor(object):
+    """
+    Computes the characteristic function of one or several synchronous
+    stations in a single pass over each packet : convolution by conv_signal
+    (real part), sliding-window kurtosis, causal boxcar smoothing,
+    differentiation and removal of the negative values.
+
+    Gives the same output as registering the convolve, sw_kurtosis, boxcar,
+    differentiate and neg_to_zero processes on a RtTrace per station
+    (including the rounding to float32 between the stages), but the state of
+    all the stages and stations is held here as (nsta, ...) arrays, packets
+    of several stations are processed at once along axis 1, and the
+    intermediate results are computed in buffers kept between packets. Once
+    a packet length has been seen, processing packets of that length for
+    the same stations (all of them, or consecutive ones) into an out array
+    does not allocate memory. The kurtosis sums are kept for each set of
+    stations processed together : changing the set rebuilds them from the
+    last samples of its stations.
+    """
 
-    return xout
+    def __init__(self, conv_signal, kwin, dt, boxcar_width=50, nsta=None):
+        """
+        :param conv_signal: signal with which to perform convolution
+        :param kwin: kurtosis window in seconds, or list of windows for the
+            maximum over a bank of windows (as sw_kurtosis_bank)
+        :param dt: sampling interval in seconds
+        :param boxcar_width: width of the boxcar, in samples
+        :param nsta: number of stations, or None for a single station
+            processing 1D packets
+        """
+        self.kernel=np.real(conv_signal).astype(np.float64)
+        self.dt=dt
+        self.kwin=kwin
+        if np.isscalar(kwin):
+            self.npts_kurt=[int(np.round(kwin/float(dt)))]
+        else:
+            self.npts_kurt=[int(np.round(win/float(dt))) for win in kwin]
+        self.boxcar_width=boxcar_width
+        self.nsta=1 if nsta is None else nsta
+        # the samples preceding the packet, for each stage
+        self._conv_hist=np.zeros((self.nsta, len(self.kernel)-1), \
+                dtype=np.float32)
+        # window sums of the kurtosis (see _WindowSums), for each set of
+        # stations processed together, the set holding the last samples of
+        # each station and the shift of each station
+        self._kurt_sums={}
+        self._kurt_owner=[None]*self.nsta
+        self._kurt_shift=np.zeros(self.nsta)
+        self._box_hist=np.zeros((self.nsta, boxcar_width), dtype=np.float32)
+        self._diff_last=np.zeros(self.nsta, dtype=np.float32)
+        self._initialized=np.zeros(self.nsta, dtype=bool)
+        self._all_initialized=False
+        # work arrays of the stages (see _work_array), and spectra of the
+        # kernel by FFT length (see _kernel_fft)
+        self._work={}
+        self._spectra={}
+
+    def _with_history(self, hist, data, name):
+        """
+        Returns the history of a stage followed by its new input, in the
+        work array name, and updates the history with the last samples.
+        """
+        m, nh = hist.shape
+        n=data.shape[1]
+        x=_work_array(self._work, name, (m, nh+n), np.float32)
+        x[:, 0:nh]=hist
+        x[:, nh:]=data
+        hist[:]=x[:, n:n+nh]
+        return x
+
+    def _window_sums(self, index, stage):
+        """
+        Returns the kurtosis window sums (see _WindowSums) of the stations of
+        index, whose next samples are stage. They are kept from one packet to
+        the next for the same set of stations. Otherwise they are rebuilt
+        from the last samples of each station, or for new stations from the
+        mirrored start of the data (repeating the last sample if the packet
+        is shorter), shifted by its mean.
+        """
+        if isinstance(index, slice):
+            key=tuple(xrange(index.start, index.stop))
+        else:
+            key=tuple(index.tolist())
+        window_sums=self._kurt_sums.get(key)
+        if window_sums is not None:
+            for ista in key:
+                if self._kurt_owner[ista][0] is not window_sums:
+                    window_sums=None
+                    break
+        if window_sums is not None:
+            return window_sums
+
+        m, n = stage.shape
+        N=max(self.npts_kurt)
+        hist=np.empty((m, N-1))
+        mirror=np.minimum(np.arange(N-2, -1, -1), n-1)
+        owner_hist={}
+        for i in xrange(m):
+            ista=key[i]
+            if self._kurt_owner[ista] is None:
+                hist[i]=stage[i, mirror]
+                self._kurt_shift[ista]=(np.sum(hist[i])+\
+                        np.sum(stage[i], dtype=np.float64))/(N-1+n)
+            else:
+                owner, j = self._kurt_owner[ista]
+                if id(owner) not in owner_hist:
+                    owner_hist[id(owner)]=owner.history(N-1)
+                hist[i]=owner_hist[id(owner)][j]
+        window_sums=_WindowSums(N, (m,), self._kurt_shift[index], n)
+        window_sums.append(hist)
+        for i in xrange(m):
+            self._kurt_owner[key[i]]=(window_sums, i)
+        # forget the sets that no longer hold any station
+        self._kurt_sums[key]=window_sums
+        for k in self._kurt_sums.keys():
+            held=[ista for ista in k \
+                    if self._kurt_owner[ista][0] is self._kurt_sums[k]]
+            if len(held)==0:
+                del self._kurt_sums[k]
+        return window_sums
+
+    def process(self, data, stations=None, out=None):
+        """
+        Returns the characteristic function of a packet of samples, which
+        must follow the previous packet of each station without gap.
+
+        :param data: (n) samples of a single station, or (m, n) block of
+            synchronous samples of m stations (any numeric type)
+        :param stations: indexes of the m stations of the block (all the
+            stations by default)
+        :param out: optional float32 array of the shape of data for the
+            output
+        :rtype: Numpy :class:`numpy.ndarray`
+        :return: float32 characteristic function, of the shape of data
+        """
+        data=np.asarray(data)
+        if out is None:
+            out=np.empty(data.shape, dtype=np.float32)
+        block=np.atleast_2d(data)
+        out2d=out.reshape(block.shape)
+        m, n = block.shape
+        if n==0:
+            return out
+        index=_station_index(stations, m, self.nsta)
+        in_place=isinstance(index, slice)
+        work=self._work
+        stage=_work_array(work, 'stage', (m, n), np.float32)
+        # the realtime processes work on float32 data
+        stage[:]=block
+        new=None
+        if not self._all_initialized:
+            new=np.logical_not(self._initialized[index])
+            if not np.any(new):
+                new=None
+
+        # convolution
+        hist=self._conv_hist[index]
+        x=self._with_history(hist, stage, 'history')
+        if not in_place:
+            self._conv_hist[index]=hist
+        x64=_work_array(work, 'history64', x.shape)
+        x64[:]=x
+        stage[:]=_convolve_valid(x64, self.kernel, work, self._spectra)
+
+        # sliding-window kurtosis
+        window_sums=self._window_sums(index, stage)
+        stage[:]=_kurtosis_bank(window_sums, stage, self.npts_kurt, work)
+
+        # causal boxcar over width+1 samples, zeros before the data
+        w=self.boxcar_width
+        x64=_work_array(work, 'history64', (m, n+w+1))
+        x64[:, 0]=0.0
+        x64[:, 1:w+1]=self._box_hist[index]
+        x64[:, w+1:]=stage
+        self._box_hist[index]=x64[:, n+1:n+w+1]
+        np.cumsum(x64, axis=1, out=x64)
+        y64=_work_array(work, 'boxcar', (m, n))
+        np.subtract(x64[:, w+1:], x64[:, 0:n], out=y64)
+        y64/=float(w+1)
+        stage[:]=y64
+
+        # differentiation (the first sample has no previous one)
+        last=self._diff_last[index]
+        if new is not None:
+            last[new]=stage[new, 0]
+        x=_work_array(work, 'history', (m, n+1), np.float32)
+        x[:, 0]=last
+        x[:, 1:]=stage
+        self._diff_last[index]=stage[:, n-1]
+        np.subtract(x[:, 1:], x[:, 0:n], out=stage)
+        y64[:]=stage
+        y64/=self.dt
+        out2d[:]=y64
+        if new is not None:
+            self._initialized[index]=True
+            self._all_initialized=bool(np.all(self._initialized))
+
+        # negative values to zero
+        np.maximum(out, np.float32(0), out=out)
+        return out
+
+
+class Decimator(object):
+    """
+    Anti-aliased decimation by an integer factor of the packets of one or
+    several synchronous stations, with the state (the samples preceding the
+    packet) carried between packets.
+
+    The data are low-pass filtered by a linear phase FIR filter whose delay
+    is removed from the output times, and only the output samples falling on
+    multiples of factor*dt (in absolute time) are computed, so that the
+    decimated samples of all the stations are aligned.
+    """
 
+    def __init__(self, factor, dt, nsta=None, ntaps=None):
+        """
+        :param factor: decimation factor
+        :param dt: sampling interval of the input data, in seconds
+        :param nsta: number of stations, or None for a single station
+            processing 1D packets
+        :param ntaps: (odd) length of the anti-alias filter, 8*factor+1 by
+            default
+        """
+        from scipy.signal import firwin
+        self.factor=int(factor)
+        self.dt=dt
+        self.nsta=1 if nsta is None else nsta
+        if ntaps is None:
+            ntaps=8*self.factor+1
+        # cut-off at 80% of the decimated Nyquist frequency
+        self.taps=firwin(ntaps, 0.8/self.factor)
+        self.delay=(ntaps-1)/2
+        self._rtaps=np.ascontiguousarray(self.taps[::-1])
+        self._hist=np.zeros((self.nsta, ntaps-1))
+        # work arrays (see _work_array)
+        self._work={}
+
+    def process(self, data, starttime, stations=None, out=None):
+        """
+        Decimates a packet of samples, which must follow the previous packet
+        of each station without gap. Once a packet length has been seen,
+        decimating packets of that length for all the stations (or
+        consecutive ones) into an out array does not allocate memory.
+
+        :param data: (n) samples of a single station, or (m, n) block of
+            synchronous samples of m stations
+        :param starttime: :class:`~obspy.core.utcdatetime.UTCDateTime` of the
+            first sample of the packet
+        :param stations: indexes of the m stations of the block (all the
+            stations by default)
+        :param out: optional float32 array of the shape of data ; the
+            decimated data are then written at its start
+        :rtype: tuple
+        :return: (decimated float32 data, time of its first sample)
+        """
+        data=np.asarray(data)
+        block=np.atleast_2d(data)
+        m, n = block.shape
+        index=_station_index(stations, m, self.nsta)
+        nh=self._hist.shape[1]
+        x=_work_array(self._work, 'history', (m, nh+n))
+        x[:, 0:nh]=self._hist[index]
+        x[:, nh:]=block
+        self._hist[index]=x[:, n:n+nh]
+        # absolute sample number of the first input sample, and first sample
+        # whose delayed time falls on the decimated grid
+        i0=int(np.round(starttime.timestamp/self.dt))
+        k0=(self.delay-i0) % self.factor
+        nout=max(0, (n-k0+self.factor-1)//self.factor)
+        # filter only at the output samples : windows of the input ending at
+        # each of them
+        s0, s1 = x.strides
+        windows=as_strided(x[:, k0:], shape=(m, nout, nh+1), \
+                strides=(s0, self.factor*s1, s1))
+        y=_work_array(self._work, 'output', (m, nout))
+        np.dot(windows, self._rtaps, out=y)
+        if out is None:
+            out=np.empty((m, nout), dtype=np.float32)
+        else:
+            out=out.reshape(block.shape)[:, 0:nout]
+        out[:]=y
+        t0=starttime+(k0-self.delay)*self.dt
+        if data.ndim==1:
+            out=out[0]
+        return out, t0
@@ -1,4 +1,7 @@
+import os, hashlib
+import h5py
 import numpy as np
+from ast import literal_eval
 from numpy import pi, sqrt, exp
 
 def gaussian_filter(sigma_f, f0, dt):
@@ -34,3 +37,115 @@ def gaussian_filter(sigma_f, f0, dt):
 
 
     return gauss, tshift
+
+def gaussian_filter_bank(bands, dt):
+    """
+    Calculates the time-domain impulse responses of a bank of gaussian
+    filters (see gaussian_filter), zero-padded to a common length so that
+    they all have the same time-shift.
+
+    :type bands: list of tuples
+    :param bands: (sigma_f, f0) of each filter, in Hz
+    :type dt: float
+    :param dt: sampling interval in seconds for the output impulse responses
+    :rtype kernels: Numpy :class:`numpy.ndarray`
+    :return kernels: (nbands, npts) array of the impulse responses
+    :rtype tshift: float
+    :return tshift: The time-shift corresponding to all the filters
+    """
+    gauss_list=[gaussian_filter(sigma_f, f0, dt)[0] for sigma_f, f0 in bands]
+    npts=max([len(gauss) for gauss in gauss_list])
+    kernels=np.zeros((len(gauss_list), npts), dtype=complex)
+    for i in xrange(len(gauss_list)):
+        # the filters have an odd number of points : centre them
+        pad=(npts-len(gauss_list[i]))/2
+        kernels[i, pad:pad+len(gauss_list[i])]=gauss_list[i]
+    tshift=((npts-1)/2) * dt
+    return kernels, tshift
+
+
+class FilterCache(object):
+    """
+    Memoized filter designs : time-domain kernels (and their time-shift) by
+    design parameters, and real FFT spectra of kernels by (kernel, fft
+    length). The designs can be written to and read from an hdf5 file, so
+    that all the processes of a deployment compute them only once.
+    """
+
+    def __init__(self):
+        # (design, parameters..., npts) -> (kernel, tshift)
+        self.kernels={}
+        # (md5 of kernel, nfft) -> spectrum
+        self.spectra={}
+        self.modified=False
+
+    def gaussian_filter(self, sigma_f, f0, dt):
+        """
+        Returns gaussian_filter(sigma_f, f0, dt), computed once. The kernel
+        is read-only.
+        """
+        npts=int(1 / (2*pi*sigma_f) / dt)*8 + 1
+        key=('gaussian', float(sigma_f), float(f0), float(dt), npts)
+        if not self.kernels.has_key(key):
+            kernel, tshift = gaussian_filter(sigma_f, f0, dt)
+            kernel.flags.writeable=False
+            self.kernels[key]=(kernel, tshift)
+            self.modified=True
+        return self.kernels[key]
+
+    def spectrum(self, kernel, nfft):
+        """
+        Returns the (read-only) real FFT of a real kernel zero-padded to nfft
+        points, computed once.
+        """
+        kernel=np.ascontiguousarray(kernel)
+        key=(hashlib.md5(kernel.tostring()).hexdigest(), int(nfft))
+        if not self.spectra.has_key(key):
+            spec=np.fft.rfft(kernel, nfft)
+            spec.flags.writeable=False
+            self.spectra[key]=spec
+            self.modified=True
+        return self.spectra[key]
+
+    def save(self, filename):
+        """
+        Writes the cached designs to an hdf5 file. The file is written under
+        a temporary name then renamed, so other processes never read a
+        partial file.
+        """
+        tmp_name='%s.%d.tmp'%(filename, os.getpid())
+        f=h5py.File(tmp_name,'w')
+        i=0
+        for key, (kernel, tshift) in self.kernels.iteritems():
+            dset=f.create_dataset('kernel_%d'%i, data=kernel)
+            dset.attrs['key']=repr(key)
+            dset.attrs['tshift']=tshift
+            i+=1
+        i=0
+        for (md5, nfft), spec in self.spectra.iteritems():
+            dset=f.create_dataset('spectrum_%d'%i, data=spec)
+            dset.attrs['kernel_md5']=md5
+            dset.attrs['nfft']=nfft
+            i+=1
+        f.close()
+        os.rename(tmp_name, filename)
+        self.modified=False
+
+    def load(self, filename):
+        """
+        Adds the designs of an hdf5 file written by save to the cache.
+        """
+        f=h5py.File(filename,'r')
+        for name, dset in f.iteritems():
+            data=dset[:]
+            data.flags.writeable=False
+            if name.startswith('kernel_'):
+                key=literal_eval(str(dset.attrs['key']))
+                self.kernels[key]=(data, float(dset.attrs['tshift']))
+            elif name.startswith('spectrum_'):
+                key=(str(dset.attrs['kernel_md5']), int(dset.attrs['nfft']))
+                self.spectra[key]=data
+        f.close()
+
+# cache shared by the module users (and inherited by forked workers)
+filter_cache=FilterCache()
@@ -1,8 +1,75 @@
 import h5py,os,logging, tempfile
 import numpy as np
 from time import time
+from collections import OrderedDict
 from scipy import ndimage
 from NllGridLib import read_hdr_file
+from ttimes_cache import TtimesCache, set_file_key
+
+# order of the spline interpolation of the grids
+SPLINE_ORDER=3
+
+
+class SplineCache(object):
+    """
+    Least recently used cache of the cubic spline coefficients of grids
+    (see ndimage.spline_filter), with a memory budget. The coefficients are
+    keyed by grid file, so that all the H5SingleGrid objects reading the
+    same file share them.
+    """
+
+    def __init__(self, max_bytes=512*1024*1024):
+        """
+        :param max_bytes: memory budget of the cache, in bytes
+        """
+        self.max_bytes=max_bytes
+        self.nbytes=0
+        self._coeffs=OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the coefficients cached under key (marking them as the most
+        recently used), or None.
+        """
+        coeffs=self._coeffs.pop(key, None)
+        if coeffs is not None:
+            self._coeffs[key]=coeffs
+        return coeffs
+
+    def put(self, key, coeffs):
+        """
+        Caches coefficients under key, evicting the least recently used ones
+        to stay within the memory budget. Coefficients larger than the
+        budget are not cached.
+        """
+        self.remove(key)
+        if coeffs.nbytes > self.max_bytes:
+            return
+        while self.nbytes + coeffs.nbytes > self.max_bytes:
+            old_key, old_coeffs = self._coeffs.popitem(last=False)
+            self.nbytes-=old_coeffs.nbytes
+        self._coeffs[key]=coeffs
+        self.nbytes+=coeffs.nbytes
+
+    def remove(self, key):
+        coeffs=self._coeffs.pop(key, None)
+        if coeffs is not None:
+            self.nbytes-=coeffs.nbytes
+
+    def invalidate(self, filename):
+        """
+        Removes the coefficients of all the grids read from filename.
+        """
+        filename=os.path.abspath(filename)
+        for key in [key for key in self._coeffs if key[0]==filename]:
+            self.remove(key)
+
+    def clear(self):
+        self._coeffs.clear()
+        self.nbytes=0
+
+spline_cache=SplineCache()
+
 
 class H5SingleGrid(object):
     """
@@ -36,21 +103,29 @@ class H5SingleGrid(object):
         :param grid_info: Attributes to be used for the 'grid_data' dataset.
         """
 
+        self._geometry=None
         if os.path.isfile(filename):
             self._f=h5py.File(filename,'r')
             self.grid_data=self._f['grid_data']
             self.grid_info=self.grid_data.attrs
+            # the spline coefficients are shared by the grids reading the
+            # same version of the file
+            st=os.stat(filename)
+            self._cache_key=(os.path.abspath(filename), st.st_mtime, \
+                    st.st_size)
 
         else:
             self._f=h5py.File(filename,'w')
+            spline_cache.invalidate(filename)
+            self._cache_key=(os.path.abspath(filename), 'w', id(self))
 
-            if not grid_data==None:
+            if grid_data is not None:
                 self.grid_data=self._f.create_dataset('grid_data',data=grid_data,\
 		        compression='lzf')
             else : 
                 self.grid_data=None
 
-            if not grid_info==None:
+            if grid_info is not None:
                 self.grid_info=self.grid_data.attrs
                 for key,value in grid_info.iteritems():
                     self.grid_info[key]=value
@@ -61,41 +136,65 @@ class H5SingleGrid(object):
     def __del__(self):
         self._f.close()
 
+    def spline_coefficients(self):
+        """
+        Returns the cubic spline coefficients of the grid, read and computed
+        on first use and then kept in spline_cache.
+        """
+        coeffs=spline_cache.get(self._cache_key)
+        if coeffs is None:
+            grid_data = np.empty(self.grid_data.shape, dtype=float)
+            grid_data[:] = self.grid_data[:]
+            grid_data = grid_data.reshape(self.grid_info['nx'],\
+                    self.grid_info['ny'], self.grid_info['nz'])
+            coeffs = ndimage.spline_filter(grid_data, order=SPLINE_ORDER)
+            spline_cache.put(self._cache_key, coeffs)
+        return coeffs
+
     def value_at_point(self,x,y,z):
         """
         Performs 3D interpolation for a single point
         """
-        x_array=np.array([x,x])
-        y_array=np.array([y,y])
-        z_array=np.array([z,z])
-
-        result = self.value_at_points(x_array, y_array, z_array)
+        result = self.value_at_points(np.array([x]), np.array([y]), \
+                np.array([z]))
         return result[0]
 
     def value_at_points(self,x,y,z):
         """
         Performs 3D interpolation on the regular grid.
 
-        Uses scipy.ndimage. Works on numpy arrays of points
+        Uses scipy.ndimage on the cached spline coefficients of the grid.
+        Works on numpy arrays of points
 
         """
-        grid_data = np.empty(self.grid_data.shape, dtype=float)
-        grid_data[:] = self.grid_data[:]
-        grid_data = grid_data.reshape(self.grid_info['nx'],\
-                self.grid_info['ny'], self.grid_info['nz'])
-
-        ix = (x - self.grid_info['x_orig']) / self.grid_info['dx']
-        iy = (y - self.grid_info['y_orig']) / self.grid_info['dy']
-        iz = (z - self.grid_info['z_orig']) / self.grid_info['dz']
+        if self._geometry is None:
+            # the hdf5 attributes are slow to read
+            self._geometry=[(self.grid_info[orig], self.grid_info[step]) for \
+                    orig, step in (('x_orig','dx'), ('y_orig','dy'), \
+                    ('z_orig','dz'))]
+        (x_orig, dx), (y_orig, dy), (z_orig, dz) = self._geometry
+        ix = (x - x_orig) / dx
+        iy = (y - y_orig) / dy
+        iz = (z - z_orig) / dz
 
         coords = np.array([ix,iy,iz])
 
-        result = ndimage.map_coordinates(grid_data, coords, order=3, \
-                mode='nearest')
+        result = ndimage.map_coordinates(self.spline_coefficients(), coords, \
+                order=SPLINE_ORDER, mode='nearest', prefilter=False)
 
         return result
 
-    def interp_to_newgrid(self,new_filename,new_grid_info):
+    def interp_to_newgrid(self,new_filename,new_grid_info,\
+            max_chunk_points=1048576):
+        """
+        Interpolates the grid onto the nodes of a new regular grid, written
+        to new_filename, and returns it as a new H5SingleGrid.
+
+        The nodes are interpolated and written by slabs of consecutive x
+        indexes (contiguous in the flattened grid) of at most about
+        max_chunk_points nodes, so the memory used does not depend on the
+        size of the new grid.
+        """
 
         nx=new_grid_info['nx']
         ny=new_grid_info['ny']
@@ -111,25 +210,23 @@ class H5SingleGrid(object):
     
         # if you're calling this function, you want any existing file overwritten
         f=h5py.File(new_filename,'w')
+        spline_cache.invalidate(new_filename)
         buf=f.create_dataset('grid_data',(nx*ny*nz,),'f')
         for key,value in new_grid_info.iteritems():
             buf.attrs[key]=value
 
-        #set coordinates for interpolation
-        npts=nx*ny*nz
-        new_shape=(nx,ny,nz)
-        x = np.empty(npts,dtype=float)
-        y = np.empty(npts,dtype=float)
-        z = np.empty(npts,dtype=float)
-
-        for i in xrange(npts):
-            ix,iy,iz = np.unravel_index(i,(new_shape))
-            x[i]=x_orig+ix*dx
-            y[i]=y_orig+iy*dy
-            z[i]=z_orig+iz*dz
+        # coordinates of the nodes along each axis, broadcast over the slabs
+        y = (y_orig+np.arange(ny)*dy).reshape(1,ny,1)
+        z = (z_orig+np.arange(nz)*dz).reshape(1,1,nz)
+        plane=ny*nz
+        slab=max(1, max_chunk_points//plane)
 
         # do interpolation
-        buf[:] = self.value_at_points(x,y,z)
+        for ix0 in xrange(0,nx,slab):
+            ix1=min(nx,ix0+slab)
+            x = (x_orig+np.arange(ix0,ix1)*dx).reshape(ix1-ix0,1,1)
+            values = self.value_at_points(*np.broadcast_arrays(x,y,z))
+            buf[ix0*plane:ix1*plane] = values.ravel()
 
         # close the old grid file
         f.close()
@@ -171,10 +268,12 @@ def nll2hdf5(nll_name,h5_name):
     h5=H5NllSingleGrid(h5_name,nll_name)
     del h5
 
-def interpolateTimeGrid(tgrid_file, out_file, x, y, z):
+def interpolateTimeGrid(tgrid_file, out_file, x, y, z, cache=None):
     """
     Interpolates a time_grid.hdf5 file to another file containing only the
-    travel-times for the points in x, y, z.
+    travel-times for the points in x, y, z. If a TtimesCache is given, the
+    travel-times are only computed if neither out_file nor the cache already
+    hold them.
     """
 
     # sanity check for length of coordinate arrays
@@ -184,24 +283,111 @@ def interpolateTimeGrid(tgrid_file, out_file, x, y, z):
 
     npts=len(x)
 
+    if cache is not None:
+        key=cache.ttimes_key(tgrid_file, x, y, z, SPLINE_ORDER)
+        if cache.fetch(key, out_file):
+            return
+
     # read the file to be interpolated
     time_grid = H5SingleGrid(tgrid_file)
 
     # do the interpolation
     ttimes = time_grid.value_at_points(x,y,z)
 
-    # create the file for output
-    f = h5py.File(out_file,'w')
+    # create the file for output, under a temporary name so that readers
+    # never see a partial file
+    tmp_name='%s.%d.tmp'%(out_file, os.getpid())
+    f = h5py.File(tmp_name,'w')
     f.create_dataset('x', data=x)
     f.create_dataset('y', data=y)
     f.create_dataset('z', data=z)
     buf = f.create_dataset('ttimes', data = ttimes)
     buf.attrs['station'] = time_grid.grid_info['station']
+    # keep the station coordinates if the grid has them
+    for name in ['sta_x', 'sta_y', 'sta_z']:
+        if name in time_grid.grid_info:
+            buf.attrs[name] = time_grid.grid_info[name]
+    if cache is not None:
+        f.attrs['cache_key'] = key
     f.close()
+    os.rename(tmp_name, out_file)
+    if cache is not None:
+        cache.store(key, out_file)
 
 
-def get_interpolated_time_grids(opdict):
+def load_time_grids(grid_glob, sta_list):
+    """
+    Opens the time grids matching grid_glob and returns them as a list of
+    H5SingleGrid objects in the order of the stations in sta_list.
+    """
     import glob
+
+    grids={}
+    for fname in glob.glob(grid_glob):
+        grid=H5SingleGrid(fname)
+        grids[grid.grid_info['station']]=grid
+    return [grids[sta] for sta in sta_list]
+
+def ttimes_at_points(time_grids, x, y, z):
+    """
+    Returns the (nsta, npts) travel-times interpolated from each of the
+    time_grids to the points x, y, z.
+    """
+    return np.vstack([grid.value_at_points(x,y,z) for grid in time_grids])
+
+def _interpolate_time_grid(task):
+    """
+    Interpolates the full-length time grid f_timegrid onto the search grid
+    described by search_info, and writes it to tgrid_filename with its
+    TtimesCache key. The grid is written under a temporary name then
+    renamed, so an interrupted run never leaves a partial grid behind.
+    Returns tgrid_filename.
+
+    Runs in the worker processes of get_interpolated_time_grids, so it takes
+    a single (f_timegrid, tgrid_filename, search_info, key) tuple.
+    """
+    f_timegrid, tgrid_filename, search_info, key = task
+
+    full_grid=H5SingleGrid(f_timegrid)
+    # copy the common part of the grid info
+    new_info={}
+    for name,value in full_grid.grid_info.iteritems():
+        new_info[name]=value
+    # set the new part of the grid info to correspond to the search grid
+    for name in ['x_orig','y_orig','z_orig','nx','ny','nz','dx','dy','dz']:
+        new_info[name]=search_info[name]
+
+    # do interpolation
+    tmp_name='%s.%d.tmp'%(tgrid_filename, os.getpid())
+    try:
+        grid=full_grid.interp_to_newgrid(tmp_name,new_info)
+        # close the grids safely, and free the spline coefficients of the
+        # full grid, which are no longer needed
+        del grid
+        del full_grid
+        spline_cache.invalidate(f_timegrid)
+        set_file_key(tmp_name, key)
+        os.rename(tmp_name, tgrid_filename)
+    except:
+        # do not leave the partial grid behind
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    return tgrid_filename
+
+def get_interpolated_time_grids(opdict, n_workers=None):
+    """
+    Returns a dictionary of the time grids of the stations interpolated onto
+    the search grid, keyed by station. The interpolated grids are in the
+    out/outdir/time_grids directory. If opdict['load_ttimes_buf'] is True,
+    the grids that are already there for the same time grid, search grid
+    and interpolation, or in the out/ttimes_cache directory (see
+    TtimesCache), are used as they are. The others are created by a pool of
+    n_workers processes (one per cpu by default), each preparing one station
+    at a time. If the creation of a grid fails, the workers are stopped and
+    the error is raised.
+    """
+    import glob, multiprocessing
     from NllGridLib import read_hdr_file
 
     base_path=opdict['base_path']
@@ -215,48 +401,58 @@ def get_interpolated_time_grids(opdict):
     if not os.path.exists(tgrid_dir) : 
         os.makedirs(tgrid_dir)
     search_info=read_hdr_file(search_grid)
+    cache=TtimesCache(os.path.join(base_path,'out','ttimes_cache'))
   
-    time_grids={}
-
-    # for each of the full-length time grids
-    logging.info('Loading time grids ... ')
+    # get the filenames of the corresponding short-length grids (the ones for
+    # the search grid in particular), and the ones that must be created
+    tgrid_filenames=[]
+    tasks=[]
+    keys={}
     for f_timegrid in full_time_grids:
         f_basename=os.path.basename(f_timegrid)
-        # get the filename of the corresponding short-length grid (the one for the search grid in particular)
         tgrid_filename=os.path.join(tgrid_dir,f_basename)
-
-        # if file exists and we want to load it, then open the file and give it to the dictionary
-        if os.path.isfile(tgrid_filename) and opdict['load_ttimes_buf']:    
-            logging.debug('Loading %s'%tgrid_filename)
-            grid=H5SingleGrid(tgrid_filename)
-            name=grid.grid_info['station']
-            time_grids[name]=grid
-
-        # if the file does not exist, or want to force re-creation, then create it 
-        if not os.path.isfile(tgrid_filename) or not opdict['load_ttimes_buf']:    
-            logging.info('Creating %s - Please be patient'%tgrid_filename)
-            full_grid=H5SingleGrid(f_timegrid)
-            # copy the common part of the grid info
-            new_info={}
-            for name,value in full_grid.grid_info.iteritems():
-                new_info[name]=value
-            # set the new part of the grid info to correspond to the search grid
-            new_info['x_orig']=search_info['x_orig']
-            new_info['y_orig']=search_info['y_orig']
-            new_info['z_orig']=search_info['z_orig']
-            new_info['nx']=search_info['nx']
-            new_info['ny']=search_info['ny']
-            new_info['nz']=search_info['nz']
-            new_info['dx']=search_info['dx']
-            new_info['dy']=search_info['dy']
-            new_info['dz']=search_info['dz']
-            # do interpolation
-            grid=full_grid.interp_to_newgrid(tgrid_filename,new_info)
-            # add to dictionary
-            name=grid.grid_info['station']
-            time_grids[name]=grid
-            # close full grid safely
-            del full_grid
+        tgrid_filenames.append(tgrid_filename)
+        key=cache.grid_key(f_timegrid, search_info, SPLINE_ORDER)
+        keys[tgrid_filename]=key
+        # if the grid is not available, or want to force re-creation, then create it 
+        if not opdict['load_ttimes_buf'] or not cache.fetch(key, tgrid_filename):
+            tasks.append((f_timegrid, tgrid_filename, search_info, key))
+
+    if len(tasks) > 0:
+        if n_workers is None:
+            n_workers=multiprocessing.cpu_count()
+        n_workers=min(n_workers, len(tasks))
+        logging.info('Creating %d time grids with %d processes - Please be patient'%(len(tasks), n_workers))
+        if n_workers > 1:
+            pool=multiprocessing.Pool(n_workers)
+            created=pool.imap_unordered(_interpolate_time_grid, tasks)
+        else:
+            pool=None
+            created=(_interpolate_time_grid(task) for task in tasks)
+        try:
+            for i, tgrid_filename in enumerate(created):
+                logging.info('Created %s (%d/%d)'%(tgrid_filename, i+1, \
+                        len(tasks)))
+                cache.store(keys[tgrid_filename], tgrid_filename)
+        except:
+            # stop the other workers rather than waiting for their grids
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    cache.log_stats('Time grid')
+
+    # open the files and give them to the dictionary
+    time_grids={}
+    logging.info('Loading time grids ... ')
+    for tgrid_filename in tgrid_filenames:
+        logging.debug('Loading %s'%tgrid_filename)
+        grid=H5SingleGrid(tgrid_filename)
+        name=grid.grid_info['station']
+        time_grids[name]=grid
 
     return time_grids
 
@@ -0,0 +1,124 @@
+import numpy as np
+from migration import RtMigrator
+from hdf5_grids import load_time_grids, ttimes_at_points
+
+class HierarchicalMigrator(RtMigrator):
+    """
+    Real-time migrator working on several resolutions. The points given by
+    the ttimes files (typically a coarse regular grid, see
+    synthetics.generate_regular_grid_points) are migrated continuously. When
+    the maximum of the coarse stacks exceeds a threshold, the neighbourhood
+    of the coarse maximum is re-migrated on progressively finer grids, using
+    the characteristic functions held in the CF buffer and travel-times
+    interpolated from the full time grids.
+
+    Options read from waveloc_options.opdict :
+
+        * refine_threshold : stack value above which refinement is done
+        * coarse_spacing : spacing of the coarse grid in km
+        * refine_levels : number of refinement levels (default 3), each one
+          halving the spacing
+        * refine_win : half-width in seconds of the origin-time window
+          searched around the coarse maximum (default 1.0)
+
+    Refined locations are appended to the locations attribute as tuples
+    (origin time, x, y, z, stack value).
+    """
+
+    def __init__(self, waveloc_options):
+        wo=waveloc_options
+        for name in ['refine_threshold', 'coarse_spacing']:
+            if not wo.opdict.has_key(name):
+                msg='%s option not set (needed for hierarchical migration)'%name
+                raise ValueError(msg)
+        RtMigrator.__init__(self, wo)
+
+        self.threshold = float(wo.opdict['refine_threshold'])
+        self.coarse_spacing = float(wo.opdict['coarse_spacing'])
+        if wo.opdict.has_key('refine_levels'):
+            self.n_levels = int(wo.opdict['refine_levels'])
+        else:
+            self.n_levels = 3
+        if wo.opdict.has_key('refine_win'):
+            self.refine_win = float(wo.opdict['refine_win'])
+        else:
+            self.refine_win = 1.0
+
+        # full time grids, in the order of sta_list
+        self.time_grids=load_time_grids(wo.grid_glob, self.sta_list)
+
+        self.locations=[]
+        # (start, end) absolute samples of the current triggered segment and
+        # index of its location in self.locations
+        self._trigger_end=None
+        self._trigger_iloc=None
+
+    def updateMax(self):
+        """
+        Appends the coarse maximum to the output streams, then refines the
+        location of any new coarse maximum above the threshold.
+        """
+        new_max=list(self.new_max)
+        RtMigrator.updateMax(self)
+        for common_start, max_data, argmax_data in new_max:
+            self._check_trigger(common_start, max_data, argmax_data)
+
+    def _check_trigger(self, common_start, max_data, argmax_data):
+        above=max_data > self.threshold
+        if not np.any(above):
+            self._trigger_end=None
+            return
+        # find the contiguous segments above threshold
+        edges=np.diff(np.concatenate(([0], above.astype(int), [0])))
+        seg_starts=np.flatnonzero(edges==1)
+        seg_ends=np.flatnonzero(edges==-1)
+        for i0, i1 in zip(seg_starts, seg_ends):
+            ipeak=i0+np.argmax(max_data[i0:i1])
+            # a segment continuing the one at the end of the previous block
+            # is the same event : only keep its highest peak
+            continuing = (i0==0 and self._trigger_end==common_start)
+            if continuing and \
+                    self.locations[self._trigger_iloc][4] >= max_data[ipeak]:
+                pass
+            else:
+                ip=argmax_data[ipeak]
+                loc=self.refine(common_start+ipeak, self.x[ip], self.y[ip], \
+                        self.z[ip], max_data[ipeak])
+                if continuing:
+                    self.locations[self._trigger_iloc]=loc
+                else:
+                    self.locations.append(loc)
+                    self._trigger_iloc=len(self.locations)-1
+        if above[-1]:
+            self._trigger_end=common_start+len(max_data)
+        else:
+            self._trigger_end=None
+
+    def refine(self, isamp, x0, y0, z0, value):
+        """
+        Re-migrates on progressively finer grids around point x0, y0, z0 and
+        absolute sample isamp, where the coarse stack is equal to value.
+        Returns (origin time, x, y, z, stack value).
+        """
+        hw=int(np.round(self.refine_win/self.dt))
+        spacing=self.coarse_spacing
+        x, y, z = x0, y0, z0
+        steps=np.arange(-2, 3)
+        for level in xrange(self.n_levels):
+            spacing=spacing/2.0
+            # 5x5x5 points spanning +/- the previous spacing
+            xx, yy, zz = np.meshgrid(x+steps*spacing, y+steps*spacing, \
+                    z+steps*spacing, indexing='ij')
+            xx=xx.flatten()
+            yy=yy.flatten()
+            zz=zz.flatten()
+            ttimes=ttimes_at_points(self.time_grids, xx, yy, zz)
+            result=self.stackAtPoints(ttimes, isamp-hw, isamp+hw+1)
+            if result is None:
+                break
+            stacks, common_start, common_end = result
+            ip, it = np.unravel_index(np.argmax(stacks), stacks.shape)
+            x, y, z = xx[ip], yy[ip], zz[ip]
+            isamp=common_start+it
+            value=stacks[ip, it]
+        return (self.cf_buffer.sample_time(isamp), x, y, z, value)
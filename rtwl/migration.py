@@ -1,8 +1,223 @@
-import h5py, glob, time
+import os, glob, time, ctypes
 import numpy as np
+from multiprocessing.sharedctypes import RawArray
+from numpy.lib.stride_tricks import as_strided
 from obspy.core import Trace, UTCDateTime
 from obspy.realtime import RtTrace
-from am_signal import gaussian_filter
+from am_signal import filter_cache
+from ttimes_store import TtimesStore
+from am_rt_signal import CFProcessor, Decimator, CONVOLVE_FFT_MIN_LENGTH, \
+        convolve_fft_length, _work_array
+
+# maximum number of stack samples (points x time) computed in one go
+STACK_CHUNK_SIZE=2**20
+
+def make_delay_table(ttimes_matrix, dt):
+    """
+    Converts a (nsta, npts) matrix of travel-times into integer sample delays.
+
+    :param ttimes_matrix: (nsta, npts) array of travel-times in seconds
+    :param dt: sampling interval in seconds
+    :rtype: tuple
+    :return: (delay_origin, delay_table, moveout_span) where delay_origin
+        (npts, int32) is the minimum delay over the stations for each point,
+        delay_table (nsta, npts) holds the delays relative to delay_origin
+        (int16 if they fit, int32 otherwise) and moveout_span (npts) is the
+        maximum relative delay for each point.
+    """
+    delays=np.round(np.asarray(ttimes_matrix)/dt).astype(np.int32)
+    delay_origin=np.min(delays, axis=0)
+    delays-=delay_origin
+    moveout_span=np.max(delays, axis=0)
+    if moveout_span.size==0 or np.max(moveout_span) <= np.iinfo(np.int16).max:
+        delay_table=delays.astype(np.int16)
+    else:
+        delay_table=delays
+    return delay_origin, delay_table, moveout_span.astype(delay_table.dtype)
+
+def stack_points(segments, offsets, nsamp, out, scratch=None, active=None, \
+        weights=None):
+    """
+    Delay-and-sum kernel. Stacks nsamp samples for a block of points in one
+    batched gather-and-sum per station.
+
+    :param segments: list of contiguous 1D arrays, one per station
+    :param offsets: (nsta, np) integer array ; offsets[ista, ip] is the index
+        in segments[ista] of the first sample to stack for point ip. If
+        active is given, offsets[ista] only holds the offsets of the points
+        in active[ista].
+    :param nsamp: number of samples to stack
+    :param out: (np, nsamp) array into which the stacks are written
+    :param scratch: optional (np, nsamp) array used for the gathered samples
+    :param active: optional list (one per station) of the indexes of the
+        points to which each station contributes ; the other station-point
+        pairs are skipped
+    :param weights: optional array (one per station) of the weights by
+        which the samples of each station are multiplied
+    """
+    if scratch is None:
+        scratch = np.empty(out.shape, dtype=out.dtype)
+    out.fill(0)
+    for ista in xrange(len(segments)):
+        seg = segments[ista]
+        # view of all windows of length nsamp in the segment (no copy)
+        windows = as_strided(seg, shape=(len(seg)-nsamp+1, nsamp), \
+                strides=(seg.strides[0], seg.strides[0]))
+        if active is None:
+            np.take(windows, offsets[ista], axis=0, out=scratch)
+            if weights is not None:
+                scratch *= weights[ista]
+            out += scratch
+        else:
+            n = len(active[ista])
+            if n == 0:
+                continue
+            np.take(windows, offsets[ista], axis=0, out=scratch[0:n])
+            if weights is not None:
+                scratch[0:n] *= weights[ista]
+            out[active[ista]] += scratch[0:n]
+    return out
+
+def stack_max(segments, offsets, nsamp, max_data, argmax_data, ip_shift=0, \
+        stacks=None, scratch=None, active=None, weights=None):
+    """
+    Stacks a block of points with stack_points and folds the result into the
+    running maximum over points (max_data) and the index of the point at
+    which it is reached (argmax_data). Both are updated in place.
+
+    :param ip_shift: index of the first point of the block in the full grid
+    :param stacks: optional (np, nsamp) array used to hold the block stacks
+    :param scratch: optional (np, nsamp) scratch array for stack_points
+    :param active: optional list of active points per station, see
+        stack_points ; stacks must then be given
+    :param weights: optional array of station weights, see stack_points
+    """
+    if stacks is None:
+        if active is not None:
+            msg = 'stacks must be given with active'
+            raise ValueError(msg)
+        stacks = np.empty((offsets.shape[1], nsamp), dtype=max_data.dtype)
+    stack_points(segments, offsets, nsamp, stacks, scratch, active, weights)
+    fold_max(stacks, max_data, argmax_data, ip_shift)
+
+def fold_max(stacks, max_data, argmax_data, ip_shift=0):
+    """
+    Folds the (np, nsamp) stacks of a block of points into the running
+    maximum over points (max_data) and its argmax (argmax_data), both
+    updated in place.
+
+    :param ip_shift: index of the first point of the block in the full grid
+    """
+    block_argmax = np.argmax(stacks, axis=0)
+    block_max = stacks[block_argmax, np.arange(stacks.shape[1])]
+    # strict inequality keeps the first point reaching the maximum
+    better = block_max > max_data
+    max_data[better] = block_max[better]
+    argmax_data[better] = block_argmax[better] + ip_shift
+
+
+def _shared_zeros(shape, dtype):
+    """
+    Returns a numpy array of zeros allocated in shared memory
+    """
+    dtype=np.dtype(dtype)
+    nbytes=int(np.prod(shape))*dtype.itemsize
+    raw=RawArray(ctypes.c_byte, max(nbytes,1))
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+class CFRingBuffer(object):
+    """
+    Fixed-size ring buffer holding the characteristic function of every
+    station, indexed by absolute sample number.
+
+    Absolute sample 0 corresponds to the starttime of the first trace ever
+    appended (t_ref). Each station keeps track of the first and of the next
+    (one past the last) absolute sample it holds.
+    """
+
+    def __init__(self, nsta, length, dt, dtype=np.float32, shared=False):
+        """
+        If shared is True, the samples and the per-station sample counters
+        are allocated in shared memory, so that processes forked after the
+        creation of the buffer see all later updates.
+        """
+        if shared:
+            alloc=_shared_zeros
+        else:
+            alloc=np.zeros
+        self.nsta=nsta
+        self.length=length
+        self.dt=dt
+        self.data=alloc((nsta, length), dtype)
+        self.t_ref=None
+        self.first_sample=alloc(nsta, int)
+        self.next_sample=alloc(nsta, int)
+        self.has_data=alloc(nsta, bool)
+
+    def sample_index(self, t):
+        """
+        Returns the absolute sample number corresponding to time t
+        """
+        return int(np.round((t - self.t_ref) / self.dt))
+
+    def sample_time(self, isamp):
+        """
+        Returns the time corresponding to absolute sample number isamp
+        """
+        return self.t_ref + isamp * self.dt
+
+    def append(self, ista, tr):
+        """
+        Writes the data of trace tr into the buffer row of station ista
+        """
+        self.append_data(ista, tr.data, tr.stats.starttime)
+
+    def append_data(self, ista, data, starttime):
+        """
+        Writes data starting at time starttime into the buffer row of
+        station ista
+        """
+        if self.t_ref is None:
+            self.t_ref = starttime
+        npts = len(data)
+        i0 = self.sample_index(starttime)
+        if not self.has_data[ista]:
+            self.first_sample[ista] = i0
+            self.has_data[ista] = True
+        # only the last length samples can be held
+        if npts > self.length:
+            i0 += npts - self.length
+            data = data[npts - self.length:]
+            npts = self.length
+        self._write(ista, i0, data)
+        self.next_sample[ista] = i0 + npts
+        self.first_sample[ista] = max(self.first_sample[ista],
+                self.next_sample[ista] - self.length)
+
+    def _write(self, ista, i0, data):
+        npts = len(data)
+        j0 = i0 % self.length
+        n1 = min(npts, self.length - j0)
+        self.data[ista, j0:j0+n1] = data[0:n1]
+        self.data[ista, 0:npts-n1] = data[n1:]
+
+    def get(self, ista, i0, i1):
+        """
+        Returns a copy of absolute samples i0 to i1 (excluded) of station
+        ista
+        """
+        if i0 < self.first_sample[ista] or i1 > self.next_sample[ista]:
+            msg = 'Samples %d to %d not held in buffer for station %d'%(i0, i1, ista)
+            raise ValueError(msg)
+        npts = i1 - i0
+        j0 = i0 % self.length
+        n1 = min(npts, self.length - j0)
+        out = np.empty(npts, dtype=self.data.dtype)
+        out[0:n1] = self.data[ista, j0:j0+n1]
+        out[n1:] = self.data[ista, 0:npts-n1]
+        return out
+
 
 class RtMigrator(object):
     """
@@ -13,24 +228,31 @@ class RtMigrator(object):
     x=np.array([])
     y=np.array([])
     z=np.array([])
-    ttimes_matrix=np.empty((0,0), dtype=float)
     npts=0
     nsta=0
     sta_list=[]
+    sta_weights=None
+
+    delay_origin=np.array([], dtype=np.int32)
+    delay_table=np.empty((0,0), dtype=np.int16)
+    moveout_span=np.array([], dtype=np.int16)
 
     obs_rt_list=[]
-    point_rt_list=[]
-    stack_list=[]
+    cf_processor=None
+    cf_buffer=None
 
     max_out=None
     x_out=None
     y_out=None
     z_out=None
 
-    last_common_end_stack=[]
-    last_common_end_max=None
+    last_common_end_stack=None
+    new_max=[]
 
     dt=1.0
+    data_dt=1.0
+    decimation=1
+    decimator=None
     filter_shift=0.0
 
 
@@ -39,62 +261,80 @@ class RtMigrator(object):
         Initialize from a set of travel-times as hdf5 files
         """
         wo=waveloc_options
-        # initialize the travel-times
-        #############################
-        ttimes_fnames=glob.glob(wo.ttimes_glob)
-        # get basic lengths
-        f=h5py.File(ttimes_fnames[0],'r')
-        # copy the x, y, z data over
-        self.x = np.array(f['x'][:])
-        self.y = np.array(f['y'][:])
-        self.z = np.array(f['z'][:])
-        f.close()
-        # read the files
-        ttimes_list = []
-        self.sta_list=[]
-        for fname in ttimes_fnames:
-            f=h5py.File(fname,'r')
-            # update the list of ttimes
-            ttimes_list.append(np.array(f['ttimes']))
-            sta=f['ttimes'].attrs['station']
-            f.close()
-            # update the dictionary of station names
-            self.sta_list.append(sta)
-        # stack the ttimes into a numpy array
-        self.ttimes_matrix=np.vstack(ttimes_list)
-        (self.nsta,self.npts) = self.ttimes_matrix.shape
-
         # initialize the RtTrace(s)
         ##########################
         max_length = wo.opdict['max_length']
         self.safety_margin = wo.opdict['safety_margin']
-        self.dt = wo.opdict['dt']
-
-        # need a RtTrace per station 
-        self.obs_rt_list=[RtTrace() for sta in self.sta_list]
+        # the data are sampled at data_dt, the CF can be decimated before
+        # migration, which is done at dt
+        self.data_dt = wo.opdict['dt']
+        if wo.opdict.has_key('decimation'):
+            self.decimation = int(wo.opdict['decimation'])
+        self.dt = self.data_dt*self.decimation
 
-        # register pre-processing
+        # initialize the travel-times
+        #############################
+        # the ttimes files are consolidated once into a single store, which
+        # is memory-mapped ; the shifts from each station to each point are
+        # whole numbers of samples, and only this compact integer form of
+        # the travel-times is used
+        self.ttimes_store=TtimesStore.cached(glob.glob(wo.ttimes_glob), \
+                wo.ttimes_store_file, self.dt)
+        store=self.ttimes_store
+        self.sta_list=store.sta_list
+        self.nsta, self.npts = store.nsta, store.npts
+        self.x, self.y, self.z = store.x, store.y, store.z
+        self.sta_xyz=store.sta_xyz
+        self.delay_origin=store.delay_origin
+        self.delay_table=store.delay_table
+        self.moveout_span=store.moveout_span
+
+        # need a RtTrace per station (synthetics) or a CF processor for all
+        # stations (real data)
         self._register_preprocessing(wo)
+        if self.decimation > 1:
+            self.decimator=Decimator(self.decimation, self.data_dt, \
+                    nsta=self.nsta)
+        self._next_input=np.zeros(self.nsta, dtype=np.int64)
+        self._has_input=np.zeros(self.nsta, dtype=bool)
+        # buffers of the packet path, kept between packets (see
+        # am_rt_signal._work_array)
+        self._work={}
+
+        # station-point pairs to be stacked
+        self.active_points=self._make_active_points(wo)
+        if self.active_points is None:
+            self._sta_used=np.ones(self.nsta, dtype=bool)
+        else:
+            self._sta_used=np.array([len(a)>0 for a in self.active_points])
+
+        # extreme delays of each station over all the points it contributes
+        # to
+        self._sta_dmin=np.zeros(self.nsta, dtype=int)
+        self._sta_dmax=np.zeros(self.nsta, dtype=int)
+        for ista in np.flatnonzero(self._sta_used):
+            delays=self.delay_origin+self.delay_table[ista,:]
+            if self.active_points is not None:
+                delays=delays[self.active_points[ista]]
+            self._sta_dmin[ista]=np.min(delays)
+            self._sta_dmax[ista]=np.max(delays)
+
+        # optional station weights, and sparse migration operator (weights
+        # baked in), cached next to the ttimes files
+        self.sta_weights=self._station_weights(wo)
+        if wo.sparse_operator:
+            from sparse_migration import SparseMigrationOperator
+            self.operator=SparseMigrationOperator.cached(self, \
+                    wo.operator_file, self.sta_weights)
+        else:
+            self.operator=None
 
-        # need nsta streams for each point we test (nsta x npts)
-        # for shifted waveforms
-        self.point_rt_list=[[RtTrace(max_length=max_length) \
-                for ista in xrange(self.nsta)] for ip in xrange(self.npts)]
-
-        # register processing of point-streams here
-        for sta_list in self.point_rt_list:
-            for rtt in sta_list:
-                # This is where we would scale for distance (given pre-calculated
-                # distances from each point to every station)
-                rtt.registerRtProcess('scale', factor=1.0)
-
-        # need npts streams to store the point-stacks
-        self.stack_list=[RtTrace(max_length=max_length) for ip in xrange(self.npts)]
-        
-        # register stack procesing here
-        for rtt in self.stack_list:
-            # This is where we would add or lower weights if we wanted to
-            rtt.registerRtProcess('scale', factor=1.0)
+        # a single ring buffer holds the pre-processed data of all stations;
+        # the point-streams are read from it using the delay_table
+        # (in shared memory if the stacking is done by other processes)
+        self.stack_backend=wo.stack_backend
+        self.cf_buffer=CFRingBuffer(self.nsta, int(np.round(max_length/self.dt)), \
+                self.dt, shared=(self.stack_backend=='process'))
 
         # need 4 output streams (max, x, y, z)
         self.max_out = RtTrace()
@@ -103,11 +343,76 @@ class RtMigrator(object):
         self.z_out = RtTrace()
 
         if not wo.is_syn:
-            self.max_out.registerRtProcess('boxcar', width=50)
+            # smoothing over 50 data samples
+            self.max_out.registerRtProcess('boxcar', \
+                    width=max(1, int(np.round(50.0/self.decimation))))
+
+        # need a common start-time (as absolute sample number of the
+        # cf_buffer) for the stacks
+        self.last_common_end_stack = np.iinfo(int).min
+        # blocks of (start sample, max, argmax) waiting for updateMax
+        self.new_max = []
+
+        # start the workers last, so they inherit the complete migrator
+        if self.stack_backend=='serial':
+            self.stacking_pool=None
+        elif self.stack_backend=='process':
+            from parallel_migration import ProcessStackingPool
+            self.stacking_pool=ProcessStackingPool(self, wo.n_workers)
+        elif self.stack_backend=='thread':
+            from parallel_migration import ThreadStackingPool
+            self.stacking_pool=ThreadStackingPool(self, wo.n_workers)
+        else:
+            msg='Unknown stack_backend %s'%self.stack_backend
+            raise ValueError(msg)
 
-        # need a list of common start-times
-        self.last_common_end_stack = [UTCDateTime(1970,1,1) for i in xrange(self.npts)]
-        self.last_common_end_max = UTCDateTime(1970,1,1) 
+    def _make_active_points(self, waveloc_options):
+        """
+        Returns the list (one per station) of the indexes of the points each
+        station contributes to, or None if all stations contribute to all
+        points. Pairs are kept if the station-point distance is at most
+        opdict['max_sta_dist'] (km, needs the station coordinates in the
+        ttimes files) or if the travel-time is at most opdict['max_ttime']
+        (s).
+        """
+        opdict=waveloc_options.opdict
+        if opdict.has_key('max_sta_dist'):
+            if self.sta_xyz is None:
+                msg='max_sta_dist needs station coordinates in the ttimes files'
+                raise ValueError(msg)
+            max_dist2=opdict['max_sta_dist']**2
+            active=[]
+            for ista in xrange(self.nsta):
+                sx, sy, sz = self.sta_xyz[ista]
+                dist2=(self.x-sx)**2 + (self.y-sy)**2 + (self.z-sz)**2
+                active.append(np.flatnonzero(dist2 <= max_dist2))
+        elif opdict.has_key('max_ttime'):
+            max_delay=opdict['max_ttime']/self.dt
+            active=[np.flatnonzero(self.delay_origin+self.delay_table[ista,:]\
+                    <= max_delay) for ista in xrange(self.nsta)]
+        else:
+            return None
+        return active
+
+    def _station_weights(self, waveloc_options):
+        """
+        Returns the (nsta) array of stacking weights given as a dictionary of
+        station names to weights in opdict['sta_weights'] (stations that are
+        not in the dictionary get a weight of 1), or None.
+        """
+        opdict=waveloc_options.opdict
+        if not opdict.has_key('sta_weights'):
+            return None
+        return np.array([opdict['sta_weights'].get(sta, 1.0) \
+                for sta in self.sta_list], dtype=np.float32)
+
+    def close(self):
+        """
+        Stops the stacking workers, if any
+        """
+        if self.stacking_pool is not None:
+            self.stacking_pool.close()
+            self.stacking_pool=None
 
     def _register_preprocessing(self, waveloc_options):
         wo=waveloc_options
@@ -115,143 +420,308 @@ class RtMigrator(object):
         # if this is a synthetic
         if wo.is_syn:
             # do dummy processing only
+            self.obs_rt_list=[RtTrace() for sta in self.sta_list]
             for rtt in self.obs_rt_list:
                 rtt.registerRtProcess('scale', factor=1.0)
 
         else:
-            # get gaussian filtering parameters
+            # get gaussian filtering parameters (the filter designs are
+            # shared with the other migrators through a file)
+            if os.path.isfile(wo.filter_cache_file):
+                filter_cache.load(wo.filter_cache_file)
             f0, sigma, dt = wo.gauss_filter
-            gauss, self.filter_shift = gaussian_filter(f0, sigma, dt)
-            # get kwin
-            # for now just use one window
-            kwin = wo.opdict['kwin']
-            # register pre-processing of data here
-            for rtt in self.obs_rt_list:
-                rtt.registerRtProcess('convolve', conv_signal=gauss)
-                rtt.registerRtProcess('sw_kurtosis', win=kwin)
-                rtt.registerRtProcess('boxcar', width=50)
-                rtt.registerRtProcess('differentiate')
-                rtt.registerRtProcess('neg_to_zero')
+            gauss, self.filter_shift = filter_cache.gaussian_filter(f0, sigma, \
+                    dt)
+            if len(gauss) >= CONVOLVE_FFT_MIN_LENGTH:
+                filter_cache.spectrum(np.real(gauss), \
+                        convolve_fft_length(len(gauss)))
+            if filter_cache.modified:
+                filter_cache.save(wo.filter_cache_file)
+            # get kwin (a single window, or a bank of windows)
+            if wo.opdict.has_key('kwin_bank'):
+                kwin = wo.opdict['kwin_bank']
+            else:
+                kwin = wo.opdict['kwin']
+            # pre-processing of data (convolve, sw_kurtosis or
+            # sw_kurtosis_bank, boxcar of 50 samples, differentiate and
+            # neg_to_zero) of all stations in a single pass
+            self.cf_processor=CFProcessor(gauss, kwin, dt, boxcar_width=50, \
+                    nsta=self.nsta)
 
     def updateData(self, tr_list):
         """
         Adds a list of traces (one per station) to the system
         """
-        t_copy=0.0
-        t_append=0.0
         t_append_proc=0.0
+        t_buffer=0.0
         t0_update=time.time()
+        # for real data, the traces with the same start and length are
+        # processed together as a (nsta, npts) block
+        blocks={}
         for tr in tr_list:
-            if (self.dt!=tr.stats.delta):
-                msg = 'Value of dt from options file %.2f does not match dt from data %2f'%(self.dt, tr.stats.delta)
-                raise ValueError()
+            if (self.data_dt!=tr.stats.delta):
+                msg = 'Value of dt from options file %.2f does not match dt from data %2f'%(self.data_dt, tr.stats.delta)
+                raise ValueError(msg)
             # pre-correct for filter_shift
             #tr.stats.starttime -= np.round(self.filter_shift/self.dt) * self.dt
             tr.stats.starttime -= self.filter_shift
             sta=tr.stats.station
             ista=self.sta_list.index(sta)
+            if self.cf_processor is not None:
+                self._check_contiguous(ista, tr)
+                key=(int(np.round(tr.stats.starttime.timestamp/self.data_dt)),\
+                        tr.stats.npts)
+                blocks.setdefault(key, []).append((ista, tr))
+                continue
             # make dtype of data float if it is not already
             tr.data=tr.data.astype(np.float32)
             t0=time.time()
             pp_data = self.obs_rt_list[ista].append(tr, gap_overlap_check = True)
             t_append_proc += time.time() - t0
 
-            # loop over points
-            for ip in xrange(self.npts):
-                # do time shift and append
-                t0=time.time()
-                pp_data_tmp = pp_data.copy()
-                t_copy += time.time() - t0
-                pp_data_tmp.stats.starttime -= np.round(self.ttimes_matrix[ista,ip]/self.dt) * self.dt
-                t0=time.time()
-                self.point_rt_list[ip][ista].append(pp_data_tmp, gap_overlap_check = True)
-                t_append += time.time() - t0
+            # store once in the ring buffer (no copies per point)
+            t0=time.time()
+            self._store_cf([ista], pp_data.data, pp_data.stats.starttime)
+            t_buffer += time.time() - t0
 
-        print "In updateData : %.2f s in process and %.2f s in data copy and %.2f s in append and a total of %.2f s" % (t_append_proc, t_copy, t_append, time.time()-t0_update)
+        for block in blocks.itervalues():
+            t0=time.time()
+            starttime=block[0][1].stats.starttime
+            # in station order, so that blocks of consecutive stations
+            # update the CF processor state in place
+            block.sort(key=lambda item: item[0])
+            ista_list=[ista for ista, tr in block]
+            # the blocks and their CF are held in buffers kept between
+            # packets
+            shape=(len(block), block[0][1].stats.npts)
+            data=_work_array(self._work, 'block', shape, np.float32)
+            cf=_work_array(self._work, 'block_cf', shape, np.float32)
+            for i in xrange(len(block)):
+                data[i]=block[i][1].data
+            self.cf_processor.process(data, ista_list, out=cf)
+            t_append_proc += time.time() - t0
+            t0=time.time()
+            self._store_cf(ista_list, cf, starttime)
+            t_buffer += time.time() - t0
 
-    def updateStacks(self):
+        print "In updateData : %.2f s in process and %.2f s in buffer update and a total of %.2f s" % (t_append_proc, t_buffer, time.time()-t0_update)
 
-        npts=self.npts
-        
-        for ip in xrange(npts):
-            self._updateStack(ip)
+    def _store_cf(self, ista_list, cf, starttime):
+        """
+        Writes the CF of stations ista_list (as a (len(ista_list), npts) or
+        (npts) array sampled at data_dt and starting at starttime) into the
+        CF buffer, after decimation if needed.
+        """
+        cf=np.atleast_2d(cf)
+        if self.decimator is not None:
+            out=_work_array(self._work, 'decimated', cf.shape, np.float32)
+            cf, starttime = self.decimator.process(cf, starttime, ista_list, \
+                    out)
+            if cf.shape[1]==0:
+                return
+        for i in xrange(len(ista_list)):
+            self.cf_buffer.append_data(ista_list[i], cf[i], starttime)
+
+    def _check_contiguous(self, ista, tr):
+        """
+        Raises TypeError if trace tr does not follow the data of station ista
+        already added (as RtTrace.append with gap_overlap_check).
+        """
+        i0=int(np.round(tr.stats.starttime.timestamp/self.data_dt))
+        if self._has_input[ista] and i0 != self._next_input[ista]:
+            msg='%s: Overlap/gap of (%d) samples in data'%(tr.getId(), \
+                    i0-self._next_input[ista])
+            raise TypeError(msg)
+        self._has_input[ista]=True
+        self._next_input[ista]=i0+tr.stats.npts
 
-    def _updateStack(self,ip):
+    def updateStacks(self):
+        """
+        Stacks all the points over the newly available time block
+        """
         UTCDateTime.DEFAULT_PRECISION=2
-        nsta=self.nsta
-        # get common start-time for this point
-        common_start=max([self.point_rt_list[ip][ista].stats.starttime \
-                 for ista in xrange(nsta)])
-        common_start=max(common_start,self.last_common_end_stack[ip])
+        buf=self.cf_buffer
+        if not np.any(buf.has_data):
+            return
+        dmin=self._sta_dmin
+        dmax=self._sta_dmax
+        # get common start-time for all points (in absolute samples)
+        sta_data=np.logical_and(buf.has_data, self._sta_used)
+        if not np.any(sta_data):
+            return
+        starts=buf.first_sample - dmin
+        ends=buf.next_sample - dmax
+        common_start=max(np.max(starts[sta_data]), \
+                self.last_common_end_stack)
         # get list of stations for which the end-time is compatible
         # with the common_start time and the safety buffer
-        ista_ok=[ista for ista in xrange(nsta) if (self.point_rt_list[ip][ista].stats.endtime - common_start) > self.safety_margin]
-        # get common end-time
-        common_end=min([ self.point_rt_list[ip][ista].stats.endtime for ista in ista_ok])
-        self.last_common_end_stack[ip]=common_end+self.dt
-        # stack
-        c_list=[]
-        for ista in ista_ok:
-            tr=self.point_rt_list[ip][ista].copy()
-            tr.trim(common_start, common_end)
-            c_list.append(np.array(tr.data[:]))
-        tr_common=np.vstack(c_list)
-        # prepare trace for passing up
-        stack_data = np.sum(tr_common, axis=0)
-        stats={'station':'STACK', 'npts':len(stack_data), 'delta':self.dt, \
-                'starttime':common_start}
-        tr=Trace(data=stack_data,header=stats)
-        #import pdb; pdb.set_trace()
-        # append to appropriate stack_list
-        self.stack_list[ip].append(tr, gap_overlap_check = True)
-
-    def updateMax(self):
-
-        npts=self.npts
-        nsta=self.nsta
-
-        # now extract maximum etc from stacks
-        # get common start-time for this point
-        common_start=max([self.stack_list[ip].stats.starttime \
-                    for ip in xrange(npts)])
-        common_start=max(common_start,self.last_common_end_max)
-        # get list of points for which the end-time is compatible
-        # with the common_start time and the safety buffer
-        ip_ok=[ip for ip in xrange(npts) if (self.stack_list[ip].stats.endtime - common_start) > self.safety_margin]
-        common_end=min([self.stack_list[ip].stats.endtime for ip in ip_ok ])
-        self.last_common_end_max=common_end+self.dt
-        # stack
-        c_list=[]
-        for ip in ip_ok:
-            tr=self.stack_list[ip].copy()
-            tr.trim(common_start, common_end)
-            c_list.append(tr.data)
-        tr_common=np.vstack(c_list)
-        # get maximum and the corresponding point
-        max_data = np.max(tr_common, axis=0)
-        argmax_data = np.argmax(tr_common, axis=0)
-        # prepare traces for passing up
-        # max
-        stats={'station':'Max', 'npts':len(max_data), 'delta':self.dt, \
-                'starttime':common_start}
-        tr_max=Trace(data=max_data,header=stats)
-        self.max_out.append(tr_max, gap_overlap_check = True)
-        # x coordinate
-        stats['station'] = 'xMax'
-        tr_x=Trace(data=self.x[argmax_data],header=stats)
-        self.x_out.append(tr_x, gap_overlap_check = True)
-        # y coordinate
-        stats['station'] = 'yMax'
-        tr_y=Trace(data=self.y[argmax_data],header=stats)
-        self.y_out.append(tr_y, gap_overlap_check = True)
-        # z coordinate
-        stats['station'] = 'zMax'
-        tr_z=Trace(data=self.z[argmax_data],header=stats)
-        self.z_out.append(tr_z, gap_overlap_check = True)
-
+        ista_ok=[ista for ista in xrange(self.nsta) if sta_data[ista] and \
+                (ends[ista] - 1 - common_start) * self.dt > self.safety_margin]
+        if len(ista_ok)==0:
+            return
+        # get common end-time (excluded)
+        common_end=min([ends[ista] for ista in ista_ok])
+        self.last_common_end_stack=common_end
+
+        # stack by blocks of points, keeping only the maximum over points
+        # and where it is reached
+        if self.stacking_pool is None:
+            max_data, argmax_data = self._migrate_block(ista_ok, common_start,\
+                    common_end, 0, self.npts)
+        else:
+            max_data, argmax_data = self.stacking_pool.migrate(ista_ok, \
+                    common_start, common_end)
+        self.new_max.append((common_start, max_data, argmax_data))
 
+    def _migrate_block(self, ista_list, common_start, common_end, ip0, ip1):
+        """
+        Returns the maximum over points ip0 to ip1 (excluded) of the stacks
+        between absolute samples common_start and common_end (excluded), and
+        the index of the point at which it is reached.
+        """
+        nsamp=common_end-common_start
+        segments=self._get_segments(ista_list, common_start, common_end)
+        max_data=np.empty(nsamp, dtype=self.cf_buffer.data.dtype)
+        max_data.fill(-np.inf)
+        argmax_data=np.zeros(nsamp, dtype=int)
+        self._migrate_points(segments, ista_list, nsamp, ip0, ip1, \
+                max_data, argmax_data)
+        return max_data, argmax_data
+
+    def _get_segments(self, ista_list, common_start, common_end):
+        """
+        Extracts the contiguous segment of each station needed to stack all
+        the points between absolute samples common_start and common_end
+        (excluded).
+        """
+        buf=self.cf_buffer
+        return [buf.get(ista, common_start+self._sta_dmin[ista], \
+                common_end+self._sta_dmax[ista]) for ista in ista_list]
 
+    def _migrate_points(self, segments, ista_list, nsamp, ip0, ip1, max_data,\
+            argmax_data, work=None):
+        """
+        Stacks points ip0 to ip1 (excluded) by chunks of at most
+        STACK_CHUNK_SIZE samples and folds them into max_data and argmax_data.
 
+        work is an optional preallocated (2, n) array used for the stacks and
+        the gathered samples of a chunk ; it is only used if it is large
+        enough. If the migrator has a sparse operator, the stacks are
+        computed by applying it to the time-aligned block instead.
+        """
+        chunk=max(1, STACK_CHUNK_SIZE // nsamp)
+        if self.operator is not None:
+            block=self.operator.aligned_block(segments, ista_list, nsamp)
+            for i0 in xrange(ip0, ip1, chunk):
+                i1=min(i0+chunk, ip1)
+                fold_max(self.operator.stack(block, i0, i1), max_data, \
+                        argmax_data, i0)
+            return
+        if self.sta_weights is None:
+            weights=None
+        else:
+            weights=self.sta_weights[ista_list]
+        n=min(chunk, ip1-ip0)
+        if work is None or work.shape[1] < n*nsamp:
+            work=np.empty((2, n*nsamp), dtype=max_data.dtype)
+        stacks=work[0, 0:n*nsamp].reshape(n, nsamp)
+        scratch=work[1, 0:n*nsamp].reshape(n, nsamp)
+        for i0 in xrange(ip0, ip1, chunk):
+            i1=min(i0+chunk, ip1)
+            if self.active_points is None:
+                offsets=self._segment_offsets(ista_list, i0, i1)
+                active=None
+            else:
+                offsets, active = self._active_offsets(ista_list, i0, i1)
+            stack_max(segments, offsets, nsamp, max_data, argmax_data, i0, \
+                    stacks[0:i1-i0], scratch[0:i1-i0], active, weights)
+
+    def stackAtPoints(self, ttimes_matrix, common_start, common_end):
+        """
+        Stacks the data held in the CF buffer for arbitrary points, given
+        their travel-times, between absolute samples common_start and
+        common_end (excluded). The window is reduced to the samples that are
+        available for all the stations with data.
+
+        :param ttimes_matrix: (nsta, np) array of travel-times in seconds,
+            with stations in the order of sta_list
+        :rtype: tuple
+        :return: (stacks, common_start, common_end) with stacks a (np, nsamp)
+            array, or None if no samples are available
+        """
+        buf=self.cf_buffer
+        ista_list=[ista for ista in xrange(self.nsta) if buf.has_data[ista]]
+        if len(ista_list)==0:
+            return None
+        delays=np.round(np.asarray(ttimes_matrix)[ista_list,:]/self.dt).astype(int)
+        dmin=np.min(delays, axis=1)
+        dmax=np.max(delays, axis=1)
+        common_start=max(common_start, np.max(buf.first_sample[ista_list]-dmin))
+        common_end=min(common_end, np.min(buf.next_sample[ista_list]-dmax))
+        if common_end <= common_start:
+            return None
+        nsamp=common_end-common_start
+        segments=[buf.get(ista_list[i], common_start+dmin[i], common_end+dmax[i])\
+                for i in xrange(len(ista_list))]
+        stacks=np.empty((delays.shape[1], nsamp), dtype=buf.data.dtype)
+        if self.sta_weights is None:
+            weights=None
+        else:
+            weights=self.sta_weights[ista_list]
+        stack_points(segments, delays-dmin[:,np.newaxis], nsamp, stacks, \
+                weights=weights)
+        return stacks, common_start, common_end
 
+    def _segment_offsets(self, ista_list, ip0, ip1):
+        """
+        Returns the offsets of points ip0 to ip1 (excluded) into the station
+        segments extracted by updateStacks, which start at the smallest delay
+        of each station.
+        """
+        return self.delay_table[ista_list, ip0:ip1] + \
+                (self.delay_origin[ip0:ip1] - \
+                self._sta_dmin[ista_list, np.newaxis])
 
+    def _active_offsets(self, ista_list, ip0, ip1):
+        """
+        Sparse version of _segment_offsets : returns the lists (one per
+        station) of the offsets into the station segments and of the indexes
+        (relative to ip0) of the active points between ip0 and ip1 (excluded).
+        """
+        offsets=[]
+        active=[]
+        for ista in ista_list:
+            points=self.active_points[ista]
+            i0, i1 = np.searchsorted(points, (ip0, ip1))
+            points=points[i0:i1]
+            offsets.append(self.delay_table[ista, points] + \
+                    self.delay_origin[points] - self._sta_dmin[ista])
+            active.append(points-ip0)
+        return offsets, active
 
+    def updateMax(self):
+        """
+        Appends the maximum of the stacks over all points computed by
+        updateStacks, and the corresponding coordinates, to the output
+        streams.
+        """
+        while len(self.new_max) > 0:
+            common_start, max_data, argmax_data = self.new_max.pop(0)
+            # prepare traces for passing up
+            # max
+            stats={'station':'Max', 'npts':len(max_data), 'delta':self.dt, \
+                    'starttime':self.cf_buffer.sample_time(common_start)}
+            tr_max=Trace(data=max_data,header=stats)
+            self.max_out.append(tr_max, gap_overlap_check = True)
+            # x coordinate
+            stats['station'] = 'xMax'
+            tr_x=Trace(data=self.x[argmax_data],header=stats)
+            self.x_out.append(tr_x, gap_overlap_check = True)
+            # y coordinate
+            stats['station'] = 'yMax'
+            tr_y=Trace(data=self.y[argmax_data],header=stats)
+            self.y_out.append(tr_y, gap_overlap_check = True)
+            # z coordinate
+            stats['station'] = 'zMax'
+            tr_z=Trace(data=self.z[argmax_data],header=stats)
+            self.z_out.append(tr_z, gap_overlap_check = True)
@@ -0,0 +1,117 @@
+import heapq
+import numpy as np
+from hdf5_grids import ttimes_at_points
+
+class OctreeSearch(object):
+    """
+    Oct-tree search for the maximum of the migration stack, in the spirit of
+    the NonLinLoc oct-tree search. The search volume is divided into initial
+    cells; the stack at the centre of each cell is evaluated on demand from
+    the CF buffer of a RtMigrator and travel-times interpolated from the
+    time grids. The cell with the highest stack is repeatedly divided into 8
+    children, until it is smaller than min_size or max_cells cells have been
+    evaluated.
+    """
+
+    def __init__(self, migrator, time_grids, grid_info=None, n_init=(4,4,2),\
+            min_size=0.1, max_cells=500):
+        """
+        :param migrator: RtMigrator holding the characteristic functions
+        :param time_grids: list of H5SingleGrid time grids, in the order of
+            migrator.sta_list
+        :param grid_info: dictionary (nx, ny, nz, dx, dy, dz, x_orig, y_orig,
+            z_orig) describing the search volume ; defaults to the extent of
+            the first time grid
+        :param n_init: number of initial cells along x, y and z
+        :param min_size: largest cell dimension (km) below which a cell is
+            not divided any further
+        :param max_cells: maximum number of evaluated cells
+        """
+        self.migrator=migrator
+        self.time_grids=time_grids
+        if grid_info is None:
+            grid_info=time_grids[0].grid_info
+        self.orig=np.array([grid_info['x_orig'], grid_info['y_orig'], \
+                grid_info['z_orig']])
+        self.extent=np.array([grid_info['nx']*grid_info['dx'], \
+                grid_info['ny']*grid_info['dy'], grid_info['nz']*grid_info['dz']])
+        self.n_init=n_init
+        self.min_size=min_size
+        self.max_cells=max_cells
+
+    def _evaluate(self, centres, m0, m1):
+        """
+        Returns the maximum stack over the time window and the absolute
+        sample at which it is reached, for each of the (n, 3) cell centres.
+        """
+        ttimes=ttimes_at_points(self.time_grids, centres[:,0], centres[:,1], \
+                centres[:,2])
+        result=self.migrator.stackAtPoints(ttimes, m0, m1)
+        if result is None:
+            msg='No data available in the search time window'
+            raise ValueError(msg)
+        stacks, common_start, common_end = result
+        it=np.argmax(stacks, axis=1)
+        return stacks[np.arange(len(it)), it], common_start+it
+
+    def search(self, t_detect, win):
+        """
+        Searches for the best location of an event detected at origin time
+        t_detect, within +/- win seconds.
+
+        :rtype: tuple
+        :return: (best, cells) where best is (origin time, x, y, z, stack
+            value) and cells is an (ncells, 7) array holding the x, y, z
+            centres, the x, y, z sizes and the stack value of every evaluated
+            cell
+        """
+        buf=self.migrator.cf_buffer
+        m0=buf.sample_index(t_detect-win)
+        m1=buf.sample_index(t_detect+win)+1
+
+        # initial cells
+        size=self.extent/np.array(self.n_init, dtype=float)
+        axes=[self.orig[i]+(np.arange(self.n_init[i])+0.5)*size[i] \
+                for i in xrange(3)]
+        xx, yy, zz = np.meshgrid(axes[0], axes[1], axes[2], indexing='ij')
+        centres=np.vstack((xx.flatten(), yy.flatten(), zz.flatten())).T
+        sizes=np.tile(size, (len(centres),1))
+        values, samples = self._evaluate(centres, m0, m1)
+
+        cells_c=[centres]
+        cells_s=[sizes]
+        cells_v=[values]
+        cells_t=[samples]
+        ncells=len(values)
+        # max-heap of cells still to be divided
+        heap=[(-values[i], i, centres[i], sizes[i]) for i in xrange(ncells)]
+        heapq.heapify(heap)
+
+        # children are offset by +/- a quarter of the parent size
+        signs=np.array([[sx, sy, sz] for sx in (-1,1) for sy in (-1,1) \
+                for sz in (-1,1)], dtype=float)
+        while len(heap) > 0 and ncells+8 <= self.max_cells:
+            value, i, centre, size = heapq.heappop(heap)
+            if np.max(size) <= self.min_size:
+                break
+            child_size=size/2.0
+            children=centre+signs*size/4.0
+            values, samples = self._evaluate(children, m0, m1)
+            for j in xrange(8):
+                heapq.heappush(heap, (-values[j], ncells+j, children[j], \
+                        child_size))
+            cells_c.append(children)
+            cells_s.append(np.tile(child_size, (8,1)))
+            cells_v.append(values)
+            cells_t.append(samples)
+            ncells+=8
+
+        centres=np.vstack(cells_c)
+        values=np.concatenate(cells_v)
+        samples=np.concatenate(cells_t)
+        cells=np.hstack((centres, np.vstack(cells_s), values[:,np.newaxis]))
+
+        ibest=np.argmax(values)
+        best=(buf.sample_time(samples[ibest]), centres[ibest,0], \
+                centres[ibest,1], centres[ibest,2], values[ibest])
+        return best, cells
@@ -1,4 +1,4 @@
-import os, logging
+import os, logging, multiprocessing
 
 class RtWavelocOptions(object):
     """
@@ -90,6 +90,11 @@ class RtWavelocOptions(object):
         outdir=self.opdict['outdir']
         return os.path.join(base_path, 'out', outdir, 'ttimes')
 
+    def _getTtimesCacheDir_(self):
+        self._verifyOutDir()
+        base_path= self.opdict['base_path']
+        return os.path.join(base_path, 'out', 'ttimes_cache')
+
     def _getFigDir_(self):
         self._verifyOutDir()
         base_path= self.opdict['base_path']
@@ -118,16 +123,51 @@ class RtWavelocOptions(object):
         else:
             return False
 
+    def _getStackBackend_(self):
+        if self.opdict.has_key('stack_backend'):
+            return self.opdict['stack_backend']
+        else:
+            return 'serial'
+
+    def _getSparseOperator_(self):
+        if self.opdict.has_key('sparse_operator') and \
+                self.opdict['sparse_operator'] == True :
+            return True
+        else:
+            return False
+
+    def _getOperatorFile_(self):
+        return os.path.join(self.ttimes_dir, self.opdict['time_grid']+'_operator.hdf5')
+
+    def _getTtimesStoreFile_(self):
+        return os.path.join(self.ttimes_dir, self.opdict['time_grid']+'_store.hdf5')
+
+    def _getFilterCacheFile_(self):
+        return os.path.join(self.out_dir, 'filter_cache.hdf5')
+
+    def _getNWorkers_(self):
+        if self.opdict.has_key('n_workers'):
+            return int(self.opdict['n_workers'])
+        else:
+            return multiprocessing.cpu_count()
+
     lib_dir = property(_getLibDir_)
     out_dir = property(_getOutDir_)
     data_dir = property(_getDataDir_)
     ttimes_dir = property(_getTtimesDir_)
+    ttimes_cache_dir = property(_getTtimesCacheDir_)
     fig_dir = property(_getFigDir_)
     ttimes_glob = property(_getTtimesGlob_)
     grid_glob = property(_getGridGlob_)
     gauss_filter = property(_getGaussFilter_)
     is_syn = property(_getIsSyn_)
     run_offline=property(_getIsOffline_)
+    stack_backend=property(_getStackBackend_)
+    n_workers=property(_getNWorkers_)
+    sparse_operator=property(_getSparseOperator_)
+    operator_file=property(_getOperatorFile_)
+    ttimes_store_file=property(_getTtimesStoreFile_)
+    filter_cache_file=property(_getFilterCacheFile_)
 
 
     def verifyDirectories(self):
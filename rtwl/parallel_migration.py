@@ -0,0 +1,261 @@
+"""
+Parallel back-ends for the stacking stage of RtMigrator. The grid points are
+split into contiguous shards, each shard is stacked by a different worker,
+and the partial maxima are reduced into the maximum over the full grid.
+
+Two back-ends are available : ProcessStackingPool (stack_backend = process)
+and ThreadStackingPool (stack_backend = thread). The latter is lighter for
+small packets and relies on the numpy gather, sum and argmax operations
+releasing the GIL.
+"""
+import multiprocessing as mp
+import threading, Queue, time, logging, traceback, cPickle, sys
+import numpy as np
+
+# interval (in seconds) at which the liveness of the workers is checked
+# while waiting for their results
+RESULT_POLL_INTERVAL = 1.0
+
+
+def reduce_max(partial_list, max_data, argmax_data):
+    """
+    Folds a list of partial (max, argmax) pairs, ordered by increasing point
+    index, into max_data and argmax_data (updated in place). The first point
+    reaching the maximum is kept, as for a serial stack.
+    """
+    for part_max, part_argmax in partial_list:
+        better = part_max > max_data
+        max_data[better] = part_max[better]
+        argmax_data[better] = part_argmax[better]
+
+def shard_bounds(npts, nshards):
+    """
+    Returns the (ip0, ip1) bounds of nshards contiguous shards of npts points
+    """
+    bounds = np.linspace(0, npts, nshards+1).astype(int)
+    return [(bounds[i], bounds[i+1]) for i in xrange(nshards) \
+            if bounds[i+1] > bounds[i]]
+
+def get_results(workers, result_queue):
+    """
+    Gets one result per worker from result_queue and returns them ordered by
+    ip0. If the task of a worker failed, its exception is raised again once
+    all the results are in, after logging the traceback of the worker. If a
+    worker dies, a RuntimeError is raised (the pool is then unusable).
+    """
+    results = []
+    while len(results) < len(workers):
+        try:
+            results.append(result_queue.get(timeout=RESULT_POLL_INTERVAL))
+        except Queue.Empty:
+            dead = [w.name for w in workers if not w.is_alive()]
+            if len(dead) > 0:
+                msg = 'Stacking worker(s) %s died'%', '.join(dead)
+                raise RuntimeError(msg)
+    results.sort(key=lambda r: r[0])
+    for ip0, res, tb in results:
+        if isinstance(res, BaseException):
+            logging.error('Stacking from point %d failed :\n%s'%(ip0, tb))
+            raise res
+    return results
+
+#----------------------------------------------
+class StackingWorker(mp.Process):
+    """
+    Process that stacks one shard of the points of a RtMigrator. The
+    migrator (delay table and shared CF ring buffer) is inherited when the
+    process is forked. Gets (ista_list, common_start, common_end) tasks from
+    task_queue and puts (ip0, max, argmax) into result_queue, or (ip0,
+    exception, traceback) if the task failed.
+    """
+    def __init__(self, migrator, ip0, ip1, task_queue, result_queue):
+        mp.Process.__init__(self)
+        self.daemon = True
+        self.migrator = migrator
+        self.ip0 = ip0
+        self.ip1 = ip1
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+    #----
+    def run(self):
+        while True:
+            next_task = self.task_queue.get()
+            if next_task is None:
+                break
+            ista_list, common_start, common_end = next_task
+            try:
+                max_data, argmax_data = self.migrator._migrate_block( \
+                        ista_list, common_start, common_end, self.ip0, \
+                        self.ip1)
+            except Exception:
+                exc = sys.exc_info()[1]
+                tb = traceback.format_exc()
+                # the exception is sent back pickled
+                try:
+                    cPickle.dumps(exc, cPickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    exc = RuntimeError('%s: %s'%(type(exc).__name__, exc))
+                self.result_queue.put((self.ip0, exc, tb))
+                continue
+            self.result_queue.put((self.ip0, max_data, argmax_data))
+
+#----------------------------------------------
+class ProcessStackingPool(object):
+    """
+    Pool of StackingWorker processes, one per shard of grid points. Must be
+    created after the migrator's CF ring buffer, which has to live in shared
+    memory.
+    """
+    def __init__(self, migrator, n_workers):
+        self.result_queue = mp.Queue()
+        self.workers = []
+        for ip0, ip1 in shard_bounds(migrator.npts, n_workers):
+            w = StackingWorker(migrator, ip0, ip1, mp.Queue(), self.result_queue)
+            w.start()
+            self.workers.append(w)
+    #----
+    def migrate(self, ista_list, common_start, common_end):
+        """
+        Returns the maximum over all points of the stacks between absolute
+        samples common_start and common_end (excluded), and the index of the
+        point at which it is reached. Raises the exception of a worker whose
+        stack failed, or a RuntimeError if a worker died.
+        """
+        for w in self.workers:
+            w.task_queue.put((ista_list, common_start, common_end))
+        results = get_results(self.workers, self.result_queue)
+
+        nsamp = common_end - common_start
+        max_data = np.empty(nsamp, dtype=results[0][1].dtype)
+        max_data.fill(-np.inf)
+        argmax_data = np.zeros(nsamp, dtype=int)
+        reduce_max([(r[1], r[2]) for r in results], max_data, argmax_data)
+        return max_data, argmax_data
+    #----
+    def close(self):
+        for w in self.workers:
+            w.task_queue.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+
+#----------------------------------------------
+class StackingThread(threading.Thread):
+    """
+    Thread that stacks one shard of the points of a RtMigrator, using its
+    own preallocated scratch buffers. Gets (segments, ista_list, nsamp)
+    tasks from task_queue and puts (ip0, max, argmax) into result_queue, or
+    (ip0, exception, traceback) if the task failed.
+    """
+    def __init__(self, migrator, ip0, ip1, task_queue, result_queue, work):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.migrator = migrator
+        self.ip0 = ip0
+        self.ip1 = ip1
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.work = work
+    #----
+    def run(self):
+        while True:
+            next_task = self.task_queue.get()
+            if next_task is None:
+                break
+            segments, ista_list, nsamp = next_task
+            try:
+                max_data = np.empty(nsamp, dtype=self.work.dtype)
+                max_data.fill(-np.inf)
+                argmax_data = np.zeros(nsamp, dtype=int)
+                self.migrator._migrate_points(segments, ista_list, nsamp, \
+                        self.ip0, self.ip1, max_data, argmax_data, self.work)
+            except Exception:
+                self.result_queue.put((self.ip0, sys.exc_info()[1], \
+                        traceback.format_exc()))
+                continue
+            self.result_queue.put((self.ip0, max_data, argmax_data))
+
+#----------------------------------------------
+class ThreadStackingPool(object):
+    """
+    Pool of StackingThread threads, one per shard of grid points. The
+    station segments are extracted once per block and shared by all the
+    threads.
+    """
+    def __init__(self, migrator, n_workers):
+        from migration import STACK_CHUNK_SIZE
+        self.migrator = migrator
+        self.result_queue = Queue.Queue()
+        self.workers = []
+        for ip0, ip1 in shard_bounds(migrator.npts, n_workers):
+            work = np.empty((2, STACK_CHUNK_SIZE), \
+                    dtype=migrator.cf_buffer.data.dtype)
+            w = StackingThread(migrator, ip0, ip1, Queue.Queue(), \
+                    self.result_queue, work)
+            w.start()
+            self.workers.append(w)
+    #----
+    def migrate(self, ista_list, common_start, common_end):
+        """
+        Returns the maximum over all points of the stacks between absolute
+        samples common_start and common_end (excluded), and the index of the
+        point at which it is reached. Raises the exception of a thread whose
+        stack failed.
+        """
+        nsamp = common_end - common_start
+        segments = self.migrator._get_segments(ista_list, common_start, \
+                common_end)
+        for w in self.workers:
+            w.task_queue.put((segments, ista_list, nsamp))
+        results = get_results(self.workers, self.result_queue)
+
+        max_data = np.empty(nsamp, dtype=results[0][1].dtype)
+        max_data.fill(-np.inf)
+        argmax_data = np.zeros(nsamp, dtype=int)
+        reduce_max([(r[1], r[2]) for r in results], max_data, argmax_data)
+        return max_data, argmax_data
+    #----
+    def close(self):
+        for w in self.workers:
+            w.task_queue.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+
+
+def benchmark_stacking(migrator, n_workers, nsamp, n_repeat=3):
+    """
+    Times the stacking of the last nsamp samples stacked by migrator, with
+    the serial kernel and with a ThreadStackingPool of n_workers threads.
+    As in RtMigrator.updateStacks, only the stations that have data, are
+    used and hold all the samples needed for these nsamp samples are
+    stacked. Returns the best serial and threaded times in seconds.
+    """
+    buf = migrator.cf_buffer
+    common_end = migrator.last_common_end_stack
+    common_start = common_end - nsamp
+    sta_data = np.logical_and(buf.has_data, migrator._sta_used)
+    starts = buf.first_sample - migrator._sta_dmin
+    ends = buf.next_sample - migrator._sta_dmax
+    ista_list = [ista for ista in xrange(migrator.nsta) if sta_data[ista] \
+            and starts[ista] <= common_start and ends[ista] >= common_end]
+    if len(ista_list) == 0:
+        msg = 'No station holds the last %d stacked samples'%nsamp
+        raise ValueError(msg)
+
+    t_serial = []
+    for i in xrange(n_repeat):
+        t0 = time.time()
+        migrator._migrate_block(ista_list, common_start, common_end, 0, \
+                migrator.npts)
+        t_serial.append(time.time()-t0)
+
+    pool = ThreadStackingPool(migrator, n_workers)
+    t_thread = []
+    for i in xrange(n_repeat):
+        t0 = time.time()
+        pool.migrate(ista_list, common_start, common_end)
+        t_thread.append(time.time()-t0)
+    pool.close()
+
+    return min(t_serial), min(t_thread)
@@ -23,7 +23,8 @@ def readConfig(filename):
         words=line.split()
         if len(words)>=3 and words[1] == '=' :
             name=words[0]
-            val=words[-1]
+            # values may hold spaces (e.g. comma separated lists)
+            val=''.join(words[2:])
             opdict[name]=val
 
     _verifyParameters(opdict)
@@ -37,12 +38,29 @@ def _verifyParameters(p):
 
     # names of logical parameters
     logical_names=['syn','offline']
+
+    # names of optional logical parameters
+    opt_logical_names=['sparse_operator']
     
     # names of string parameters
     string_names=['base_path', 'outdir', 'datadir', 'data_glob', 'time_grid']
    
     # names of floating point parameters
     float_names=['max_length','safety_margin','filt_f0','filt_sigma','kwin']
+
+    # names of optional integer parameters
+    opt_int_names=['n_workers','decimation','refine_levels']
+
+    # names of optional floating point parameters
+    opt_float_names=['max_sta_dist','max_ttime','refine_threshold',
+            'coarse_spacing','refine_win']
+
+    # names of optional lists of floating point parameters (comma separated)
+    opt_float_list_names=['kwin_bank']
+
+    # names of optional dictionaries of floating point parameters (comma
+    # separated name:value pairs)
+    opt_float_dict_names=['sta_weights']
     
     # cleanup types in dictionary
     try:
@@ -57,6 +75,18 @@ def _verifyParameters(p):
                 raise UserWarning(
                 'Parameter %s should be either .true. or .false., not %s'
                 %(name,val))
+        # deal with the optional logical names
+        for name in opt_logical_names:
+            if p.has_key(name):
+                val=p[name]
+                if val=='.true.': 
+                    p[name]=True
+                elif val=='.false.': 
+                    p[name]=False
+                else : 
+                    raise UserWarning(
+                    'Parameter %s should be either .true. or .false., not %s'
+                    %(name,val))
         # deal with the float names
         for name in float_names:
             val=p[name]
@@ -64,5 +94,26 @@ def _verifyParameters(p):
         # deal with the string names (just check they exist)
         for name in string_names:
             val=p[name]
+        # deal with the optional integer names
+        for name in opt_int_names:
+            if p.has_key(name):
+                p[name]=int(p[name])
+        # deal with the optional float names
+        for name in opt_float_names:
+            if p.has_key(name):
+                p[name]=np.float(p[name])
+        # deal with the optional float list names
+        for name in opt_float_list_names:
+            if p.has_key(name):
+                p[name]=[np.float(val) for val in p[name].split(',')]
+        # deal with the optional float dictionary names
+        for name in opt_float_dict_names:
+            if p.has_key(name):
+                pairs=[item.split(':') for item in p[name].split(',')]
+                if not all([len(pair)==2 for pair in pairs]):
+                    raise UserWarning(
+                    'Parameter %s should be a list of name:value pairs, not %s'
+                    %(name,p[name]))
+                p[name]=dict([(key, np.float(val)) for key, val in pairs])
     except KeyError:
         raise UserWarning('Missing parameter %s in PAR_FILE'%name)
\ No newline at end of file
@@ -6,6 +6,7 @@ import am_rt_signal
 from options import RtWavelocOptions
 from synthetics import generate_random_test_points
 from migration import RtMigrator
+from parallel_migration import benchmark_stacking
 from plotting import plotMaxXYZ
 
 ###############
@@ -108,6 +109,11 @@ print "Times taken for updating data   : %.2f s" % np.sum(t_update_data)
 print "Times taken for updating stacks : %.2f s" % np.sum(t_update_stacks)
 print "Times taken for updating max    : %.2f s" % np.sum(t_update_max)
 
+# compare the thread-pool stacking back-end with the serial one
+n_workers=wo.n_workers
+t_serial, t_thread = benchmark_stacking(migrator, n_workers, int(10.0/migrator.dt))
+print "Stacking 10 s of data : %.3f s serial, %.3f s with %d threads (speedup %.1f)" % (t_serial, t_thread, n_workers, t_serial/t_thread)
+
 st=migrator.max_out.stats.starttime+100
 ed=migrator.max_out.stats.starttime+130
 #st=migrator.max_out.stats.starttime
@@ -2,6 +2,7 @@ import os, time
 from options import RtWavelocOptions
 from synthetics import make_synthetic_data, generate_random_test_points
 from migration import RtMigrator
+from parallel_migration import benchmark_stacking
 from plotting import plotMaxXYZ
 
 
@@ -69,6 +70,11 @@ for itr in xrange(ntr):
 tac=time.time()
 print "Time taken for two-minute 100Hz synthetic test on %d points : %.2f s"%(n_test, tac-tic)
 
+# compare the thread-pool stacking back-end with the serial one
+n_workers=wo.n_workers
+t_serial, t_thread = benchmark_stacking(migrator, n_workers, int(10.0/migrator.dt))
+print "Stacking 10 s of data : %.3f s serial, %.3f s with %d threads (speedup %.1f)" % (t_serial, t_thread, n_workers, t_serial/t_thread)
+
 st=migrator.max_out.stats.starttime+45
 ed=migrator.max_out.stats.starttime+55
 max_out=migrator.max_out.slice(st,ed)
@@ -0,0 +1,161 @@
+import os, hashlib
+import h5py
+import numpy as np
+from scipy import sparse
+from numpy.lib.stride_tricks import as_strided
+
+
+class SparseMigrationOperator(object):
+    """
+    Migration expressed as a sparse (npts, ncols) operator acting on the
+    time-aligned CF block of all the stations.
+
+    The columns of the operator are the (station, lag) pairs : for a block of
+    nsamp samples, row col_start[ista]+j of the aligned block holds the nsamp
+    samples of station ista starting j samples after its smallest delay.
+    Each row of the operator (one per point) holds the weights of the
+    (station, lag) pairs that contribute to the point, so that the stacks of
+    all points are the product of the operator by the aligned block.
+    """
+
+    def __init__(self, matrix, col_start, key=''):
+        """
+        :param matrix: scipy.sparse.csr_matrix of shape (npts, ncols)
+        :param col_start: (nsta+1) array of the first column of each station
+        :param key: string identifying the migrator the operator was built for
+        """
+        self.matrix=matrix
+        self.col_start=np.asarray(col_start, dtype=int)
+        self.key=key
+        self.npts, self.ncols = matrix.shape
+        self.nsta=len(self.col_start)-1
+
+    @staticmethod
+    def migrator_key(migrator, weights=None):
+        """
+        Returns a string identifying the delays, contributing pairs and
+        weights of a migrator, used to check the validity of a cached operator.
+        """
+        h=hashlib.md5()
+        h.update(np.array([migrator.nsta, migrator.npts]).tostring())
+        h.update(np.ascontiguousarray(migrator.delay_origin).tostring())
+        h.update(np.ascontiguousarray(migrator.delay_table).tostring())
+        h.update(np.ascontiguousarray(migrator._sta_dmin).tostring())
+        h.update(np.ascontiguousarray(migrator._sta_dmax).tostring())
+        if migrator.active_points is not None:
+            for points in migrator.active_points:
+                h.update(np.asarray(points).tostring())
+        if weights is not None:
+            h.update(np.asarray(weights, dtype=np.float32).tostring())
+        return h.hexdigest()
+
+    @classmethod
+    def from_migrator(cls, migrator, weights=None):
+        """
+        Builds the operator of a RtMigrator.
+
+        :param weights: None (all weights equal to 1), (nsta) array of
+            station weights or (nsta, npts) array of station-point weights
+        """
+        nsta=migrator.nsta
+        npts=migrator.npts
+        dmin=migrator._sta_dmin
+        span=migrator._sta_dmax-dmin
+        col_start=np.zeros(nsta+1, dtype=int)
+        col_start[1:]=np.cumsum(span+1)
+        if weights is None:
+            w=np.ones((nsta, 1), dtype=np.float32)
+        else:
+            w=np.asarray(weights, dtype=np.float32)
+            if w.ndim==1:
+                w=w[:, np.newaxis]
+        rows=[]
+        cols=[]
+        vals=[]
+        for ista in xrange(nsta):
+            if migrator.active_points is None:
+                points=np.arange(npts)
+            else:
+                points=migrator.active_points[ista]
+            if len(points)==0:
+                continue
+            delays=migrator.delay_origin[points]+migrator.delay_table[ista,points]
+            rows.append(points)
+            cols.append(col_start[ista]+delays-dmin[ista])
+            if w.shape[1]==1:
+                vals.append(np.repeat(w[ista], len(points)))
+            else:
+                vals.append(w[ista, points])
+        # stations are added in order, so the columns of each row are
+        # sorted and the stacks are summed in the order of the stations
+        matrix=sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows),\
+                np.concatenate(cols))), shape=(npts, col_start[-1]),\
+                dtype=np.float32).tocsr()
+        return cls(matrix, col_start, cls.migrator_key(migrator, weights))
+
+    @classmethod
+    def cached(cls, migrator, filename, weights=None):
+        """
+        Reads the operator of a RtMigrator from filename if it was built for
+        the same delays, contributing pairs and weights, otherwise builds it
+        and writes it to filename.
+        """
+        key=cls.migrator_key(migrator, weights)
+        if os.path.isfile(filename):
+            op=cls.load(filename)
+            if op.key==key:
+                return op
+        op=cls.from_migrator(migrator, weights)
+        op.save(filename)
+        return op
+
+    def save(self, filename):
+        """
+        Writes the operator to an hdf5 file.
+        """
+        f=h5py.File(filename,'w')
+        f.create_dataset('data', data=self.matrix.data)
+        f.create_dataset('indices', data=self.matrix.indices)
+        f.create_dataset('indptr', data=self.matrix.indptr)
+        f.create_dataset('col_start', data=self.col_start)
+        f.attrs['shape']=self.matrix.shape
+        f.attrs['key']=self.key
+        f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads an operator written by save.
+        """
+        f=h5py.File(filename,'r')
+        shape=tuple(f.attrs['shape'])
+        matrix=sparse.csr_matrix((f['data'][:], f['indices'][:], \
+                f['indptr'][:]), shape=shape)
+        col_start=f['col_start'][:]
+        key=str(f.attrs['key'])
+        f.close()
+        return cls(matrix, col_start, key)
+
+    def aligned_block(self, segments, ista_list, nsamp):
+        """
+        Returns the (ncols, nsamp) time-aligned block built from the station
+        segments extracted by RtMigrator._get_segments. The rows of the
+        stations that are not in ista_list are zero.
+        """
+        block=np.zeros((self.ncols, nsamp), dtype=self.matrix.dtype)
+        for i in xrange(len(ista_list)):
+            ista=ista_list[i]
+            seg=segments[i]
+            c0=self.col_start[ista]
+            nlag=self.col_start[ista+1]-c0
+            stride=seg.strides[0]
+            block[c0:c0+nlag]=as_strided(seg, shape=(nlag, nsamp), \
+                    strides=(stride, stride))
+        return block
+
+    def stack(self, block, ip0, ip1):
+        """
+        Returns the (ip1-ip0, nsamp) stacks of points ip0 to ip1 (excluded)
+        for an aligned block.
+        """
+        return self.matrix[ip0:ip1].dot(block)
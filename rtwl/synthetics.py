@@ -2,6 +2,7 @@ import os, glob
 import numpy as np
 from obspy.core import UTCDateTime, Trace
 from hdf5_grids import H5SingleGrid, interpolateTimeGrid
+from ttimes_cache import TtimesCache
 
 def make_synthetic_data(waveloc_options):
     """
@@ -85,11 +86,43 @@ def generate_random_test_points(waveloc_options,npts,loc0=None):
     time_grid_names = glob.glob(wo.grid_glob)
     base_names=[os.path.basename(fname) for fname in time_grid_names]
     tt_names=[os.path.join(ttimes_path,base_name) for base_name in base_names]
+    cache=TtimesCache(wo.ttimes_cache_dir)
 
     for i in xrange(len(time_grid_names)):
         outname,ext=os.path.splitext(tt_names[i])
         outname = outname +'_ttimes.hdf5'
-        interpolateTimeGrid(time_grid_names[i], outname, x, y, z)
+        interpolateTimeGrid(time_grid_names[i], outname, x, y, z, cache)
+    cache.log_stats('Travel-time')
 
 
 
+
+def generate_regular_grid_points(waveloc_options, spacing):
+    """
+    Generates ttimes files for a regular grid of points with the given
+    spacing (in km) covering the extent of the time-grids.
+    """
+    wo = waveloc_options
+
+    # get grid extent from first time-grid
+    time_grid_names = glob.glob(wo.grid_glob)
+    tgrid=H5SingleGrid(time_grid_names[0]) 
+    info=tgrid.grid_info
+
+    # generate points
+    x_axis=np.arange(0, info['nx']*info['dx'], spacing) + info['x_orig']
+    y_axis=np.arange(0, info['ny']*info['dy'], spacing) + info['y_orig']
+    z_axis=np.arange(0, info['nz']*info['dz'], spacing) + info['z_orig']
+    xx, yy, zz = np.meshgrid(x_axis, y_axis, z_axis, indexing='ij')
+    x=xx.flatten()
+    y=yy.flatten()
+    z=zz.flatten()
+
+    # generate files
+    ttimes_path=wo.ttimes_dir
+    cache=TtimesCache(wo.ttimes_cache_dir)
+    for fname in time_grid_names:
+        outname,ext=os.path.splitext(os.path.basename(fname))
+        outname = os.path.join(ttimes_path, outname +'_ttimes.hdf5')
+        interpolateTimeGrid(fname, outname, x, y, z, cache)
+    cache.log_stats('Travel-time')
@@ -14,6 +14,11 @@ def suite():
   suite.addTest(H5SingleGridTests('test_interpolation_ones'))
   suite.addTest(H5SingleGridTests('test_interpolation_sinc'))
   suite.addTest(H5SingleGridTests('test_interpolation_newgrid'))
+  suite.addTest(H5SingleGridTests('test_interpolation_newgrid_chunks'))
+  suite.addTest(H5SingleGridTests('test_interpolated_time_grids'))
+  suite.addTest(H5SingleGridTests('test_ttimes_cache'))
+  suite.addTest(H5SingleGridTests('test_spline_cache'))
+  suite.addTest(H5SingleGridTests('test_spline_cache_lru'))
   return suite
 
 class H5Tests(unittest.TestCase):
@@ -322,6 +327,274 @@ class H5SingleGridTests(unittest.TestCase):
     del data
     os.remove(filename)
     os.remove(new_filename)
+
+  def test_interpolation_newgrid_chunks(self):
+
+    data=np.random.rand(20,30,10)
+    info={}
+    info['nx']=20
+    info['ny']=30
+    info['nz']=10
+    info['dx']=1.
+    info['dy']=0.1
+    info['dz']=0.5
+    info['x_orig']=10.
+    info['y_orig']=30.
+    info['z_orig']=15.
+
+    new_info={}
+    new_info['nx']=7
+    new_info['ny']=11
+    new_info['nz']=4
+    new_info['dx']=1.5
+    new_info['dy']=0.15
+    new_info['dz']=0.55
+    new_info['x_orig']=10.5
+    new_info['y_orig']=30.5
+    new_info['z_orig']=15
+
+    # coordinates of the nodes of the new grid, in flattened order
+    ix,iy,iz=np.unravel_index(np.arange(7*11*4),(7,11,4))
+    x=new_info['x_orig']+ix*new_info['dx']
+    y=new_info['y_orig']+iy*new_info['dy']
+    z=new_info['z_orig']+iz*new_info['dz']
+
+    filename='interpolate.hdf5'
+    new_filename='interpolate_new.hdf5'
+    if os.path.isfile(filename): os.remove(filename)
+    sg=H5SingleGrid(filename,data.flatten(),info)
+    expected=sg.value_at_points(x,y,z).astype(np.float32)
+
+    # single slab, one x plane per slab, and several planes per slab
+    for max_chunk_points in (10000, 1, 3*11*4):
+      new_sg=sg.interp_to_newgrid(new_filename,new_info,max_chunk_points)
+      np.testing.assert_array_equal(new_sg.grid_data[:],expected)
+      del new_sg
+      os.remove(new_filename)
+
+    del sg
+    os.remove(filename)
+
+  def test_interpolated_time_grids(self):
+    import glob, shutil, tempfile
+
+    # base path with the test time grids and a search grid in lib
+    base_path=tempfile.mkdtemp()
+    lib_dir=os.path.join(base_path,'lib')
+    os.makedirs(lib_dir)
+    for fname in glob.glob(os.path.join('test_data','lib','*.time.hdf5')):
+      os.symlink(os.path.abspath(fname), \
+          os.path.join(lib_dir,os.path.basename(fname)))
+    f=open(os.path.join(lib_dir,'search.hdr'),'w')
+    f.write('9 7 4  362.2 7647.3 -2.5  0.8 0.7 0.9 SLOW_LEN\n')
+    f.write('TRANSFORM  NONE\n')
+    f.close()
+    opdict={'base_path':base_path, 'time_grid':'Slow_len.100m.P', \
+        'search_grid':'search.hdr', 'load_ttimes_buf':False}
+
+    data={}
+    for outdir, n_workers in (('serial',1), ('parallel',3)):
+      opdict['outdir']=outdir
+      time_grids=get_interpolated_time_grids(opdict, n_workers)
+      data[outdir]=dict([(sta, grid.grid_data[:]) for sta, grid in \
+          time_grids.iteritems()])
+      self.assertEqual(time_grids['FJS'].grid_info['nx'], 9)
+      del time_grids
+      # no temporary file is left
+      tgrid_dir=os.path.join(base_path,'out',outdir,'time_grids')
+      self.assertEqual(len(glob.glob(os.path.join(tgrid_dir,'*.tmp'))), 0)
+
+    # the parallel grids are the serial ones
+    self.assertEqual(sorted(data['parallel'].keys()), \
+        sorted(data['serial'].keys()))
+    for sta in data['serial']:
+      np.testing.assert_array_equal(data['parallel'][sta], data['serial'][sta])
+
+    # existing grids are loaded
+    opdict['load_ttimes_buf']=True
+    time_grids=get_interpolated_time_grids(opdict, 3)
+    np.testing.assert_array_equal(time_grids['FJS'].grid_data[:], \
+        data['serial']['FJS'])
+    del time_grids
+
+    # a new search grid is not mistaken for the previous one
+    f=open(os.path.join(lib_dir,'search.hdr'),'w')
+    f.write('5 7 4  362.2 7647.3 -2.5  0.8 0.7 0.9 SLOW_LEN\n')
+    f.write('TRANSFORM  NONE\n')
+    f.close()
+    time_grids=get_interpolated_time_grids(opdict, 1)
+    self.assertEqual(time_grids['FJS'].grid_info['nx'], 5)
+    del time_grids
+
+    # a failed interpolation does not leave its temporary file behind
+    from hdf5_grids import _interpolate_time_grid
+    from NllGridLib import read_hdr_file
+    f_timegrid=glob.glob(os.path.join(lib_dir,'*.time.hdf5'))[0]
+    tgrid_filename=os.path.join(base_path,'failed.hdf5')
+    search_info=read_hdr_file(os.path.join(lib_dir,'search.hdr'))
+    self.assertRaises(TypeError, _interpolate_time_grid, (f_timegrid, \
+        tgrid_filename, search_info, object()))
+    self.assertEqual(glob.glob(tgrid_filename+'*'), [])
+
+    # nor does a grid that cannot be read, and the error is raised
+    f=open(os.path.join(lib_dir,'Slow_len.100m.P.BAD.time.hdf5'),'w')
+    f.write('not an hdf5 file\n')
+    f.close()
+    opdict['outdir']='failed'
+    opdict['load_ttimes_buf']=False
+    self.assertRaises(IOError, get_interpolated_time_grids, opdict, 3)
+    tgrid_dir=os.path.join(base_path,'out','failed','time_grids')
+    self.assertEqual(len(glob.glob(os.path.join(tgrid_dir,'*.tmp'))), 0)
+
+    shutil.rmtree(base_path)
+
+  def test_ttimes_cache(self):
+    import shutil, tempfile
+    from ttimes_cache import TtimesCache
+
+    data=np.random.rand(20,30,10)
+    info={}
+    info['nx']=20
+    info['ny']=30
+    info['nz']=10
+    info['dx']=1.
+    info['dy']=0.1
+    info['dz']=0.5
+    info['x_orig']=10.
+    info['y_orig']=30.
+    info['z_orig']=15.
+    info['station']='STA'
+
+    x=np.random.rand(5)*info['nx']*info['dx']+info['x_orig']
+    y=np.random.rand(5)*info['ny']*info['dy']+info['y_orig']
+    z=np.random.rand(5)*info['nz']*info['dz']+info['z_orig']
+
+    tmp_dir=tempfile.mkdtemp()
+    grid_file=os.path.join(tmp_dir,'grid.hdf5')
+    out_file=os.path.join(tmp_dir,'grid_ttimes.hdf5')
+    sg=H5SingleGrid(grid_file,data.flatten(),info)
+    del sg
+    cache=TtimesCache(os.path.join(tmp_dir,'cache'))
+
+    def ttimes():
+      f=h5py.File(out_file,'r')
+      values=f['ttimes'][:]
+      f.close()
+      return values
+
+    # computed once
+    interpolateTimeGrid(grid_file, out_file, x, y, z, cache)
+    expected=ttimes()
+    self.assertEqual((cache.hits, cache.misses), (0, 1))
+    # the current file is kept
+    interpolateTimeGrid(grid_file, out_file, x, y, z, cache)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+    # a lost file is restored from the cache
+    os.remove(out_file)
+    interpolateTimeGrid(grid_file, out_file, x, y, z, cache)
+    self.assertEqual((cache.hits, cache.misses), (2, 1))
+    np.testing.assert_array_equal(ttimes(), expected)
+
+    # new points, or a new grid, are computed
+    interpolateTimeGrid(grid_file, out_file, x+0.5, y, z, cache)
+    self.assertEqual((cache.hits, cache.misses), (2, 2))
+    os.remove(grid_file)
+    sg=H5SingleGrid(grid_file,2*data.flatten(),info)
+    del sg
+    interpolateTimeGrid(grid_file, out_file, x, y, z, cache)
+    self.assertEqual((cache.hits, cache.misses), (2, 3))
+    np.testing.assert_array_almost_equal(ttimes(), 2*expected)
+    self.assertEqual(cache.stats()['entries'], 3)
+
+    # the least recently used entries are evicted beyond the size limit
+    entry_size=cache.stats()['nbytes']/3
+    cache.max_bytes=2*entry_size
+    key=cache.ttimes_key(grid_file, x+1.0, y, z, SPLINE_ORDER)
+    entries=[os.path.join(cache.cache_dir, name) for name in \
+        os.listdir(cache.cache_dir)]
+    for i in xrange(len(entries)):
+      os.utime(entries[i], (1000+i, 1000+i))
+    interpolateTimeGrid(grid_file, out_file, x+1.0, y, z, cache)
+    remaining=os.listdir(cache.cache_dir)
+    self.assertEqual(len(remaining), 2)
+    self.assertTrue(key+'.hdf5' in remaining)
+    self.assertTrue(os.path.basename(entries[-1]) in remaining)
+
+    # a product larger than the limit is neither copied nor evicts others
+    cache.max_bytes=entry_size/2
+    interpolateTimeGrid(grid_file, out_file, x+2.0, y, z, cache)
+    self.assertEqual(sorted(os.listdir(cache.cache_dir)), sorted(remaining))
+
+    shutil.rmtree(tmp_dir)
+
+  def test_spline_cache(self):
+    from scipy import ndimage
+
+    data=np.random.rand(20,30,10)
+    info={}
+    info['nx']=20
+    info['ny']=30
+    info['nz']=10
+    info['dx']=1.
+    info['dy']=0.1
+    info['dz']=0.5
+    info['x_orig']=10.
+    info['y_orig']=30.
+    info['z_orig']=15.
+
+    x=np.random.rand(5)*info['nx']*info['dx']+info['x_orig']
+    y=np.random.rand(5)*info['ny']*info['dy']+info['y_orig']
+    z=np.random.rand(5)*info['nz']*info['dz']+info['z_orig']
+    coords=np.array([(x-info['x_orig'])/info['dx'], \
+        (y-info['y_orig'])/info['dy'], (z-info['z_orig'])/info['dz']])
+
+    filename='spline_cache.hdf5'
+    if os.path.isfile(filename): os.remove(filename)
+    sg=H5SingleGrid(filename,data.flatten(),info)
+    del sg
+    sg=H5SingleGrid(filename)
+
+    # same result as prefiltering the whole grid at each call
+    expected=ndimage.map_coordinates(data, coords, order=3, mode='nearest')
+    np.testing.assert_array_equal(sg.value_at_points(x,y,z), expected)
+    self.assertEqual(sg.value_at_point(x[0],y[0],z[0]), expected[0])
+
+    # the coefficients are computed once, and shared by the grids reading
+    # the same file
+    coeffs=sg.spline_coefficients()
+    self.assertTrue(sg.spline_coefficients() is coeffs)
+    sg1=H5SingleGrid(filename)
+    self.assertTrue(sg1.spline_coefficients() is coeffs)
+    del sg
+    del sg1
+
+    # rewriting the file discards them
+    os.remove(filename)
+    sg=H5SingleGrid(filename,2*data.flatten(),info)
+    np.testing.assert_array_almost_equal(sg.value_at_points(x,y,z), \
+        2*expected)
+
+    del sg
+    os.remove(filename)
+
+  def test_spline_cache_lru(self):
+    a=np.zeros(100)
+    b=np.zeros(100)
+    c=np.zeros(100)
+    cache=SplineCache(max_bytes=2*a.nbytes)
+    cache.put('a',a)
+    cache.put('b',b)
+    self.assertTrue(cache.get('a') is a)
+    # b is now the least recently used
+    cache.put('c',c)
+    self.assertTrue(cache.get('b') is None)
+    self.assertTrue(cache.get('a') is a)
+    self.assertTrue(cache.get('c') is c)
+    self.assertEqual(cache.nbytes, 2*a.nbytes)
+    # larger than the budget
+    cache.put('d',np.zeros(300))
+    self.assertTrue(cache.get('d') is None)
+    self.assertEqual(cache.nbytes, 2*a.nbytes)
  
 if __name__ == '__main__':
 
@@ -1,10 +1,11 @@
-import unittest
+import unittest, os, tempfile
 from options import RtWavelocOptions
 from rtwl_io import readConfig
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(IoTests('test_readConfig'))
+    suite.addTest(IoTests('test_readConfig_examples'))
     return suite
     
 class IoTests(unittest.TestCase):
@@ -33,6 +34,32 @@ class IoTests(unittest.TestCase):
         
         for key in self.wo.opdict.keys():
             self.assertEqual(opdict[key],self.wo.opdict[key])
+
+    def test_readConfig_examples(self) :
+
+        # enable the commented examples of the distributed config file
+        f=open('rtwl.config','r')
+        examples=('#kwin_bank', '#refine_', '#coarse_', '#sta_weights')
+        lines=[line.lstrip('#') if line.startswith(examples) else line \
+                for line in f.readlines()]
+        f.close()
+        fd, filename = tempfile.mkstemp(suffix='.config')
+        os.close(fd)
+        f=open(filename,'w')
+        f.writelines(lines)
+        f.close()
+        try:
+            opdict = readConfig(filename)
+        finally:
+            os.remove(filename)
+
+        self.assertEqual(opdict['kwin_bank'], [1.0, 3.0, 9.0])
+        self.assertEqual(opdict['kwin'], 3.0)
+        self.assertEqual(opdict['refine_threshold'], 10.0)
+        self.assertEqual(opdict['coarse_spacing'], 2.0)
+        self.assertEqual(opdict['refine_levels'], 3)
+        self.assertEqual(opdict['refine_win'], 1.0)
+        self.assertEqual(opdict['sta_weights'], {'UV01':0.5, 'UV02':2.0})
             
 if __name__ == '__main__':
  
@@ -1,19 +1,134 @@
-import unittest
+import unittest, os, glob
+import h5py
 import numpy as np
 import am_rt_signal 
 
 
 from options import RtWavelocOptions
 
-from migration import RtMigrator
+from migration import RtMigrator, stack_points, stack_max, make_delay_table
 
-from synthetics import make_synthetic_data, generate_random_test_points
+from hierarchical_migration import HierarchicalMigrator
+from octree_search import OctreeSearch
+from sparse_migration import SparseMigrationOperator
+from hdf5_grids import load_time_grids
+from ttimes_store import TtimesStore
+from test_processing import NumpyAllocationCounter
+from parallel_migration import benchmark_stacking
+
+from synthetics import make_synthetic_data, generate_random_test_points, \
+        generate_regular_grid_points
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(SyntheticMigrationTests('test_rt_migration_true'))
+    suite.addTest(SyntheticMigrationTests('test_rt_migration_process'))
+    suite.addTest(SyntheticMigrationTests('test_rt_migration_thread'))
+    suite.addTest(SyntheticMigrationTests('test_process_pool_errors'))
+    suite.addTest(SyntheticMigrationTests('test_thread_pool_errors'))
+    suite.addTest(SyntheticMigrationTests('test_rt_migration_hierarchical'))
+    suite.addTest(SyntheticMigrationTests('test_octree_search'))
+    suite.addTest(SyntheticMigrationTests('test_rt_migration_masked'))
+    suite.addTest(SyntheticMigrationTests('test_rt_migration_sparse'))
+    suite.addTest(SyntheticMigrationTests('test_rt_migration_decimated'))
+    suite.addTest(SyntheticMigrationTests('test_ttimes_store'))
+    suite.addTest(SyntheticMigrationTests('test_update_data_allocations'))
+    suite.addTest(SyntheticMigrationTests('test_benchmark_stacking'))
+    suite.addTest(StackingTests('test_stack_points'))
+    suite.addTest(StackingTests('test_stack_max'))
+    suite.addTest(StackingTests('test_stack_points_active'))
+    suite.addTest(StackingTests('test_delay_table'))
     return suite
 
+class StackingTests(unittest.TestCase):
+
+    def test_stack_points(self):
+        nsta=4
+        npts=7
+        nsamp=50
+        max_delay=20
+
+        offsets=np.random.randint(0, max_delay, size=(nsta, npts))
+        segments=[np.random.rand(nsamp+max_delay).astype(np.float32) \
+                for ista in xrange(nsta)]
+
+        # stack point by point
+        expected=np.zeros((npts, nsamp), dtype=np.float32)
+        for ip in xrange(npts):
+            for ista in xrange(nsta):
+                i0=offsets[ista,ip]
+                expected[ip,:] += segments[ista][i0:i0+nsamp]
+
+        stacks=np.empty((npts, nsamp), dtype=np.float32)
+        stack_points(segments, offsets, nsamp, stacks)
+        np.testing.assert_array_almost_equal(stacks, expected)
+
+    def test_stack_max(self):
+        nsta=4
+        npts=30
+        nsamp=50
+        max_delay=20
+
+        offsets=np.random.randint(0, max_delay, size=(nsta, npts))
+        segments=[np.random.rand(nsamp+max_delay).astype(np.float32) \
+                for ista in xrange(nsta)]
+        stacks=np.empty((npts, nsamp), dtype=np.float32)
+        stack_points(segments, offsets, nsamp, stacks)
+
+        # fold the points in by blocks of 7
+        max_data=np.empty(nsamp, dtype=np.float32)
+        max_data.fill(-np.inf)
+        argmax_data=np.zeros(nsamp, dtype=int)
+        for ip0 in xrange(0, npts, 7):
+            ip1=min(ip0+7, npts)
+            stack_max(segments, offsets[:,ip0:ip1], nsamp, max_data, \
+                    argmax_data, ip0)
+
+        np.testing.assert_array_equal(max_data, np.max(stacks, axis=0))
+        np.testing.assert_array_equal(argmax_data, np.argmax(stacks, axis=0))
+
+    def test_stack_points_active(self):
+        nsta=4
+        npts=30
+        nsamp=50
+        max_delay=20
+
+        offsets=np.random.randint(0, max_delay, size=(nsta, npts))
+        segments=[np.random.rand(nsamp+max_delay).astype(np.float32) \
+                for ista in xrange(nsta)]
+        mask=np.random.rand(nsta, npts) > 0.5
+        mask[:,0]=False
+
+        # stack point by point
+        expected=np.zeros((npts, nsamp), dtype=np.float32)
+        for ip in xrange(npts):
+            for ista in xrange(nsta):
+                if mask[ista,ip]:
+                    i0=offsets[ista,ip]
+                    expected[ip,:] += segments[ista][i0:i0+nsamp]
+
+        active=[np.flatnonzero(mask[ista]) for ista in xrange(nsta)]
+        active_offsets=[offsets[ista, active[ista]] for ista in xrange(nsta)]
+        stacks=np.empty((npts, nsamp), dtype=np.float32)
+        stack_points(segments, active_offsets, nsamp, stacks, active=active)
+        np.testing.assert_array_almost_equal(stacks, expected)
+
+    def test_delay_table(self):
+        dt=0.01
+        ttimes=np.random.rand(5, 30)*10.0
+
+        delay_origin, delay_table, moveout_span = make_delay_table(ttimes, dt)
+
+        self.assertEqual(delay_table.dtype, np.int16)
+        self.assertEqual(np.min(delay_table), 0)
+        np.testing.assert_array_equal(delay_origin+delay_table, \
+                np.round(ttimes/dt).astype(int))
+        np.testing.assert_array_equal(moveout_span, np.max(delay_table,axis=0))
+
+        # large moveouts do not fit in 16 bits
+        delay_origin, delay_table, moveout_span = make_delay_table(ttimes, 1e-4)
+        self.assertEqual(delay_table.dtype, np.int32)
+
 class SyntheticMigrationTests(unittest.TestCase):
 
     def setUp(self):
@@ -35,6 +150,7 @@ class SyntheticMigrationTests(unittest.TestCase):
 
         # make synthetic data
         self.obs_list, self.ot, (x0,y0,z0) = make_synthetic_data(self.wo)
+        self.loc0 = (x0, y0, z0)
 
         self.starttime=self.obs_list[0].stats.starttime
         self.dt=self.obs_list[0].stats.delta
@@ -49,12 +165,9 @@ class SyntheticMigrationTests(unittest.TestCase):
         n_test=150
         generate_random_test_points(self.wo, n_test, (x0, y0, z0))
 
-    def test_rt_migration_true(self):
-
-        migrator = RtMigrator(self.wo)
+    def _run_migrator(self, migrator):
         nsta = migrator.nsta
 
-
         ntr=len(self.obs_split[0])
         #########################
         # start loops
@@ -65,7 +178,7 @@ class SyntheticMigrationTests(unittest.TestCase):
             # loop over stations
             data_list=[]
             for ista in xrange(nsta):
-                tr = self.obs_split[ista][itr]
+                tr = self.obs_split[ista][itr].copy()
                 data_list.append(tr)
 
             # update data
@@ -81,6 +194,296 @@ class SyntheticMigrationTests(unittest.TestCase):
         # end loops
         #########################
 
+    def _compare_backend(self, stack_backend):
+
+        migrator = RtMigrator(self.wo)
+        self._run_migrator(migrator)
+
+        self.wo.opdict['stack_backend'] = stack_backend
+        self.wo.opdict['n_workers'] = 3
+        par_migrator = RtMigrator(self.wo)
+        self._run_migrator(par_migrator)
+        par_migrator.close()
+
+        np.testing.assert_array_equal(migrator.max_out.data, \
+                par_migrator.max_out.data)
+        np.testing.assert_array_equal(migrator.x_out.data, \
+                par_migrator.x_out.data)
+        np.testing.assert_array_equal(migrator.z_out.data, \
+                par_migrator.z_out.data)
+
+    def test_rt_migration_process(self):
+        self._compare_backend('process')
+
+    def test_rt_migration_thread(self):
+        self._compare_backend('thread')
+
+    def test_process_pool_errors(self):
+
+        self.wo.opdict['stack_backend'] = 'process'
+        self.wo.opdict['n_workers'] = 2
+        migrator = RtMigrator(self.wo)
+        pool = migrator.stacking_pool
+
+        # the exception of a worker is raised by migrate, and the pool is
+        # still usable
+        self.assertRaises(IndexError, pool.migrate, [migrator.nsta], 0, 10)
+        self.assertRaises(IndexError, pool.migrate, [migrator.nsta], 0, 10)
+
+        # a dead worker is detected instead of waiting for its result
+        pool.workers[0].terminate()
+        pool.workers[0].join()
+        self.assertRaises(RuntimeError, pool.migrate, [0], 0, 10)
+        migrator.close()
+
+    def test_thread_pool_errors(self):
+
+        self.wo.opdict['stack_backend'] = 'thread'
+        self.wo.opdict['n_workers'] = 2
+        migrator = RtMigrator(self.wo)
+        pool = migrator.stacking_pool
+
+        def failing_migrate_points(*args):
+            raise ValueError('stacking failed')
+        migrator._migrate_points = failing_migrate_points
+
+        # the exception of a thread is raised by migrate, and the pool is
+        # still usable
+        self.assertRaises(ValueError, pool.migrate, [0], 0, 10)
+        self.assertRaises(ValueError, pool.migrate, [0], 0, 10)
+        migrator.close()
+
+    def test_rt_migration_hierarchical(self):
+
+        # coarse grid that does not contain the true location
+        generate_regular_grid_points(self.wo, 2.0)
+        self.assertRaises(ValueError, HierarchicalMigrator, self.wo)
+        self.wo.opdict['coarse_spacing'] = 2.0
+        self.wo.opdict['refine_levels'] = 3
+        self.wo.opdict['refine_threshold'] = 0.5*len(self.obs_list)
+
+        migrator = HierarchicalMigrator(self.wo)
+        self._run_migrator(migrator)
+
+        # a single event, found at the right place and time
+        self.assertEqual(len(migrator.locations), 1)
+        otime, x, y, z, value = migrator.locations[0]
+        self.assertAlmostEqual(otime - (self.starttime + self.ot), 0.0, 1)
+        dist=np.sqrt((x-self.loc0[0])**2 + (y-self.loc0[1])**2 + \
+                (z-self.loc0[2])**2)
+        self.assertLessEqual(dist, 0.5)
+        self.assertGreater(value, np.max(migrator.max_out.data))
+
+    def test_rt_migration_masked(self):
+
+        migrator = RtMigrator(self.wo)
+        self._run_migrator(migrator)
+
+        # a travel-time cutoff larger than all travel-times keeps all the
+        # pairs
+        self.wo.opdict['max_ttime'] = 1000.0
+        all_migrator = RtMigrator(self.wo)
+        self._run_migrator(all_migrator)
+        np.testing.assert_array_equal(migrator.max_out.data, \
+                all_migrator.max_out.data)
+
+        # a distance cutoff must still find the origin time
+        self.wo.opdict['max_sta_dist'] = 6.0
+        masked_migrator = RtMigrator(self.wo)
+        n_pairs=sum([len(a) for a in masked_migrator.active_points])
+        self.assertLess(n_pairs, masked_migrator.nsta*masked_migrator.npts)
+        self._run_migrator(masked_migrator)
+        max_trace=masked_migrator.max_out.data
+        tmax=np.argmax(max_trace)*self.dt
+        tdiff=(masked_migrator.max_out.stats.starttime + tmax)-\
+                (self.starttime + self.ot)
+        self.assertAlmostEqual(tdiff, 0, 1)
+
+    def test_rt_migration_sparse(self):
+
+        self.wo.opdict['max_sta_dist'] = 6.0
+        migrator = RtMigrator(self.wo)
+        self._run_migrator(migrator)
+
+        # the sparse operator gives the same stacks
+        self.wo.opdict['sparse_operator'] = True
+        sparse_migrator = RtMigrator(self.wo)
+        self.assertEqual(sparse_migrator.operator.matrix.nnz, \
+                sum([len(a) for a in migrator.active_points]))
+        self._run_migrator(sparse_migrator)
+        np.testing.assert_array_equal(migrator.max_out.data, \
+                sparse_migrator.max_out.data)
+        np.testing.assert_array_equal(migrator.x_out.data, \
+                sparse_migrator.x_out.data)
+
+        # the cached operator is read back, and rebuilt if the weights change
+        op=SparseMigrationOperator.load(self.wo.operator_file)
+        self.assertEqual(op.key, sparse_migrator.operator.key)
+        self.wo.opdict['sta_weights'] = dict([(sta, 2.0) for sta in \
+                migrator.sta_list])
+        weighted_migrator = RtMigrator(self.wo)
+        self.assertNotEqual(weighted_migrator.operator.key, op.key)
+        self._run_migrator(weighted_migrator)
+        np.testing.assert_array_equal(2*migrator.max_out.data, \
+                weighted_migrator.max_out.data)
+
+        # the dense stacking applies the same weights
+        self.wo.opdict['sta_weights'] = dict([(migrator.sta_list[ista], \
+                0.5+0.25*ista) for ista in xrange(migrator.nsta)])
+        sparse_migrator = RtMigrator(self.wo)
+        self._run_migrator(sparse_migrator)
+        self.wo.opdict['sparse_operator'] = False
+        dense_migrator = RtMigrator(self.wo)
+        self._run_migrator(dense_migrator)
+        np.testing.assert_array_equal(sparse_migrator.max_out.data, \
+                dense_migrator.max_out.data)
+        np.testing.assert_array_equal(sparse_migrator.x_out.data, \
+                dense_migrator.x_out.data)
+        self.assertFalse(np.array_equal(migrator.max_out.data, \
+                dense_migrator.max_out.data))
+
+    def test_rt_migration_decimated(self):
+
+        self.wo.opdict['decimation'] = 4
+        migrator = RtMigrator(self.wo)
+        self.assertAlmostEqual(migrator.dt, 4*self.dt)
+        self.assertEqual(migrator.cf_buffer.length*4, \
+                int(np.round(self.wo.opdict['max_length']/self.dt)))
+        self._run_migrator(migrator)
+
+        self.assertAlmostEqual(migrator.max_out.stats.delta, 4*self.dt)
+        max_trace=migrator.max_out.data
+        imax=np.argmax(max_trace)
+        tdiff=(migrator.max_out.stats.starttime + imax*migrator.dt)-\
+                (self.starttime + self.ot)
+        self.assertLessEqual(abs(tdiff), 2*migrator.dt)
+        dist=np.sqrt((migrator.x_out.data[imax]-self.loc0[0])**2 + \
+                (migrator.y_out.data[imax]-self.loc0[1])**2 + \
+                (migrator.z_out.data[imax]-self.loc0[2])**2)
+        self.assertLessEqual(dist, 0.5)
+
+    def test_ttimes_store(self):
+
+        migrator = RtMigrator(self.wo)
+
+        # the delays are those of the ttimes files, memory-mapped from the
+        # store
+        ttimes_fnames=glob.glob(self.wo.ttimes_glob)
+        ttimes=[]
+        for fname in ttimes_fnames:
+            f=h5py.File(fname,'r')
+            ttimes.append(f['ttimes'][:])
+            self.assertEqual(migrator.sta_list[len(ttimes)-1], \
+                    f['ttimes'].attrs['station'])
+            f.close()
+        delay_origin, delay_table, moveout_span = \
+                make_delay_table(np.vstack(ttimes), migrator.dt)
+        self.assertIsInstance(migrator.delay_table.base, np.memmap)
+        self.assertEqual(migrator.delay_table.dtype, delay_table.dtype)
+        np.testing.assert_array_equal(migrator.delay_table, delay_table)
+        np.testing.assert_array_equal(migrator.delay_origin, delay_origin)
+        np.testing.assert_array_equal(migrator.moveout_span, moveout_span)
+        np.testing.assert_array_equal(migrator.ttimes_store.ttimes, \
+                np.vstack(ttimes))
+        self.assertEqual(migrator.npts, len(migrator.x))
+
+        # the store is reused as long as the ttimes files and dt are the same
+        mtime=os.path.getmtime(self.wo.ttimes_store_file)
+        store=TtimesStore.cached(ttimes_fnames, self.wo.ttimes_store_file, \
+                migrator.dt)
+        self.assertEqual(store.key, migrator.ttimes_store.key)
+        self.assertEqual(os.path.getmtime(self.wo.ttimes_store_file), mtime)
+        store=TtimesStore.cached(ttimes_fnames, self.wo.ttimes_store_file, \
+                2*migrator.dt)
+        self.assertNotEqual(store.key, migrator.ttimes_store.key)
+        self.assertAlmostEqual(store.dt, 2*migrator.dt)
+        np.testing.assert_array_equal(store.delay_table, make_delay_table(\
+                np.vstack(ttimes), 2*migrator.dt)[1])
+
+        # the first migrator still reads its own delays
+        np.testing.assert_array_equal(migrator.delay_table, delay_table)
+
+    def test_update_data_allocations(self):
+        try:
+            counter=NumpyAllocationCounter()
+        except (AttributeError, ValueError):
+            self.skipTest('numpy allocation hook not available')
+
+        # real-data pre-processing, without and with decimation
+        self.wo.opdict['syn'] = False
+        self.wo.opdict['filt_f0'] = 27.0
+        self.wo.opdict['filt_sigma'] = 7.0
+        self.wo.opdict['kwin'] = 3.0
+        npkt=10
+        npts=len(self.obs_list[0].data)//npkt
+        packets=[[obs.data[i*npts:(i+1)*npts] for i in xrange(npkt)] \
+                for obs in self.obs_list]
+        for decimation in (1, 4):
+            self.wo.opdict['decimation'] = decimation
+            migrator = RtMigrator(self.wo)
+            counts=[]
+            for i in xrange(npkt):
+                tr_list=[]
+                for ista in xrange(migrator.nsta):
+                    tr=self.obs_list[ista].copy()
+                    tr.data=packets[ista][i]
+                    tr.stats.starttime+=i*npts*self.dt
+                    tr_list.append(tr)
+                # the first packet sets up the state and the buffers
+                with counter:
+                    migrator.updateData(tr_list)
+                counts.append(counter.count)
+            self.assertGreater(counts[0], 0)
+            self.assertEqual(counts[1:], [0]*(npkt-1))
+
+    def test_benchmark_stacking(self):
+
+        migrator = RtMigrator(self.wo)
+        ntr=len(self.obs_split[0])
+        # the first station only sends its first packet
+        for itr in xrange(ntr):
+            data_list=[self.obs_split[ista][itr].copy() for ista in \
+                    xrange(migrator.nsta) if itr==0 or \
+                    self.obs_split[ista][itr].stats.station != \
+                    migrator.sta_list[0]]
+            migrator.updateData(data_list)
+            migrator.updateStacks()
+        buf=migrator.cf_buffer
+        self.assertLess(buf.next_sample[0]-migrator._sta_dmax[0], \
+                migrator.last_common_end_stack)
+
+        # the lagging station is left out of the benchmark
+        t_serial, t_thread = benchmark_stacking(migrator, 2, 100, n_repeat=1)
+        self.assertGreater(t_serial, 0.0)
+        self.assertGreater(t_thread, 0.0)
+        # no station holds samples before the start of the buffer
+        nsamp=migrator.last_common_end_stack+np.max(migrator._sta_dmin)+1
+        self.assertRaises(ValueError, benchmark_stacking, migrator, 2, nsamp)
+
+    def test_octree_search(self):
+
+        migrator = RtMigrator(self.wo)
+        self._run_migrator(migrator)
+
+        time_grids = load_time_grids(self.wo.grid_glob, migrator.sta_list)
+        octree = OctreeSearch(migrator, time_grids, min_size=0.2)
+        best, cells = octree.search(self.starttime + self.ot, 1.0)
+
+        otime, x, y, z, value = best
+        self.assertAlmostEqual(otime - (self.starttime + self.ot), 0.0, 1)
+        dist=np.sqrt((x-self.loc0[0])**2 + (y-self.loc0[1])**2 + \
+                (z-self.loc0[2])**2)
+        self.assertLessEqual(dist, 0.5)
+        # far fewer cells than nodes in the time grids
+        info = time_grids[0].grid_info
+        self.assertLess(len(cells), info['nx']*info['ny']*info['nz']/2)
+        self.assertEqual(np.max(cells[:,6]), value)
+
+    def test_rt_migration_true(self):
+
+        migrator = RtMigrator(self.wo)
+        self._run_migrator(migrator)
+
         # check we find the same absolute origin time
         #migrator.max_out.plot()
         st=migrator.max_out.stats.starttime+45
@@ -1,9 +1,10 @@
-import unittest
+import unittest, ctypes
 import numpy as np
 import am_rt_signal
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 from obspy.realtime import RtTrace 
-from obspy import read, Stream
+from obspy.realtime.rtmemory import RtMemory
+from obspy import read, Stream, Trace
 try:
     from waveloc import rec_kurtosis
     waveloc_installed=True
@@ -12,6 +13,59 @@ except ImportError:
     
 
 
+class NumpyAllocationCounter(object):
+    """
+    Counts the allocations of array data by numpy while it is active (as a
+    context manager), through the PyDataMem_SetEventHook function of the
+    numpy C API.
+    """
+
+    _HOOK=ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, \
+            ctypes.c_size_t, ctypes.c_void_p)
+    # index of PyDataMem_SetEventHook in the numpy C API table, for the
+    # numpy versions having it at that index (from its introduction to its
+    # deprecation)
+    _SET_HOOK_INDEX=291
+    _NUMPY_VERSIONS=((1, 7), (1, 23))
+
+    def __init__(self):
+        version=tuple([int(v) for v in np.__version__.split('.')[0:2]])
+        if not self._NUMPY_VERSIONS[0] <= version < self._NUMPY_VERSIONS[1]:
+            msg='PyDataMem_SetEventHook not known for numpy %s'%np.__version__
+            raise ValueError(msg)
+        api=np.core.multiarray._ARRAY_API
+        if type(api).__name__=='PyCapsule':
+            get_pointer=ctypes.pythonapi.PyCapsule_GetPointer
+            get_pointer.argtypes=[ctypes.py_object, ctypes.c_char_p]
+            args=(api, None)
+        else:
+            get_pointer=ctypes.pythonapi.PyCObject_AsVoidPtr
+            get_pointer.argtypes=[ctypes.py_object]
+            args=(api,)
+        get_pointer.restype=ctypes.c_void_p
+        table=ctypes.cast(get_pointer(*args), ctypes.POINTER(ctypes.c_void_p))
+        address=table[self._SET_HOOK_INDEX]
+        if not address:
+            raise ValueError('PyDataMem_SetEventHook not available')
+        self._set_hook=ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_void_p, \
+                ctypes.c_void_p, ctypes.c_void_p)(address)
+        self._hook=self._HOOK(self._event)
+        self.count=0
+
+    def _event(self, old_ptr, new_ptr, size, user_data):
+        if new_ptr:
+            self.count+=1
+
+    def __enter__(self):
+        self.count=0
+        self._previous=self._set_hook(ctypes.cast(self._hook, \
+                ctypes.c_void_p), None, None)
+        return self
+
+    def __exit__(self, *args):
+        self._set_hook(self._previous, None, None)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(RtTests('test_rt_offset'))
@@ -23,13 +77,28 @@ def suite():
     suite.addTest(RtTests('test_rt_dx2'))
     suite.addTest(RtTests('test_rt_kurtosis'))
     suite.addTest(RtTests('test_sw_kurtosis'))
+    suite.addTest(RtTests('test_rec_kurtosis'))
+    suite.addTest(RtTests('test_sw_kurtosis_scipy'))
+    suite.addTest(RtTests('test_sw_kurtosis_event'))
     #suite.addTest(RtTests('test_rt_kurtosis_dec'))
     suite.addTest(RtTests('test_rt_neg_to_zero'))
     suite.addTest(RtTests('test_rt_kurt_grad'))
     suite.addTest(RtTests('test_rt_gaussian_filter'))
+    suite.addTest(RtTests('test_rt_convolve_fft'))
+    suite.addTest(RtTests('test_rt_convolve_packets'))
+    suite.addTest(RtTests('test_kernel_spectra'))
+    suite.addTest(RtTests('test_filter_bank'))
+    suite.addTest(RtTests('test_cf_processor'))
+    suite.addTest(RtTests('test_cf_processor_block'))
+    suite.addTest(RtTests('test_decimator'))
+    suite.addTest(RtTests('test_out_buffer'))
+    suite.addTest(RtTests('test_cf_processor_allocations'))
     suite.addTest(RtTests('test_kwin_bank'))
+    suite.addTest(RtTests('test_sw_kurtosis_bank'))
+    suite.addTest(RtTests('test_sw_kurtosis_cost'))
     suite.addTest(FilterTests('test_bp_filterbank'))
     suite.addTest(FilterTests('test_gaussian_filter'))
+    suite.addTest(FilterTests('test_filter_cache'))
     return suite
 
     
@@ -45,7 +114,10 @@ class RtTests(unittest.TestCase):
         rt_dict['dx2']=(am_rt_signal.dx2,2)
         rt_dict['neg_to_zero']=(am_rt_signal.neg_to_zero,0)
         rt_dict['convolve']=(am_rt_signal.convolve,1)
+        rt_dict['filter_bank']=(am_rt_signal.filter_bank,1)
         rt_dict['sw_kurtosis']=(am_rt_signal.sw_kurtosis,1)
+        rt_dict['sw_kurtosis_bank']=(am_rt_signal.sw_kurtosis_bank,1)
+        rt_dict['rec_kurtosis']=(am_rt_signal.rec_kurtosis,3)
 
         # set up traces
         self.data_trace = read('test_data/YA.UV15.00.HHZ.MSEED')[0]
@@ -140,6 +212,92 @@ class RtTests(unittest.TestCase):
         self.assertAlmostEquals(np.mean(np.abs(diff)),0.0)
 
 
+    def test_sw_kurtosis_scipy(self):
+        import scipy.stats as ss
+        win=0.5
+
+        data_trace = self.data_trace.copy()
+        x=data_trace.data/np.std(data_trace.data)
+        # a constant stretch gives zero variance windows
+        x[1000:1200]=x[1000]
+        data_trace.data=x
+
+        rt_trace=RtTrace()
+        rt_trace.registerRtProcess('sw_kurtosis',win=win)
+        for tr in data_trace / 3:
+            rt_trace.append(tr, gap_overlap_check = True)
+
+        # direct computation, windows padded with the mirrored start
+        npts=int(np.round(win/data_trace.stats.delta))
+        xpad=np.concatenate((x[0:npts-1][::-1], x)).astype(np.float64)
+        k_array=np.array([xpad[i:i+npts] for i in xrange(len(x))])
+        kurt=ss.kurtosis(k_array,axis=1)
+
+        assert_array_almost_equal(rt_trace.data, kurt, 3)
+        self.assertEqual(rt_trace.data[1150], -3.0)
+
+    def test_sw_kurtosis_event(self):
+        import scipy.stats as ss
+        win=1.0
+
+        # long stream of unit noise, with a very large event : the
+        # round-off of the event must not affect the following windows
+        data_trace = self.data_trace.copy()
+        np.random.seed(42)
+        x=np.random.randn(20000)
+        x[2000:2300]*=1e4
+        data_trace.data=x
+        data_trace.stats.delta=0.01
+
+        rt_trace=RtTrace()
+        rt_bank=RtTrace()
+        rt_trace.registerRtProcess('sw_kurtosis',win=win)
+        rt_bank.registerRtProcess('sw_kurtosis_bank',win_list=[win])
+        for tr in data_trace / 80:
+            rt_trace.append(tr.copy(), gap_overlap_check = True)
+            rt_bank.append(tr.copy(), gap_overlap_check = True)
+
+        # direct computation, windows padded with the mirrored start
+        npts=int(np.round(win/data_trace.stats.delta))
+        xpad=np.concatenate((x[0:npts-1][::-1], x))
+        k_array=np.array([xpad[i:i+npts] for i in xrange(len(x))])
+        kurt=ss.kurtosis(k_array,axis=1)
+
+        assert_array_almost_equal(rt_trace.data, kurt, 6)
+        assert_array_almost_equal(rt_trace.data[2500:], kurt[2500:], 10)
+        assert_array_equal(rt_trace.data, rt_bank.data)
+
+    def test_rec_kurtosis(self):
+        win=3.0
+
+        data_trace = self.data_trace.copy()
+
+        rt_trace=RtTrace()
+        rt_single=RtTrace()
+        rt_trace.registerRtProcess('rec_kurtosis',win=win)
+        rt_single.registerRtProcess('rec_kurtosis',win=win)
+
+        # the initial state is taken from the first trace
+        rt_single.append(self.traces[0].copy())
+        rt_single.append(data_trace.slice(self.traces[1].stats.starttime))
+        for tr in self.traces:
+            rt_trace.append(tr, gap_overlap_check = True)
+        assert_array_almost_equal(rt_single.data, rt_trace.data, 4)
+
+        # gaussian noise has zero kurtosis, a spike a large one (shortly
+        # after it, once its contribution to the variance has decayed)
+        noise_trace = self.data_trace.copy()
+        np.random.seed(42)
+        noise_trace.data = np.random.randn(len(noise_trace.data)).astype(np.float32)
+        noise_trace.data[10000] = 50.0
+        rt_noise=RtTrace()
+        rt_noise.registerRtProcess('rec_kurtosis',win=win)
+        rt_noise.append(noise_trace)
+        self.assertAlmostEqual(np.median(rt_noise.data[0:9000]), 0.0, 0)
+        imax=np.argmax(rt_noise.data)
+        self.assertTrue(10000 <= imax < 11000)
+        self.assertGreater(rt_noise.data[imax], 10.0)
+
     def test_rt_neg_to_zero(self):
 
         data_trace=self.data_trace.copy()
@@ -361,6 +519,78 @@ class RtTests(unittest.TestCase):
 
         #max_kurt.plot()
 
+    def test_sw_kurtosis_bank(self):
+        from am_signal import gaussian_filter
+        win_list=[1.0, 3.0, 9.0]
+
+        # the bank gives the maximum over the single windows
+        kurt_traces=[]
+        for win in win_list:
+            rtt=RtTrace()
+            rtt.registerRtProcess('sw_kurtosis',win=win)
+            kurt_traces.append(rtt)
+        rt_bank=RtTrace()
+        rt_bank.registerRtProcess('sw_kurtosis_bank',win_list=win_list)
+        for tr in self.traces:
+            for rtt in kurt_traces:
+                rtt.append(tr.copy(), gap_overlap_check = True)
+            rt_bank.append(tr.copy(), gap_overlap_check = True)
+        max_kurt=np.max(np.vstack([rtt.data for rtt in kurt_traces]), axis=0)
+        assert_array_almost_equal(rt_bank.data/np.max(max_kurt), \
+                max_kurt/np.max(max_kurt), 5)
+
+        # as a stage of the CF processor
+        gauss,tshift = gaussian_filter(1.0, 5.0, 0.01)
+        rt_trace=RtTrace()
+        rt_trace.registerRtProcess('convolve',conv_signal=gauss)
+        rt_trace.registerRtProcess('sw_kurtosis_bank',win_list=win_list)
+        rt_trace.registerRtProcess('boxcar',width=50)
+        rt_trace.registerRtProcess('differentiate')
+        rt_trace.registerRtProcess('neg_to_zero')
+        proc=am_rt_signal.CFProcessor(gauss, win_list, 0.01)
+        cf=[]
+        for tr in self.traces:
+            cf.append(proc.process(tr.data))
+            rt_trace.append(tr, gap_overlap_check = True)
+        cf=np.concatenate(cf)
+        assert_array_almost_equal(cf/np.max(cf), rt_trace.data/np.max(cf), 4)
+
+    def test_sw_kurtosis_cost(self):
+        import time
+
+        # short packets of many stations
+        nsta=20
+        n=100
+        npackets=100
+        np.random.seed(42)
+        data=np.random.randn(nsta, n*npackets)
+
+        def kurtosis_time(npts_list):
+            best=None
+            for rep in xrange(5):
+                window_sums=am_rt_signal._WindowSums(max(npts_list), (nsta,),\
+                        np.zeros(nsta), n)
+                window_sums.append(data[:, 0:max(npts_list)-1])
+                work={}
+                t0=time.time()
+                for i in xrange(npackets):
+                    am_rt_signal._kurtosis_bank(window_sums, \
+                            data[:, i*n:(i+1)*n], npts_list, work)
+                t=time.time()-t0
+                if best is None or t < best:
+                    best=t
+            return best
+
+        # the cost does not grow with the window length (a rebuild of the
+        # sums at each packet costs about 5 times more for 9 s than for 1 s)
+        t_short=kurtosis_time([100])
+        t_long=kurtosis_time([900])
+        self.assertLess(t_long, 2.0*t_short)
+        # the windows of a bank share the powers and the block sums (a pass
+        # per window costs about 7 times more for 1, 3 and 9 s than for 1 s)
+        t_bank=kurtosis_time([100, 300, 900])
+        self.assertLess(t_bank, 3.5*t_short)
+
     def test_rt_gaussian_filter(self):
         from am_signal import gaussian_filter
 
@@ -388,6 +618,247 @@ class RtTests(unittest.TestCase):
         self.assertAlmostEquals(starttime_diff,0.0)
 
 
+    def test_rt_convolve_fft(self):
+        from am_signal import gaussian_filter
+
+        # long enough to be convolved by fft
+        gauss,tshift = gaussian_filter(0.2, 5.0, 0.01)
+        self.assertGreaterEqual(len(gauss), am_rt_signal.CONVOLVE_FFT_MIN_LENGTH)
+
+        rt_trace=RtTrace()
+        rt_trace.registerRtProcess('convolve',conv_signal=gauss)
+        for tr in self.traces:
+            rt_trace.append(tr, gap_overlap_check = True)
+
+        # direct convolution, with zeros before the data
+        x=self.data_trace.data.astype(np.float64)
+        direct=np.real(np.convolve(x, gauss))[0:len(x)]
+        scale=np.max(np.abs(direct))
+        assert_array_almost_equal(rt_trace.data/scale, direct/scale, 6)
+
+    def test_rt_convolve_packets(self):
+        from am_signal import gaussian_filter
+
+        # convolved by FFT : the output of packets of any length only
+        # differs from that of the whole trace by the FFT round-off
+        gauss,tshift = gaussian_filter(1.0, 5.0, 0.01)
+        self.assertGreaterEqual(len(gauss), am_rt_signal.CONVOLVE_FFT_MIN_LENGTH)
+
+        np.random.seed(42)
+        npts=self.data_trace.stats.npts
+        cuts=np.unique(np.concatenate(([0, 1, 2, npts], \
+                np.random.randint(0, npts, 80))))
+        # tolerance relative to the largest output : double precision
+        # round-off, or one rounding to float32
+        for dtype, tol in ((np.float64, 1e-12), (np.float32, 2.0**-23)):
+            x=self.data_trace.data.astype(dtype)
+            whole=am_rt_signal.convolve(Trace(data=x.copy()), \
+                    conv_signal=gauss)
+            rtmemory_list=[RtMemory()]
+            packets=[am_rt_signal.convolve(Trace(data=x[i0:i1].copy()), \
+                    conv_signal=gauss, rtmemory_list=rtmemory_list) \
+                    for i0, i1 in zip(cuts[:-1], cuts[1:])]
+            diff=np.abs(np.concatenate(packets).astype(np.float64)-whole)
+            self.assertLessEqual(np.max(diff), tol*np.max(np.abs(whole)))
+
+    def test_kernel_spectra(self):
+        from am_signal import gaussian_filter, filter_cache
+
+        gauss,tshift = gaussian_filter(0.2, 5.0, 0.01)
+        x=self.data_trace.data
+        npts=500
+
+        # the filter cache is looked up once per FFT length, not per packet
+        lookups=[]
+        def spectrum(kernel, nfft):
+            lookups.append(nfft)
+            return filter_cache.__class__.spectrum(filter_cache, kernel, nfft)
+        filter_cache.spectrum=spectrum
+        try:
+            proc=am_rt_signal.CFProcessor(gauss, 3.0, 0.01)
+            rt_trace=RtTrace()
+            rt_trace.registerRtProcess('convolve',conv_signal=gauss)
+            for i in xrange(6):
+                proc.process(x[i*npts:(i+1)*npts])
+                tr=self.data_trace.slice(self.data_trace.stats.starttime+\
+                        i*npts*0.01, self.data_trace.stats.starttime+\
+                        ((i+1)*npts-1)*0.01)
+                rt_trace.append(tr.copy(), gap_overlap_check = True)
+        finally:
+            del filter_cache.spectrum
+        self.assertEqual(len(lookups), 2)
+
+    def test_filter_bank(self):
+        from am_signal import gaussian_filter_bank
+
+        bands=[(1.0, 2.0), (1.0, 5.0), (2.0, 10.0)]
+        weights=[1.0, 0.5, 2.0]
+        kernels,tshift = gaussian_filter_bank(bands, 0.01)
+        self.assertAlmostEqual(tshift, (kernels.shape[1]-1)/2*0.01)
+
+        # one convolve per band
+        band_data=[]
+        for kernel in kernels:
+            rtt=RtTrace()
+            rtt.registerRtProcess('convolve',conv_signal=kernel)
+            for tr in self.traces:
+                rtt.append(tr.copy(), gap_overlap_check = True)
+            band_data.append(rtt.data)
+        band_data=np.vstack(band_data)
+        weighted=np.dot(weights, band_data)
+        imax=np.argmax(np.abs(band_data), axis=0)
+        band_max=band_data[imax, np.arange(band_data.shape[1])]
+
+        rt_max=RtTrace()
+        rt_max.registerRtProcess('filter_bank',kernels=kernels)
+        rt_weighted=RtTrace()
+        rt_weighted.registerRtProcess('filter_bank',kernels=kernels, \
+                weights=weights)
+        for tr in self.traces:
+            rt_max.append(tr.copy(), gap_overlap_check = True)
+            rt_weighted.append(tr.copy(), gap_overlap_check = True)
+
+        scale=np.max(np.abs(band_data))
+        assert_array_almost_equal(rt_max.data/scale, band_max/scale, 5)
+        assert_array_almost_equal(rt_weighted.data/scale, weighted/scale, 5)
+
+    def test_cf_processor(self):
+        from am_signal import gaussian_filter
+
+        gauss,tshift = gaussian_filter(1.0, 5.0, 0.01)
+        win=3.0
+
+        rt_trace=RtTrace()
+        rt_trace.registerRtProcess('convolve',conv_signal=gauss)
+        rt_trace.registerRtProcess('sw_kurtosis',win=win)
+        rt_trace.registerRtProcess('boxcar',width=50)
+        rt_trace.registerRtProcess('differentiate')
+        rt_trace.registerRtProcess('neg_to_zero')
+
+        proc=am_rt_signal.CFProcessor(gauss, win, 0.01, boxcar_width=50)
+        cf=[]
+        for tr in self.traces:
+            cf.append(proc.process(tr.data))
+            rt_trace.append(tr, gap_overlap_check = True)
+        cf=np.concatenate(cf)
+
+        self.assertEqual(cf.dtype, np.float32)
+        assert_array_almost_equal(cf/np.max(cf), rt_trace.data/np.max(cf), 5)
+
+    def test_cf_processor_block(self):
+        from am_signal import gaussian_filter
+
+        gauss,tshift = gaussian_filter(1.0, 5.0, 0.01)
+        win=1.0
+        nsta=4
+
+        # stations with different data, in synchronous packets
+        x=self.data_trace.data
+        data=np.vstack([np.roll(x, 1000*i) for i in xrange(nsta)])
+        npts=data.shape[1]
+        cuts=[0, npts/3, 2*npts/3, npts]
+
+        block_proc=am_rt_signal.CFProcessor(gauss, win, 0.01, nsta=nsta)
+        single_procs=[am_rt_signal.CFProcessor(gauss, win, 0.01) \
+                for i in xrange(nsta)]
+        block_cf=[]
+        single_cf=[]
+        for j in xrange(3):
+            packet=data[:, cuts[j]:cuts[j+1]]
+            if j==1:
+                # stations may also be processed separately
+                block_cf.append(np.vstack([block_proc.process(packet[i], [i])\
+                        for i in xrange(nsta)]))
+            else:
+                block_cf.append(block_proc.process(packet))
+            single_cf.append(np.vstack([single_procs[i].process(packet[i]) \
+                    for i in xrange(nsta)]))
+        block_cf=np.hstack(block_cf)
+        single_cf=np.hstack(single_cf)
+
+        self.assertEqual(block_cf.shape, data.shape)
+        assert_array_almost_equal(block_cf/np.max(single_cf), \
+                single_cf/np.max(single_cf), 5)
+
+    def test_decimator(self):
+        from scipy.signal import lfilter
+
+        factor=4
+        dec=am_rt_signal.Decimator(factor, 0.01)
+        out=[]
+        times=[]
+        for tr in self.traces:
+            y, t = dec.process(tr.data, tr.stats.starttime)
+            out.append(y)
+            times.append(t)
+
+        # the packets follow each other on the decimated grid
+        dt_dec=factor*0.01
+        for i in xrange(1, len(times)):
+            self.assertAlmostEqual(times[i]-times[i-1], len(out[i-1])*dt_dec, 6)
+        self.assertAlmostEqual(np.round(times[0].timestamp/dt_dec)*dt_dec, \
+                times[0].timestamp, 6)
+        out=np.concatenate(out)
+
+        # same as filtering the whole trace and keeping one sample in factor
+        x=self.data_trace.data.astype(np.float64)
+        full=lfilter(dec.taps, [1.0], x)
+        k0=int(np.round((times[0]-self.traces[0].stats.starttime)/0.01)) + \
+                dec.delay
+        scale=np.max(np.abs(full))
+        assert_array_almost_equal(out/scale, full[k0::factor][0:len(out)]/scale,\
+                6)
+
+
+    def test_out_buffer(self):
+        win=3.0
+        processes=[('mean', {'win':win}, 1), ('variance', {'win':win}, 2),\
+                ('dx2', {'win':win}, 2), ('rec_kurtosis', {'win':win}, 3), \
+                ('sw_kurtosis', {'win':win}, 1), ('neg_to_zero', {}, 0)]
+        for name, options, nmem in processes:
+            rt_trace=RtTrace()
+            rt_trace.registerRtProcess(name, **options)
+            func=getattr(am_rt_signal, name)
+            rtmemory_list=[RtMemory() for i in xrange(nmem)]
+            data=[]
+            for tr in self.traces:
+                out=np.empty(tr.stats.npts, dtype=np.float32)
+                res=func(tr.copy(), rtmemory_list=rtmemory_list, out=out, \
+                        **options)
+                self.assertTrue(res is out)
+                data.append(out)
+                rt_trace.append(tr, gap_overlap_check = True)
+            assert_array_equal(np.concatenate(data), rt_trace.data)
+
+    def test_cf_processor_allocations(self):
+        from am_signal import gaussian_filter
+
+        try:
+            counter=NumpyAllocationCounter()
+        except (AttributeError, ValueError):
+            self.skipTest('numpy allocation hook not available')
+
+        nsta=3
+        npts=500
+        x=self.data_trace.data
+        data=np.vstack([np.roll(x, 1000*i) for i in xrange(nsta)])
+        out=np.empty((nsta, npts), dtype=np.float32)
+        # short (direct) and long (FFT) kernels, single window and bank
+        for f0, sigma, win in ((27.0, 7.0, 3.0), (1.0, 5.0, [1.0, 3.0])):
+            gauss,tshift = gaussian_filter(f0, sigma, 0.01)
+            proc=am_rt_signal.CFProcessor(gauss, win, 0.01, nsta=nsta)
+            # the first packet sets up the state and the work arrays
+            proc.process(data[:, 0:npts], out=out)
+            with counter:
+                for i in xrange(1, 6):
+                    proc.process(data[:, i*npts:(i+1)*npts], out=out)
+            self.assertEqual(counter.count, 0)
+
+        # without an output array, only the output is allocated
+        with counter:
+            proc.process(data[:, 6*npts:7*npts])
+        self.assertEqual(counter.count, 1)
+
 
 #@unittest.skip('Skipping filter tests')
 class FilterTests(unittest.TestCase):
@@ -453,6 +924,35 @@ class FilterTests(unittest.TestCase):
         cf5=cfrequency(data_trace5.data,1/dt,0,0)
         self.assertAlmostEquals(cf5,5.0,0)
 
+    def test_filter_cache(self):
+        import os
+        from am_signal import gaussian_filter, FilterCache
+
+        cache=FilterCache()
+        gauss, tshift = cache.gaussian_filter(1.0, 5.0, 0.01)
+        gauss_direct, tshift_direct = gaussian_filter(1.0, 5.0, 0.01)
+        np.testing.assert_array_equal(gauss, gauss_direct)
+        self.assertEqual(tshift, tshift_direct)
+        # computed once
+        self.assertTrue(cache.gaussian_filter(1.0, 5.0, 0.01)[0] is gauss)
+        spec=cache.spectrum(np.real(gauss), 1024)
+        np.testing.assert_array_equal(spec, np.fft.rfft(np.real(gauss), 1024))
+        self.assertTrue(cache.spectrum(np.real(gauss), 1024) is spec)
+
+        # read back from file
+        fname=os.path.join('test_data', 'filter_cache_test.hdf5')
+        cache.save(fname)
+        new_cache=FilterCache()
+        new_cache.load(fname)
+        os.remove(fname)
+        self.assertEqual(sorted(new_cache.kernels.keys()), \
+                sorted(cache.kernels.keys()))
+        self.assertEqual(sorted(new_cache.spectra.keys()), \
+                sorted(cache.spectra.keys()))
+        np.testing.assert_array_equal(new_cache.gaussian_filter(1.0, 5.0, \
+                0.01)[0], gauss)
+        self.assertFalse(new_cache.modified)
+
 if __name__ == '__main__':
 
   import logging
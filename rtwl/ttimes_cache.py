@@ -0,0 +1,187 @@
+import os, glob, shutil, hashlib, logging
+import h5py
+import numpy as np
+
+
+class TtimesCache(object):
+    """
+    Content-addressed cache of the interpolated travel-time products : time
+    grids interpolated onto a search grid, and travel-times interpolated at
+    points (the *_ttimes.hdf5 files).
+
+    Each product is identified by a key hashing everything it is computed
+    from (contents and header of the source time grid, target grid header
+    or points, interpolation order). The product files carry their key in
+    the 'cache_key' attribute, so a file that is still current is used as
+    is. The cache directory holds a copy of the products under their key,
+    so switching back to a previous search grid, set of points or velocity
+    model does not recompute them. The least recently used entries are
+    evicted to keep the directory within max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2*1024*1024*1024):
+        """
+        :param cache_dir: directory holding the cached products (created if
+            needed)
+        :param max_bytes: size limit of the cache directory, in bytes
+        """
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.hits=0
+        self.misses=0
+        # digests of the source grids, by (path, mtime, size)
+        self._digests={}
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def source_digest(self, filename):
+        """
+        Returns the digest of the contents and header of a time grid file.
+        """
+        st=os.stat(filename)
+        memo_key=(os.path.abspath(filename), st.st_mtime, st.st_size)
+        digest=self._digests.get(memo_key)
+        if digest is None:
+            h=hashlib.md5()
+            f=h5py.File(filename,'r')
+            dset=f['grid_data']
+            h.update(repr(sorted((str(k), str(v)) for k, v in \
+                    dset.attrs.iteritems() if k != 'cache_key')))
+            h.update(np.ascontiguousarray(dset[:]).tostring())
+            f.close()
+            digest=h.hexdigest()
+            self._digests[memo_key]=digest
+        return digest
+
+    def grid_key(self, tgrid_file, grid_info, order):
+        """
+        Returns the key of the interpolation of a time grid onto the grid
+        described by grid_info (nx, ny, nz, x_orig, ..., dz).
+        """
+        h=hashlib.md5('grid')
+        h.update(self.source_digest(tgrid_file))
+        h.update(repr([(name, grid_info[name]) for name in ['nx','ny','nz',\
+                'x_orig','y_orig','z_orig','dx','dy','dz']]))
+        h.update(repr(order))
+        return h.hexdigest()
+
+    def ttimes_key(self, tgrid_file, x, y, z, order):
+        """
+        Returns the key of the interpolation of a time grid at the points x,
+        y, z.
+        """
+        h=hashlib.md5('ttimes')
+        h.update(self.source_digest(tgrid_file))
+        for coord in (x, y, z):
+            h.update(np.ascontiguousarray(coord, dtype=np.float64).tostring())
+        h.update(repr(order))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key+'.hdf5')
+
+    def fetch(self, key, filename):
+        """
+        Makes filename hold the product of the given key. Returns True (a
+        hit) if filename was already current or the product was in the
+        cache, otherwise False (a miss) : the product must then be
+        computed, written to filename with file_key set, and stored.
+        """
+        if os.path.isfile(filename) and file_key(filename)==key:
+            self.hits+=1
+            return True
+        entry=self._entry(key)
+        if os.path.isfile(entry):
+            _copy_atomic(entry, filename)
+            # mark the entry as recently used
+            os.utime(entry, None)
+            self.hits+=1
+            return True
+        self.misses+=1
+        return False
+
+    def store(self, key, filename):
+        """
+        Adds a product file to the cache, then evicts the least recently
+        used entries beyond max_bytes. Files larger than max_bytes are not
+        cached.
+        """
+        if os.path.getsize(filename) > self.max_bytes:
+            return
+        _copy_atomic(filename, self._entry(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits within
+        max_bytes.
+        """
+        entries=[]
+        for entry in glob.glob(os.path.join(self.cache_dir, '*.hdf5')):
+            try:
+                st=os.stat(entry)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+        entries.sort()
+        nbytes=sum([size for mtime, size, entry in entries])
+        for mtime, size, entry in entries:
+            if nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            nbytes-=size
+
+    def stats(self):
+        """
+        Returns a dictionary of the number of hits and misses, and of the
+        number of entries and size of the cache directory.
+        """
+        sizes=[os.path.getsize(entry) for entry in \
+                glob.glob(os.path.join(self.cache_dir, '*.hdf5'))]
+        return {'hits':self.hits, 'misses':self.misses, \
+                'entries':len(sizes), 'nbytes':sum(sizes)}
+
+    def log_stats(self, name):
+        stats=self.stats()
+        logging.info('%s cache : %d hits, %d misses, %d entries (%.1f MB)'%\
+                (name, stats['hits'], stats['misses'], stats['entries'], \
+                stats['nbytes']/1024.0/1024.0))
+
+
+def file_key(filename):
+    """
+    Returns the cache key of a product file, or None.
+    """
+    try:
+        f=h5py.File(filename,'r')
+    except IOError:
+        return None
+    key=f.attrs.get('cache_key')
+    f.close()
+    return None if key is None else str(key)
+
+def set_file_key(filename, key):
+    """
+    Sets the cache key of a product file.
+    """
+    f=h5py.File(filename,'r+')
+    f.attrs['cache_key']=key
+    f.close()
+
+def _copy_atomic(src, dst):
+    """
+    Copies src to dst through a temporary file, so readers of dst never see
+    a partial file. The files are copied rather than linked, so rewriting a
+    product in place cannot alter the cache.
+    """
+    tmp_name='%s.%d.tmp'%(dst, os.getpid())
+    shutil.copyfile(src, tmp_name)
+    os.rename(tmp_name, dst)
@@ -0,0 +1,138 @@
+import os, hashlib
+import h5py
+import numpy as np
+
+
+class TtimesStore(object):
+    """
+    Consolidated travel-times of all the stations, in a single hdf5 file
+    holding the (nsta, npts) travel-time matrix, the station names and
+    coordinates, the point coordinates and the integer delay table for a
+    given sampling interval.
+
+    The datasets are written contiguous and uncompressed, one row per
+    station, and are memory-mapped rather than read : opening the store
+    costs the same whatever nsta and npts, only the pages that are used are
+    read, and processes opening (or forked after opening) the same store
+    share them.
+    """
+
+    def __init__(self, filename):
+        """
+        Opens and memory-maps a store written by consolidate.
+        """
+        self.filename=filename
+        f=h5py.File(filename,'r')
+        self.key=str(f.attrs['key'])
+        self.dt=float(f.attrs['dt'])
+        self.sta_list=[str(sta) for sta in f['stations'][:]]
+        self.ttimes=_memmap(filename, f['ttimes'])
+        self.x=_memmap(filename, f['x'])
+        self.y=_memmap(filename, f['y'])
+        self.z=_memmap(filename, f['z'])
+        self.delay_origin=_memmap(filename, f['delay_origin'])
+        self.delay_table=_memmap(filename, f['delay_table'])
+        self.moveout_span=_memmap(filename, f['moveout_span'])
+        if 'sta_xyz' in f:
+            self.sta_xyz=_memmap(filename, f['sta_xyz'])
+        else:
+            self.sta_xyz=None
+        f.close()
+        self.nsta, self.npts = self.ttimes.shape
+
+    @staticmethod
+    def sources_key(ttimes_fnames, dt):
+        """
+        Returns a string identifying a list of ttimes files (names,
+        modification times and sizes, in order) and a sampling interval,
+        used to check the validity of a store without opening the files.
+        """
+        h=hashlib.md5()
+        for fname in ttimes_fnames:
+            st=os.stat(fname)
+            h.update(repr((os.path.abspath(fname), st.st_mtime, st.st_size)))
+        h.update(repr(float(dt)))
+        return h.hexdigest()
+
+    @classmethod
+    def cached(cls, ttimes_fnames, filename, dt):
+        """
+        Opens the store in filename if it was consolidated from the same
+        ttimes files for the same sampling interval, otherwise consolidates
+        it first.
+        """
+        if len(ttimes_fnames)==0:
+            msg='No ttimes files to consolidate into %s'%filename
+            raise IOError(msg)
+        key=cls.sources_key(ttimes_fnames, dt)
+        if os.path.isfile(filename):
+            try:
+                store=cls(filename)
+            except (IOError, KeyError):
+                store=None
+            if store is not None and store.key==key:
+                return store
+        cls.consolidate(ttimes_fnames, filename, dt, key)
+        return cls(filename)
+
+    @staticmethod
+    def consolidate(ttimes_fnames, filename, dt, key=''):
+        """
+        Writes the store of a list of ttimes files (one per station, as
+        written by hdf5_grids.interpolateTimeGrid), with the delay table for
+        sampling interval dt. The stations are kept in the order of
+        ttimes_fnames.
+        """
+        from migration import make_delay_table
+
+        nsta=len(ttimes_fnames)
+        f=h5py.File(ttimes_fnames[0],'r')
+        x=f['x'][:]
+        y=f['y'][:]
+        z=f['z'][:]
+        ttimes=np.empty((nsta, len(x)), dtype=f['ttimes'].dtype)
+        f.close()
+        sta_list=[]
+        sta_xyz=[]
+        for ista in xrange(nsta):
+            f=h5py.File(ttimes_fnames[ista],'r')
+            dset=f['ttimes']
+            dset.read_direct(ttimes[ista])
+            attrs=dset.attrs
+            sta_list.append(str(attrs['station']))
+            if 'sta_x' in attrs:
+                sta_xyz.append((attrs['sta_x'], attrs['sta_y'], attrs['sta_z']))
+            f.close()
+        delay_origin, delay_table, moveout_span = make_delay_table(ttimes, dt)
+
+        tmp_name='%s.%d.tmp'%(filename, os.getpid())
+        f=h5py.File(tmp_name,'w')
+        f.create_dataset('stations', data=np.array(sta_list, dtype=np.string_))
+        f.create_dataset('ttimes', data=ttimes)
+        f.create_dataset('x', data=x)
+        f.create_dataset('y', data=y)
+        f.create_dataset('z', data=z)
+        f.create_dataset('delay_origin', data=delay_origin)
+        f.create_dataset('delay_table', data=delay_table)
+        f.create_dataset('moveout_span', data=moveout_span)
+        # station coordinates (if all the ttimes files have them)
+        if len(sta_xyz)==nsta:
+            f.create_dataset('sta_xyz', data=np.array(sta_xyz))
+        f.attrs['dt']=dt
+        f.attrs['key']=key
+        f.close()
+        os.rename(tmp_name, filename)
+
+
+def _memmap(filename, dset):
+    """
+    Returns a read-only array mapping a contiguous dataset of an hdf5 file.
+    Datasets without storage (empty ones) are read.
+    """
+    offset=dset.id.get_offset()
+    if offset is None:
+        return dset[...]
+    # a plain ndarray view of the mapping, so the results of operations on
+    # it are not memmaps
+    return np.asarray(np.memmap(filename, mode='r', dtype=dset.dtype, \
+            shape=dset.shape, offset=offset))